@@ -0,0 +1,406 @@
+"""
+Émulateur local des API utilisées (Anthropic, Perplexity, xAI, Gemini).
+
+Un seul serveur HTTP (bibliothèque standard) répond, selon le chemin, au format de
+chaque fournisseur, en streaming SSE ou non :
+- Anthropic  : POST /v1/messages (événements message_start ... message_stop,
+  avec un bloc server_tool_use web_search et son web_search_tool_result)
+- Perplexity : POST /chat/completions
+- xAI        : POST /v1/chat/completions
+- Gemini     : POST /v1beta/models/{modèle}:streamGenerateContent?alt=sse et :generateContent
+
+Chaque fournisseur a son profil : délai avant le premier token, débit en tokens par
+seconde, taux d'erreurs 500 et de réponses 429 (avec Retry-After).
+Le temps passé côté serveur est mesuré par requête, pour isoler le surcoût des clients.
+"""
+
+import json
+import time
+import uuid
+import random
+import threading
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Iterator, Tuple
+
+
+PROVIDERS = ("anthropic", "perplexity", "xai", "gemini")
+
+RESPONSE_WORDS = (
+    "Selon l'article 1240 du Code civil, tout fait quelconque de l'homme qui cause à autrui "
+    "un dommage oblige celui par la faute duquel il est arrivé à le réparer. La jurisprudence "
+    "de la Cour de cassation précise les conditions de la responsabilité délictuelle [1]. "
+).split()
+
+CITATIONS = [
+    "https://www.legifrance.gouv.fr/codes/article_lc/LEGIARTI000032041571",
+    "https://www.service-public.fr/particuliers/vosdroits/F1234",
+]
+
+
+@dataclass
+class EmulatorProfile:
+    """Comportement simulé d'un fournisseur"""
+    ttft: float = 0.3                # secondes avant le premier token
+    tokens_per_second: float = 80.0  # débit de génération
+    response_tokens: int = 120       # longueur de la réponse
+    tokens_per_chunk: int = 3        # tokens par événement SSE
+    error_rate: float = 0.0          # proportion de réponses 500
+    rate_limit_rate: float = 0.0     # proportion de réponses 429
+    retry_after: float = 1.0         # en-tête Retry-After des 429 (secondes)
+
+
+@dataclass
+class RequestRecord:
+    """Trace d'une requête servie par l'émulateur"""
+    provider: str
+    path: str
+    status: int
+    stream: bool
+    started: float
+    finished: float = 0.0
+
+    @property
+    def server_time(self) -> float:
+        return self.finished - self.started
+
+
+@dataclass
+class _ProviderState:
+    profile: EmulatorProfile
+    rng: random.Random = field(default_factory=random.Random)
+
+
+def route_request(path: str, body: dict) -> Optional[Tuple[str, bool]]:
+    """Fournisseur et mode streaming d'une requête de génération (None pour les autres chemins)"""
+    if path == "/v1/messages":
+        return "anthropic", bool(body.get("stream"))
+    if path == "/chat/completions":
+        return "perplexity", bool(body.get("stream"))
+    if path == "/v1/chat/completions":
+        return "xai", bool(body.get("stream"))
+    if path.startswith("/v1beta/models/") and (":generateContent" in path or ":streamGenerateContent" in path):
+        return "gemini", ":streamGenerateContent" in path
+    return None
+
+
+def _response_tokens(count: int) -> List[str]:
+    """Tokens (mots) de la réponse simulée"""
+    return [RESPONSE_WORDS[i % len(RESPONSE_WORDS)] + " " for i in range(count)]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Routage des requêtes vers le format du fournisseur"""
+
+    server: "_EmulatorHTTPServer"
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):  # noqa: A002 - signature de BaseHTTPRequestHandler
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw_body = self.rfile.read(length) if length else b""
+        try:
+            body = json.loads(raw_body) if raw_body else {}
+        except ValueError:
+            body = {}
+
+        path = self.path.split("?", 1)[0]
+        route = route_request(path, body)
+        if route is None:
+            self._send_json(404, {"error": {"message": f"Chemin inconnu: {path}"}})
+            return
+        provider, stream = route
+
+        emulator = self.server.emulator
+        record = RequestRecord(provider, path, 200, stream, time.perf_counter())
+        try:
+            state = emulator.providers[provider]
+            draw = state.rng.random()
+            if draw < state.profile.rate_limit_rate:
+                record.status = 429
+                self._send_error(provider, 429, "rate_limit_error", "Trop de requêtes (émulateur)",
+                                 {"Retry-After": f"{state.profile.retry_after:g}"})
+            elif draw < state.profile.rate_limit_rate + state.profile.error_rate:
+                record.status = 500
+                self._send_error(provider, 500, "api_error", "Erreur interne (émulateur)")
+            else:
+                handler = getattr(self, f"_serve_{provider}")
+                handler(body, state.profile, stream)
+        except (BrokenPipeError, ConnectionResetError):
+            record.status = 499  # client parti avant la fin
+        finally:
+            record.finished = time.perf_counter()
+            emulator._record(record)
+
+    # --- Écriture des réponses ---
+
+    def _send_json(self, status: int, payload: dict, headers: Optional[Dict[str, str]] = None) -> None:
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_error(self, provider: str, status: int, error_type: str, message: str,
+                    headers: Optional[Dict[str, str]] = None) -> None:
+        if provider == "anthropic":
+            payload = {"type": "error", "error": {"type": error_type, "message": message}}
+        elif provider == "gemini":
+            payload = {"error": {"code": status, "message": message,
+                                 "status": "RESOURCE_EXHAUSTED" if status == 429 else "INTERNAL"}}
+        else:
+            payload = {"error": {"type": error_type, "message": message, "code": status}}
+        self._send_json(status, payload, headers)
+
+    def _start_sse(self) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+    def _sse(self, data: dict, event: Optional[str] = None) -> None:
+        message = f"event: {event}\n" if event else ""
+        message += f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+        self.wfile.write(message.encode("utf-8"))
+        self.wfile.flush()
+
+    @staticmethod
+    def _paced_chunks(profile: EmulatorProfile) -> Iterator[str]:
+        """Fragments de texte émis au rythme du profil (premier fragment après ttft)"""
+        tokens = _response_tokens(profile.response_tokens)
+        time.sleep(profile.ttft)
+        interval = profile.tokens_per_chunk / profile.tokens_per_second if profile.tokens_per_second else 0.0
+        for start in range(0, len(tokens), profile.tokens_per_chunk):
+            if start:
+                time.sleep(interval)
+            yield "".join(tokens[start:start + profile.tokens_per_chunk])
+
+    @staticmethod
+    def _full_text(profile: EmulatorProfile) -> str:
+        """Réponse complète, rendue après le temps de génération complet"""
+        time.sleep(profile.ttft + (profile.response_tokens / profile.tokens_per_second if profile.tokens_per_second else 0.0))
+        return "".join(_response_tokens(profile.response_tokens))
+
+    @staticmethod
+    def _input_tokens(body: dict) -> int:
+        return max(len(json.dumps(body.get("messages") or body.get("contents") or "")) // 4, 1)
+
+    # --- Anthropic Messages ---
+
+    def _serve_anthropic(self, body: dict, profile: EmulatorProfile, stream: bool) -> None:
+        message_id = f"msg_{uuid.uuid4().hex[:24]}"
+        tool_id = f"srvtoolu_{uuid.uuid4().hex[:24]}"
+        model = body.get("model", "claude-emulator")
+        input_tokens = self._input_tokens(body)
+        web_search = any(tool.get("name") == "web_search" for tool in body.get("tools") or [])
+        search_results = [
+            {"type": "web_search_result", "url": url, "title": f"Source {i}",
+             "encrypted_content": "emulateur", "page_age": None}
+            for i, url in enumerate(CITATIONS, 1)
+        ]
+        usage_end = {
+            "output_tokens": profile.response_tokens,
+            "server_tool_use": {"web_search_requests": 1 if web_search else 0}
+        }
+
+        if not stream:
+            text = self._full_text(profile)
+            content = []
+            if web_search:
+                content.append({"type": "server_tool_use", "id": tool_id, "name": "web_search",
+                                "input": {"query": "responsabilité délictuelle"}})
+                content.append({"type": "web_search_tool_result", "tool_use_id": tool_id, "content": search_results})
+            content.append({"type": "text", "text": text, "citations": [
+                {"type": "web_search_result_location", "url": CITATIONS[0], "title": "Source 1",
+                 "cited_text": "Tout fait quelconque de l'homme...", "encrypted_index": "emulateur"}
+            ] if web_search else None})
+            self._send_json(200, {
+                "id": message_id, "type": "message", "role": "assistant", "model": model,
+                "content": content, "stop_reason": "end_turn", "stop_sequence": None,
+                "usage": {"input_tokens": input_tokens, "cache_creation_input_tokens": 0,
+                          "cache_read_input_tokens": 0, **usage_end}
+            })
+            return
+
+        self._start_sse()
+        self._sse({"type": "message_start", "message": {
+            "id": message_id, "type": "message", "role": "assistant", "model": model, "content": [],
+            "stop_reason": None, "stop_sequence": None,
+            "usage": {"input_tokens": input_tokens, "output_tokens": 1,
+                      "cache_creation_input_tokens": 0, "cache_read_input_tokens": 0}
+        }}, "message_start")
+
+        index = 0
+        if web_search:
+            self._sse({"type": "content_block_start", "index": index, "content_block": {
+                "type": "server_tool_use", "id": tool_id, "name": "web_search", "input": {}
+            }}, "content_block_start")
+            self._sse({"type": "content_block_delta", "index": index, "delta": {
+                "type": "input_json_delta", "partial_json": json.dumps({"query": "responsabilité délictuelle"})
+            }}, "content_block_delta")
+            self._sse({"type": "content_block_stop", "index": index}, "content_block_stop")
+            index += 1
+            self._sse({"type": "content_block_start", "index": index, "content_block": {
+                "type": "web_search_tool_result", "tool_use_id": tool_id, "content": search_results
+            }}, "content_block_start")
+            self._sse({"type": "content_block_stop", "index": index}, "content_block_stop")
+            index += 1
+
+        self._sse({"type": "content_block_start", "index": index,
+                   "content_block": {"type": "text", "text": ""}}, "content_block_start")
+        for chunk in self._paced_chunks(profile):
+            self._sse({"type": "content_block_delta", "index": index,
+                       "delta": {"type": "text_delta", "text": chunk}}, "content_block_delta")
+        self._sse({"type": "content_block_stop", "index": index}, "content_block_stop")
+        self._sse({"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                   "usage": usage_end}, "message_delta")
+        self._sse({"type": "message_stop"}, "message_stop")
+
+    # --- Perplexity / xAI chat/completions ---
+
+    def _serve_chat_completions(self, body: dict, profile: EmulatorProfile, stream: bool, with_citations: bool) -> None:
+        completion_id = uuid.uuid4().hex
+        model = body.get("model", "emulator")
+        usage = {
+            "prompt_tokens": self._input_tokens(body),
+            "completion_tokens": profile.response_tokens,
+            "total_tokens": self._input_tokens(body) + profile.response_tokens
+        }
+        extra = {"citations": CITATIONS} if with_citations else {}
+
+        if not stream:
+            self._send_json(200, {
+                "id": completion_id, "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": self._full_text(profile)}}],
+                "usage": usage, **extra
+            })
+            return
+
+        self._start_sse()
+        for chunk in self._paced_chunks(profile):
+            self._sse({
+                "id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "finish_reason": None, "delta": {"role": "assistant", "content": chunk}}],
+                **extra
+            })
+        self._sse({
+            "id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+            "choices": [{"index": 0, "finish_reason": "stop", "delta": {}}],
+            "usage": usage, **extra
+        })
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def _serve_perplexity(self, body: dict, profile: EmulatorProfile, stream: bool) -> None:
+        self._serve_chat_completions(body, profile, stream, with_citations=True)
+
+    def _serve_xai(self, body: dict, profile: EmulatorProfile, stream: bool) -> None:
+        with_citations = bool((body.get("search_parameters") or {}).get("return_citations"))
+        self._serve_chat_completions(body, profile, stream, with_citations=with_citations)
+
+    # --- Gemini generateContent ---
+
+    def _serve_gemini(self, body: dict, profile: EmulatorProfile, stream: bool) -> None:
+        prompt_tokens = self._input_tokens(body)
+
+        def response(text: str, output_tokens: int, finished: bool) -> dict:
+            candidate = {"content": {"parts": [{"text": text}], "role": "model"}, "index": 0}
+            if finished:
+                candidate["finishReason"] = "STOP"
+            return {
+                "candidates": [candidate],
+                "usageMetadata": {"promptTokenCount": prompt_tokens, "candidatesTokenCount": output_tokens,
+                                  "totalTokenCount": prompt_tokens + output_tokens},
+                "modelVersion": "gemini-emulator"
+            }
+
+        if not stream:
+            self._send_json(200, response(self._full_text(profile), profile.response_tokens, True))
+            return
+
+        self._start_sse()
+        emitted = 0
+        chunks = list(self._paced_chunks(profile))
+        for i, chunk in enumerate(chunks):
+            emitted = min(emitted + profile.tokens_per_chunk, profile.response_tokens)
+            self._sse(response(chunk, emitted, i == len(chunks) - 1))
+
+
+class _EmulatorHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, emulator: "ProviderEmulator"):
+        super().__init__(address, _Handler)
+        self.emulator = emulator
+
+
+class ProviderEmulator:
+    """
+    Serveur local qui émule les fournisseurs, démarré dans un thread.
+
+    Exemple :
+        with ProviderEmulator({"anthropic": EmulatorProfile(ttft=0.5)}) as emulator:
+            os.environ["ANTHROPIC_BASE_URL"] = emulator.base_url
+    """
+
+    def __init__(
+        self,
+        profiles: Optional[Dict[str, EmulatorProfile]] = None,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        seed: int = 0
+    ):
+        profiles = profiles or {}
+        self.providers = {
+            name: _ProviderState(profiles.get(name, EmulatorProfile()), random.Random(seed + i))
+            for i, name in enumerate(PROVIDERS)
+        }
+        self._server = _EmulatorHTTPServer((host, port), self)
+        self._thread: Optional[threading.Thread] = None
+        self._records: List[RequestRecord] = []
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def set_profile(self, provider: str, profile: EmulatorProfile) -> None:
+        """Change le comportement simulé d'un fournisseur"""
+        self.providers[provider].profile = profile
+
+    def _record(self, record: RequestRecord) -> None:
+        with self._lock:
+            self._records.append(record)
+
+    def drain_records(self) -> List[RequestRecord]:
+        """Retourne et oublie les requêtes servies depuis le dernier appel"""
+        with self._lock:
+            records, self._records = self._records, []
+        return records
+
+    def start(self) -> "ProviderEmulator":
+        self._thread = threading.Thread(target=self._server.serve_forever, name="provider-emulator", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self) -> "ProviderEmulator":
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.stop()
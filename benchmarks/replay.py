@@ -0,0 +1,460 @@
+"""
+Capture et rejeu des flux des fournisseurs (Anthropic, Perplexity, xAI, Gemini).
+
+- StreamRecorder : proxy local qui relaie les requêtes vers les vraies API et écrit chaque
+  réponse de génération (octets reçus et événements SSE, avec leur instant d'arrivée)
+  dans un fichier de fixture.
+- StreamReplayer : serveur local qui rejoue ces fixtures, au rythme enregistré ou aussi
+  vite que possible.
+
+Les deux se branchent comme l'émulateur, par les variables *_BASE_URL : cela couvre
+PerplexityClient.search_stream_async, call_grok, les consommateurs de messages.stream
+d'Anthropic et GeminiClient.send_message_stream sans modifier ces clients.
+
+Format d'une fixture (JSON Lines, un fichier par réponse) :
+    {"provider", "method", "path", "stream", "model", "status", "headers"}   (1re ligne)
+    {"t": secondes depuis l'envoi de la requête, "chunk": texte reçu}
+    {"t": ..., "event": type SSE, "data": données}                         (événements complets)
+
+Usage :
+    python benchmarks/replay.py record fixtures/      # puis lancer l'application avec les *_BASE_URL affichées
+    python benchmarks/replay.py serve fixtures/ --speed 0
+"""
+
+import sys
+import json
+import time
+import codecs
+import argparse
+import threading
+from collections import defaultdict, deque
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Deque, Dict, List, Optional, Tuple
+
+import httpx
+
+from emulator import RequestRecord, route_request
+
+
+UPSTREAMS = {
+    "anthropic": "https://api.anthropic.com",
+    "perplexity": "https://api.perplexity.ai",
+    "xai": "https://api.x.ai",
+    "gemini": "https://generativelanguage.googleapis.com",
+}
+
+# En-têtes propres à une connexion, jamais relayés
+HOP_HEADERS = {"host", "connection", "content-length", "transfer-encoding", "accept-encoding",
+               "content-encoding", "keep-alive"}
+
+# En-têtes de réponse conservés dans les fixtures
+RECORDED_HEADERS = {"content-type", "retry-after"}
+
+
+def upstream_provider(path: str) -> Optional[str]:
+    """Fournisseur vers lequel relayer un chemin (génération, fichiers, caches...)"""
+    if path == "/v1/chat/completions":
+        return "xai"
+    if path == "/chat/completions":
+        return "perplexity"
+    if path.startswith(("/v1beta/", "/upload/")):
+        return "gemini"
+    if path.startswith("/v1/"):
+        return "anthropic"
+    return None
+
+
+class SSEParser:
+    """Découpe incrémentale d'un flux SSE en événements (type, données)"""
+
+    def __init__(self):
+        self._buffer = ""
+
+    def feed(self, text: str) -> List[Tuple[str, str]]:
+        self._buffer += text.replace("\r\n", "\n")
+        events = []
+        while "\n\n" in self._buffer:
+            block, self._buffer = self._buffer.split("\n\n", 1)
+            event, data = "message", []
+            for line in block.split("\n"):
+                if line.startswith("event:"):
+                    event = line[6:].strip()
+                elif line.startswith("data:"):
+                    data.append(line[5:].lstrip())
+            if data:
+                events.append((event, "\n".join(data)))
+        return events
+
+
+@dataclass
+class StreamFixture:
+    """Réponse enregistrée d'un fournisseur"""
+    provider: str
+    path: str
+    stream: bool
+    status: int = 200
+    model: str = ""
+    method: str = "POST"
+    headers: Dict[str, str] = field(default_factory=dict)
+    chunks: List[Tuple[float, str]] = field(default_factory=list)
+    events: List[Tuple[float, str, str]] = field(default_factory=list)
+
+    @property
+    def ttft(self) -> float:
+        """Délai avant le premier octet de réponse"""
+        return self.chunks[0][0] if self.chunks else 0.0
+
+    @property
+    def duration(self) -> float:
+        return self.chunks[-1][0] if self.chunks else 0.0
+
+    def body(self) -> bytes:
+        return "".join(chunk for _, chunk in self.chunks).encode("utf-8")
+
+    def save(self, path: Path) -> None:
+        meta = {"provider": self.provider, "method": self.method, "path": self.path, "stream": self.stream,
+                "model": self.model, "status": self.status, "headers": self.headers}
+        lines = [meta]
+        lines += [{"t": round(t, 6), "chunk": chunk} for t, chunk in self.chunks]
+        lines += [{"t": round(t, 6), "event": event, "data": data} for t, event, data in self.events]
+        path.write_text("\n".join(json.dumps(line, ensure_ascii=False) for line in lines) + "\n", encoding="utf-8")
+
+    @classmethod
+    def load(cls, path: Path) -> "StreamFixture":
+        lines = [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines() if line.strip()]
+        meta = lines[0]
+        fixture = cls(
+            provider=meta["provider"],
+            path=meta["path"],
+            stream=meta.get("stream", False),
+            status=meta.get("status", 200),
+            model=meta.get("model", ""),
+            method=meta.get("method", "POST"),
+            headers=meta.get("headers", {})
+        )
+        for line in lines[1:]:
+            if "chunk" in line:
+                fixture.chunks.append((line["t"], line["chunk"]))
+            elif "event" in line:
+                fixture.events.append((line["t"], line["event"], line["data"]))
+        return fixture
+
+
+def load_fixtures(directory: Path) -> List[StreamFixture]:
+    """Fixtures d'un dossier, dans l'ordre d'enregistrement"""
+    return [StreamFixture.load(path) for path in sorted(Path(directory).glob("*.jsonl"))]
+
+
+def _read_body(handler: BaseHTTPRequestHandler) -> Tuple[bytes, dict]:
+    length = int(handler.headers.get("Content-Length") or 0)
+    raw_body = handler.rfile.read(length) if length else b""
+    try:
+        body = json.loads(raw_body) if raw_body else {}
+    except ValueError:
+        body = {}
+    return raw_body, body if isinstance(body, dict) else {}
+
+
+# --- Capture ---
+
+class _RecorderHandler(BaseHTTPRequestHandler):
+    """Relaie chaque requête vers le fournisseur et enregistre les réponses de génération"""
+
+    server: "_LocalHTTPServer"
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):  # noqa: A002 - signature de BaseHTTPRequestHandler
+        pass
+
+    def do_POST(self):
+        self._forward()
+
+    do_GET = do_PUT = do_PATCH = do_DELETE = do_POST
+
+    def _forward(self):
+        recorder: StreamRecorder = self.server.owner
+        raw_body, body = _read_body(self)
+        path = self.path.split("?", 1)[0]
+        provider = upstream_provider(path)
+        if provider is None:
+            self.send_error(404, f"Chemin inconnu: {path}")
+            return
+
+        route = route_request(path, body) if self.command == "POST" else None
+        model = str(body.get("model") or path.split("/models/")[-1].split(":")[0])
+        fixture = StreamFixture(provider, path, route[1], model=model, method=self.command) if route else None
+        headers = {name: value for name, value in self.headers.items() if name.lower() not in HOP_HEADERS}
+        headers["Accept-Encoding"] = "identity"
+
+        start = time.perf_counter()
+        headers_sent = False
+        try:
+            with recorder.client.stream(self.command, recorder.upstreams[provider] + self.path,
+                                        headers=headers, content=raw_body) as response:
+                headers_sent = True
+                self.send_response(response.status_code)
+                for name, value in response.headers.items():
+                    if name.lower() not in HOP_HEADERS:
+                        self.send_header(name, value)
+                self.send_header("Connection", "close")
+                self.end_headers()
+                self.close_connection = True
+
+                if fixture:
+                    fixture.status = response.status_code
+                    fixture.headers = {name: value for name, value in response.headers.items()
+                                       if name.lower() in RECORDED_HEADERS}
+                decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+                parser = SSEParser()
+                for data in response.iter_bytes():
+                    self.wfile.write(data)
+                    self.wfile.flush()
+                    if fixture:
+                        elapsed = time.perf_counter() - start
+                        text = decoder.decode(data)
+                        if text:
+                            fixture.chunks.append((elapsed, text))
+                        if fixture.stream:
+                            fixture.events.extend((elapsed, event, payload) for event, payload in parser.feed(text))
+        except httpx.HTTPError as e:
+            if not headers_sent:
+                self.send_error(502, f"Fournisseur injoignable: {e}")
+            return
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # client parti avant la fin : la fixture est gardée telle que reçue
+
+        if fixture:
+            recorder._save(fixture)
+
+
+class _LocalHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, handler, owner):
+        super().__init__(address, handler)
+        self.owner = owner
+
+
+class _BackgroundServer:
+    """Serveur HTTP local démarré dans un thread (même cycle de vie que ProviderEmulator)"""
+
+    handler = BaseHTTPRequestHandler
+    thread_name = "local-server"
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self._server = _LocalHTTPServer((host, port), self.handler, self)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def environment(self) -> Dict[str, str]:
+        """Variables à définir pour y pointer tous les clients du projet"""
+        return {
+            "ANTHROPIC_BASE_URL": self.base_url,
+            "PERPLEXITY_BASE_URL": self.base_url,
+            "XAI_BASE_URL": f"{self.base_url}/v1",
+            "GEMINI_BASE_URL": self.base_url,
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name=self.thread_name, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.stop()
+
+
+class StreamRecorder(_BackgroundServer):
+    """
+    Proxy d'enregistrement : chaque réponse de génération est écrite dans `directory`
+    ({numéro}_{fournisseur}.jsonl). Les autres appels (fichiers, caches) sont relayés
+    sans être enregistrés. Les en-têtes d'authentification ne sont jamais écrits.
+
+    Exemple :
+        with StreamRecorder("fixtures/") as recorder:
+            os.environ.update(recorder.environment())
+            ...  # session réelle
+    """
+
+    handler = _RecorderHandler
+    thread_name = "stream-recorder"
+
+    def __init__(self, directory: Path, upstreams: Optional[Dict[str, str]] = None,
+                 host: str = "127.0.0.1", port: int = 0):
+        super().__init__(host, port)
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.upstreams = {**UPSTREAMS, **(upstreams or {})}
+        self.client = httpx.Client(timeout=httpx.Timeout(300.0, connect=10.0))
+        self.saved: List[Path] = []
+        self._counter = len(list(self.directory.glob("*.jsonl")))
+
+    def _save(self, fixture: StreamFixture) -> None:
+        with self._lock:
+            self._counter += 1
+            path = self.directory / f"{self._counter:04d}_{fixture.provider}.jsonl"
+            self.saved.append(path)
+        fixture.save(path)
+
+    def stop(self) -> None:
+        super().stop()
+        self.client.close()
+
+
+# --- Rejeu ---
+
+class _ReplayHandler(BaseHTTPRequestHandler):
+    """Rejoue la prochaine fixture du fournisseur demandé"""
+
+    server: "_LocalHTTPServer"
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):  # noqa: A002 - signature de BaseHTTPRequestHandler
+        pass
+
+    def do_POST(self):
+        replayer: StreamReplayer = self.server.owner
+        _, body = _read_body(self)
+        path = self.path.split("?", 1)[0]
+        route = route_request(path, body)
+        fixture = replayer.next_fixture(*route) if route else None
+        if fixture is None:
+            data = json.dumps({"error": {"message": f"Aucune fixture pour {path}"}}).encode("utf-8")
+            self.send_response(404)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+
+        record = RequestRecord(fixture.provider, path, fixture.status, fixture.stream, time.perf_counter())
+        try:
+            self.send_response(fixture.status)
+            for name, value in fixture.headers.items():
+                self.send_header(name, value)
+            if fixture.stream:
+                self.send_header("Cache-Control", "no-cache")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                self.close_connection = True
+                for t, chunk in fixture.chunks:
+                    replayer._wait_until(record.started, t)
+                    self.wfile.write(chunk.encode("utf-8"))
+                    self.wfile.flush()
+            else:
+                data = fixture.body()
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                replayer._wait_until(record.started, fixture.duration)
+                self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            record.status = 499  # client parti avant la fin
+        finally:
+            record.finished = time.perf_counter()
+            replayer._record(record)
+
+
+class StreamReplayer(_BackgroundServer):
+    """
+    Serveur de rejeu des fixtures enregistrées.
+
+    Les fixtures de chaque fournisseur sont servies dans l'ordre d'enregistrement, puis
+    en boucle. `speed` règle le rythme : 1.0 = temps enregistrés, 2.0 = deux fois plus
+    vite, 0 = aussi vite que possible (mesure du seul coût des clients).
+    """
+
+    handler = _ReplayHandler
+    thread_name = "stream-replayer"
+
+    def __init__(self, fixtures: List[StreamFixture], speed: float = 1.0,
+                 host: str = "127.0.0.1", port: int = 0):
+        super().__init__(host, port)
+        self.speed = speed
+        self._queues: Dict[Tuple[str, bool], Deque[StreamFixture]] = defaultdict(deque)
+        for fixture in fixtures:
+            self._queues[(fixture.provider, fixture.stream)].append(fixture)
+        self._records: List[RequestRecord] = []
+
+    @classmethod
+    def from_directory(cls, directory: Path, **kwargs) -> "StreamReplayer":
+        return cls(load_fixtures(directory), **kwargs)
+
+    def next_fixture(self, provider: str, stream: bool) -> Optional[StreamFixture]:
+        with self._lock:
+            queue = self._queues.get((provider, stream))
+            if not queue:
+                return None
+            fixture = queue[0]
+            queue.rotate(-1)
+            return fixture
+
+    def _wait_until(self, started: float, recorded_time: float) -> None:
+        if self.speed <= 0:
+            return
+        delay = started + recorded_time / self.speed - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _record(self, record: RequestRecord) -> None:
+        with self._lock:
+            self._records.append(record)
+
+    def drain_records(self) -> List[RequestRecord]:
+        """Retourne et oublie les requêtes servies depuis le dernier appel"""
+        with self._lock:
+            records, self._records = self._records, []
+        return records
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Capture et rejeu des flux des fournisseurs")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    record = subparsers.add_parser("record", help="proxy d'enregistrement vers les vraies API")
+    record.add_argument("directory", type=Path)
+    record.add_argument("--port", type=int, default=8787)
+
+    serve = subparsers.add_parser("serve", help="rejoue les fixtures d'un dossier")
+    serve.add_argument("directory", type=Path)
+    serve.add_argument("--port", type=int, default=8787)
+    serve.add_argument("--speed", type=float, default=1.0, help="1 = rythme enregistré, 0 = sans attente")
+    args = parser.parse_args()
+
+    if args.command == "record":
+        server = StreamRecorder(args.directory, port=args.port)
+    else:
+        server = StreamReplayer.from_directory(args.directory, speed=args.speed, port=args.port)
+        if not any(server._queues.values()):
+            parser.error(f"aucune fixture dans {args.directory}")
+
+    with server:
+        print(f"{'Enregistrement' if args.command == 'record' else 'Rejeu'} sur {server.base_url}", file=sys.stderr)
+        for name, value in server.environment().items():
+            print(f"export {name}={value}")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+    if args.command == "record":
+        print(f"{len(server.saved)} fixture(s) écrite(s) dans {args.directory}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+"""
+Benchmark de latence de bout en bout contre l'émulateur local des fournisseurs.
+
+Les clients du projet sont pointés vers l'émulateur (variables *_BASE_URL) :
+- PerplexityClient (gemini_chat)
+- GeminiClient (gemini_chat, send_message_stream)
+- call_grok (streamlit_app/grok31)
+- la boucle de web_search_stream_agent (run_conversation)
+- process_model_query de l'arène (page 6), pour chaque modèle
+
+Pour chaque cible : p50/p95 de la latence de bout en bout et du surcoût propre au
+client (latence de bout en bout moins le temps passé dans l'émulateur).
+
+Avec --replay, les réponses réelles enregistrées par replay.py remplacent l'émulateur,
+au rythme enregistré ou sans attente (--speed 0).
+
+Usage :
+    python benchmarks/run_benchmark.py --iterations 20 --ttft 0.3 --tps 80
+    python benchmarks/run_benchmark.py --targets perplexity_client agent_loop --error-rate 0.1
+    python benchmarks/run_benchmark.py --replay fixtures/ --speed 0
+"""
+
+import io
+import os
+import ast
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import contextlib
+from dataclasses import dataclass, field, asdict
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+from emulator import ProviderEmulator, EmulatorProfile, RequestRecord, PROVIDERS
+from replay import StreamReplayer
+
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+QUERY = "Quelles sont les conditions de la responsabilité délictuelle en droit français ?"
+
+ARENA_MODELS = ["Claude 3.5 Haiku", "Google Gemini", "Google Gemini 2.0 Flash + Perplexity", "Perplexity AI"]
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Percentile au rang le plus proche"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(int(round(pct / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def server_busy_time(records: List[RequestRecord]) -> float:
+    """Temps pendant lequel au moins une requête était servie (requêtes parallèles fusionnées)"""
+    total = 0.0
+    current_start = current_end = None
+    for record in sorted(records, key=lambda r: r.started):
+        if current_end is None or record.started > current_end:
+            if current_end is not None:
+                total += current_end - current_start
+            current_start, current_end = record.started, record.finished
+        else:
+            current_end = max(current_end, record.finished)
+    if current_end is not None:
+        total += current_end - current_start
+    return total
+
+
+@dataclass
+class TargetResult:
+    """Mesures d'une cible"""
+    name: str
+    latencies: List[float] = field(default_factory=list)
+    overheads: List[float] = field(default_factory=list)
+    requests: int = 0
+    failed_requests: int = 0
+    exceptions: int = 0
+    skipped: Optional[str] = None
+
+    def summary(self) -> dict:
+        return {
+            "target": self.name,
+            "iterations": len(self.latencies),
+            "requests": self.requests,
+            "failed_requests": self.failed_requests,
+            "exceptions": self.exceptions,
+            "latency_p50_ms": round(percentile(self.latencies, 50) * 1000, 1),
+            "latency_p95_ms": round(percentile(self.latencies, 95) * 1000, 1),
+            "overhead_p50_ms": round(percentile(self.overheads, 50) * 1000, 1),
+            "overhead_p95_ms": round(percentile(self.overheads, 95) * 1000, 1),
+            "skipped": self.skipped
+        }
+
+
+# --- Cibles : chaque fabrique retourne (appel d'une itération, nettoyage) ---
+
+def _gemini_chat_path() -> None:
+    path = str(REPO_ROOT / "gemini_chat")
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+def make_perplexity_client() -> Tuple[Callable[[], None], Callable[[], None]]:
+    _gemini_chat_path()
+    from src.utils.config import Config
+    from src.clients.perplexity_client import PerplexityClient
+
+    client = PerplexityClient(Config())
+
+    def run():
+        client.search(QUERY, use_cache=False)
+
+    return run, client.close
+
+
+def make_gemini_client() -> Tuple[Callable[[], None], Callable[[], None]]:
+    _gemini_chat_path()
+    from src.utils.config import Config
+    from src.clients.gemini_client import GeminiClient
+
+    client = GeminiClient(Config())
+
+    def run():
+        client.initialize_chat()
+        for _ in client.send_message_stream(QUERY):
+            pass
+
+    return run, lambda: None
+
+
+def make_call_grok() -> Tuple[Callable[[], None], Callable[[], None]]:
+    sys.path.insert(0, str(REPO_ROOT / "streamlit_app" / "grok31"))
+    from grok3_utils import call_grok
+
+    def run():
+        for item in call_grok("grok-3", QUERY):
+            if isinstance(item, dict) and item.get("type") == "error":
+                raise RuntimeError(item["message"])
+
+    return run, lambda: None
+
+
+def make_agent_loop() -> Tuple[Callable[[], None], Callable[[], None]]:
+    sys.path.insert(0, str(REPO_ROOT))
+    import web_search_stream_agent
+
+    def run():
+        if web_search_stream_agent.run_conversation([{"role": "user", "content": QUERY}]) is None:
+            raise RuntimeError("la boucle de l'agent n'a pas abouti")
+
+    return run, lambda: None
+
+
+def load_arena_functions() -> dict:
+    """
+    Charge les fonctions de la page arène sans exécuter son interface : seuls les imports,
+    les définitions de fonctions et les constantes (noms en majuscules) sont évalués.
+    """
+    _gemini_chat_path()
+    page_path = REPO_ROOT / "streamlit_app" / "pages" / "6_comparaison.py"
+    tree = ast.parse(page_path.read_text(encoding="utf-8"), filename=str(page_path))
+    tree.body = [
+        node for node in tree.body
+        if isinstance(node, (ast.Import, ast.ImportFrom, ast.FunctionDef, ast.AsyncFunctionDef))
+        or (isinstance(node, ast.Assign) and all(isinstance(t, ast.Name) and t.id.isupper() for t in node.targets))
+    ]
+    namespace = {"__name__": "arena", "__file__": str(page_path)}
+    exec(compile(tree, str(page_path), "exec"), namespace)
+    # Les noms réels sont passés directement (pas d'anonymisation hors session Streamlit)
+    namespace["get_real_name"] = lambda name: name
+    return namespace
+
+
+def make_arena(model_name: str) -> Callable[[], Tuple[Callable[[], None], Callable[[], None]]]:
+    def factory():
+        arena = load_arena_functions()
+
+        def run():
+            _, _, error = asyncio.run(arena["process_model_query"](
+                model_name, QUERY, [], os.environ["ANTHROPIC_API_KEY"], os.environ["PERPLEXITY_API_KEY"],
+                os.environ["GEMINI_API_KEY"], 2000, 0.3
+            ))
+            if error:
+                raise RuntimeError(error)
+
+        return run, lambda: None
+
+    return factory
+
+
+TARGETS: Dict[str, Callable[[], Tuple[Callable[[], None], Callable[[], None]]]] = {
+    "perplexity_client": make_perplexity_client,
+    "gemini_client": make_gemini_client,
+    "call_grok": make_call_grok,
+    "agent_loop": make_agent_loop,
+    **{f"arena:{name}": make_arena(name) for name in ARENA_MODELS},
+}
+
+
+def configure_environment(base_url: str) -> None:
+    """Pointe tous les clients vers l'émulateur et désactive les caches"""
+    os.environ.update({
+        "ANTHROPIC_BASE_URL": base_url,
+        "PERPLEXITY_BASE_URL": base_url,
+        "XAI_BASE_URL": f"{base_url}/v1",
+        "GEMINI_BASE_URL": base_url,
+        "ANTHROPIC_API_KEY": "emulator",
+        "PERPLEXITY_API_KEY": "emulator",
+        "GROK_API_KEY": "emulator",
+        "GEMINI_API_KEY": "emulator",
+        "PERPLEXITY_CACHE": "0",
+        "GEMINI_CONTEXT_CACHE": "0",
+    })
+
+
+def run_target(name: str, emulator: Union[ProviderEmulator, StreamReplayer], iterations: int,
+               warmup: int) -> TargetResult:
+    """Mesure une cible ; une cible dont les dépendances manquent est ignorée"""
+    result = TargetResult(name)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            run, cleanup = TARGETS[name]()
+    except ImportError as e:
+        result.skipped = f"dépendance manquante ({e.name or e})"
+        return result
+
+    try:
+        for i in range(warmup + iterations):
+            emulator.drain_records()
+            start = time.perf_counter()
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    run()
+            except Exception:
+                if i >= warmup:
+                    result.exceptions += 1
+            elapsed = time.perf_counter() - start
+            records = emulator.drain_records()
+            if i < warmup:
+                continue
+            result.latencies.append(elapsed)
+            result.overheads.append(max(elapsed - server_busy_time(records), 0.0))
+            result.requests += len(records)
+            result.failed_requests += sum(1 for record in records if record.status != 200)
+    finally:
+        with contextlib.redirect_stdout(io.StringIO()):
+            cleanup()
+    return result
+
+
+def format_table(results: List[TargetResult]) -> str:
+    header = f"{'cible':<42} {'n':>4} {'req':>5} {'échecs':>6} {'p50 ms':>9} {'p95 ms':>9} {'surcoût p50':>12} {'surcoût p95':>12}"
+    lines = [header, "-" * len(header)]
+    for result in results:
+        if result.skipped:
+            lines.append(f"{result.name:<42} ignorée : {result.skipped}")
+            continue
+        s = result.summary()
+        lines.append(
+            f"{result.name:<42} {s['iterations']:>4} {s['requests']:>5} "
+            f"{s['failed_requests'] + s['exceptions']:>6} {s['latency_p50_ms']:>9.1f} {s['latency_p95_ms']:>9.1f} "
+            f"{s['overhead_p50_ms']:>12.1f} {s['overhead_p95_ms']:>12.1f}"
+        )
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark de latence contre l'émulateur local des fournisseurs")
+    parser.add_argument("--targets", nargs="*", default=list(TARGETS), help=f"cibles parmi : {', '.join(TARGETS)}")
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--ttft", type=float, default=0.3, help="délai avant le premier token (s)")
+    parser.add_argument("--tps", type=float, default=80.0, help="tokens par seconde")
+    parser.add_argument("--tokens", type=int, default=120, help="tokens par réponse")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="proportion de réponses 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="proportion de réponses 429")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--replay", type=Path, help="rejoue les fixtures de ce dossier au lieu de l'émulateur")
+    parser.add_argument("--speed", type=float, default=1.0, help="rythme du rejeu (1 = enregistré, 0 = sans attente)")
+    parser.add_argument("--json", type=Path, help="écrit les résultats dans ce fichier JSON")
+    args = parser.parse_args()
+
+    unknown = [name for name in args.targets if name not in TARGETS]
+    if unknown:
+        parser.error(f"cibles inconnues : {', '.join(unknown)}")
+
+    profile = EmulatorProfile(
+        ttft=args.ttft,
+        tokens_per_second=args.tps,
+        response_tokens=args.tokens,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate
+    )
+
+    if args.json:
+        args.json = args.json.resolve()
+    if args.replay:
+        server = StreamReplayer.from_directory(args.replay, speed=args.speed)
+        source = f"Rejeu de {args.replay} (vitesse {args.speed:g})"
+    else:
+        server = ProviderEmulator({name: profile for name in PROVIDERS}, seed=args.seed)
+        source = (f"Émulateur : ttft={args.ttft}s, {args.tps} tokens/s, {args.tokens} tokens, "
+                  f"erreurs={args.error_rate:.0%}, 429={args.rate_limit_rate:.0%}")
+
+    # Les clients créent leurs dossiers de données dans le répertoire courant
+    os.chdir(tempfile.mkdtemp(prefix="benchmark_"))
+
+    with server as emulator:
+        configure_environment(emulator.base_url)
+        results = []
+        for name in args.targets:
+            print(f"▶ {name}...", file=sys.stderr)
+            results.append(run_target(name, emulator, args.iterations, args.warmup))
+
+    print(f"\n{source}\n")
+    print(format_table(results))
+
+    if args.json:
+        payload = {"profile": None if args.replay else asdict(profile), "replay": str(args.replay or ""),
+                   "speed": args.speed, "results": [result.summary() for result in results]}
+        args.json.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
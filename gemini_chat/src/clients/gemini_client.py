@@ -1,14 +1,26 @@
 """Client pour l'API Gemini"""
 
+import io
 import asyncio
 import sys
-from typing import List, Optional, Generator, Any, Set
+import json
+import time
+import hashlib
+from datetime import datetime, timezone
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Optional, Generator, Any, Set, Dict, Callable, Union
 from pathlib import Path
 from google.genai import types
 from google import genai
 
 from ..utils.config import Config
+from ..utils.file_manifest import RemoteFileManifest, hash_file
+from ..utils.context_packer import ContextPacker, PackedContext, estimate_pdf_tokens
+from ..utils.metrics import get_registry
+from ..utils.usage import Usage, BudgetGovernor, gemini_usage, get_pricing
 from ..models.message import ChatMessage, MessageRole
+from ..models.stream_event import StreamEvent, StreamEventType, GeminiUsage
 
 
 class DuplicateFileError(Exception):
@@ -19,110 +31,433 @@ class DuplicateFileError(Exception):
         super().__init__(f"Le fichier '{file_path.name}' est déjà uploadé sous le nom '{existing_name}'")
 
 
+@dataclass
+class BatchUploadResult:
+    """Résultat d'un upload par lot : les fichiers réussis sont enregistrés même si d'autres échouent"""
+    uploaded: List[dict] = field(default_factory=list)
+    duplicates: List[str] = field(default_factory=list)
+    errors: Dict[str, str] = field(default_factory=dict)
+
+
 class GeminiClient:
     """Client pour interagir avec l'API Gemini"""
     
+    model = "gemini-2.0-flash"
+    
+    system_instruction = (
+        "Tu es un expert juridique français. Tu peux analyser des documents PDF "
+        "et répondre aux questions les concernant.\n\n"
+        "Tu as la capacité de faire des tableaux por présenter des informations de manière claire.\n\n"
+
+        "RÈGLES DE RECHERCHE AVEC PERPLEXITY :\n"
+        "1. Si la question est une simple salutation, politesse ou remerciement : réponds directement SANS outil\n\n"
+
+        "2. Si la question ne concerne AUCUN document uploadé ET nécessite des informations d'internet :\n"
+        "   → Utilise 'perplexity_direct_search' (l'utilisateur recevra directement la réponse complète)\n\n"
+
+        "3. Si la question concerne le contenu d'articles de lois , jurisprudence ou réglementation :\n"
+        "   → Utilise 'perplexity_direct_search' (tu recevras une réponse directe à l'utilisateur)\n\n"
+
+        "4. Si la question concerne un document uploadé ET tu as besoin d'informations complémentaires :\n"
+        "   → Utilise 'perplexity_help_search' (tu recevras des informations à intégrer dans ta synthèse)\n\n"
+
+        "IMPORTANT :\n"
+        "- perplexity_direct_search : réponse finale directe à l'utilisateur avec sources\n"
+        "- perplexity_help_search : informations complémentaires pour enrichir TA réponse\n"
+        "- Ne mentionne jamais ces outils dans tes réponses, utilise-les de manière transparente\n\n"
+
+        "EXEMPLES D'USAGE :\n"
+        "- 'Salut' → réponse directe\n"
+        "- 'Quelle est la jurisprudence récente sur les contrats de travail ?' (sans document) → perplexity_direct_search\n"
+        "- 'Que dit l'article 1234-5 du Code du travail ?' → perplexity_direct_search\n"
+        "- 'Ce contrat est-il conforme à la réglementation actuelle ?' (avec document) → perplexity_help_search\n"
+        "- 'Explique-moi ce document' (avec document) → réponse directe"
+    )
+    
     def __init__(self, config: Config):
         self.config = config
-        self.client = genai.Client(api_key=config.gemini_api_key)
+        self.client = genai.Client(
+            api_key=config.gemini_api_key,
+            http_options=types.HttpOptions(base_url=config.gemini_base_url) if config.gemini_base_url else None
+        )
         self.chat = None
+        self.chat_tools: Optional[List] = None
         self.uploaded_files: List[dict] = []
-        self.files_sent_to_chat: Set[str] = set()  # Track des fichiers déjà envoyés au chat actuel
-    
-    def initialize_chat(self, tools: Optional[List] = None) -> None:
-        """Initialise une nouvelle session de chat"""
-        chat_config = types.GenerateContentConfig(
-            system_instruction=(
-                "Tu es un expert juridique français. Tu peux analyser des documents PDF "
-                "et répondre aux questions les concernant.\n\n"
-                "Tu as la capacité de faire des tableaux por présenter des informations de manière claire.\n\n"
-                
-                "RÈGLES DE RECHERCHE AVEC PERPLEXITY :\n"
-                "1. Si la question est une simple salutation, politesse ou remerciement : réponds directement SANS outil\n\n"
-                
-                "2. Si la question ne concerne AUCUN document uploadé ET nécessite des informations d'internet :\n"
-                "   → Utilise 'perplexity_direct_search' (l'utilisateur recevra directement la réponse complète)\n\n"
-                
-                "3. Si la question concerne le contenu d'articles de lois , jurisprudence ou réglementation :\n"
-                "   → Utilise 'perplexity_direct_search' (tu recevras une réponse directe à l'utilisateur)\n\n"
-                
-                "4. Si la question concerne un document uploadé ET tu as besoin d'informations complémentaires :\n"
-                "   → Utilise 'perplexity_help_search' (tu recevras des informations à intégrer dans ta synthèse)\n\n"
-                
-                "IMPORTANT :\n"
-                "- perplexity_direct_search : réponse finale directe à l'utilisateur avec sources\n"
-                "- perplexity_help_search : informations complémentaires pour enrichir TA réponse\n"
-                "- Ne mentionne jamais ces outils dans tes réponses, utilise-les de manière transparente\n\n"
-                
-                "EXEMPLES D'USAGE :\n"
-                "- 'Salut' → réponse directe\n"
-                "- 'Quelle est la jurisprudence récente sur les contrats de travail ?' (sans document) → perplexity_direct_search\n"
-                "- 'Que dit l'article 1234-5 du Code du travail ?' → perplexity_direct_search\n"
-                "- 'Ce contrat est-il conforme à la réglementation actuelle ?' (avec document) → perplexity_help_search\n"
-                "- 'Explique-moi ce document' (avec document) → réponse directe"
-            ),
-            max_output_tokens=self.config.max_tokens,
-            temperature=self.config.temperature,
-            tools=tools
+        self.files_by_hash: Dict[str, dict] = {}  # Index des fichiers uploadés par empreinte SHA-256
+        self.file_manifest = RemoteFileManifest(
+            config.gemini_files_manifest_path,
+            expiry_margin=config.gemini_file_expiry_margin
         )
+        self.files_sent_to_chat: Set[str] = set()  # Track des fichiers déjà envoyés au chat actuel
+        self.pending_context: List[str] = []  # Contexte en attente, joint au prochain tour
+        self.function_handlers: Dict[str, Callable[[str], str]] = {}  # Fonctions exécutées dans le tour
+        self.max_tool_rounds = 3
         
-        self.chat = self.client.chats.create(
-            model="gemini-2.0-flash",
-            config=chat_config
+        # Caches de contexte Gemini des documents uploadés, par jeu de fichiers (réutilisés entre chats)
+        self.context_caches: Dict[str, dict] = {}
+        self.active_context_cache: Optional[dict] = None
+        self._uncacheable_keys: Set[str] = set()
+        self._pending_cache_storage_price = 0.0
+        self.context_cache_storage_cost = 0.0
+        
+        # Historique du chat limité au budget de tokens d'entrée du modèle (tours avec fichiers gardés)
+        self.context_packer = ContextPacker.for_model(
+            self.model,
+            is_pinned=lambda content: any(getattr(part, 'file_data', None) for part in content.parts or [])
         )
+        self.last_packed_context: Optional[PackedContext] = None
+        
+        # Plafonds de tokens et de dépense de la session (partagé avec le client Perplexity)
+        self.governor: Optional[BudgetGovernor] = None
+    
+    def initialize_chat(
+        self,
+        tools: Optional[List] = None,
+        function_handlers: Optional[Dict[str, Callable[[str], str]]] = None
+    ) -> None:
+        """
+        Initialise une nouvelle session de chat
+        
+        Args:
+            tools: Outils déclarés à Gemini
+            function_handlers: Fonctions exécutées directement par le client, leur résultat
+                étant renvoyé à Gemini comme FunctionResponse dans le même tour
+        """
+        self.function_handlers = dict(function_handlers or {})
+        self.chat_tools = tools
+        self.active_context_cache = None
         
         # Réinitialiser le tracking des fichiers envoyés pour le nouveau chat
         self.files_sent_to_chat.clear()
+        self.pending_context.clear()
+        
+        self._create_chat()
+        
+        # Réutiliser le cache de contexte existant pour les fichiers déjà uploadés
+        self._sync_context_cache()
+    
+    def _create_chat(self, history: Optional[List[Any]] = None) -> None:
+        """Crée la session de chat, adossée au cache de contexte actif s'il y en a un"""
+        if self.active_context_cache:
+            # Le prompt système et les outils font partie du cache
+            chat_config = types.GenerateContentConfig(
+                cached_content=self.active_context_cache['name'],
+                max_output_tokens=self.config.max_tokens,
+                temperature=self.config.temperature
+            )
+        else:
+            chat_config = types.GenerateContentConfig(
+                system_instruction=self.system_instruction,
+                max_output_tokens=self.config.max_tokens,
+                temperature=self.config.temperature,
+                tools=self.chat_tools
+            )
+        
+        self.chat = self.client.chats.create(
+            model=self.model,
+            config=chat_config,
+            history=history
+        )
+    
+    def _context_cache_key(self, file_infos: List[dict]) -> str:
+        """Clé d'un cache de contexte : modèle, prompt système, outils et fichiers distants"""
+        raw = json.dumps([
+            self.model,
+            self.system_instruction,
+            repr(self.chat_tools),
+            sorted(file_info['file'].name for file_info in file_infos)
+        ], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+    
+    def _add_cache_storage_cost(self, tokens: int, seconds: float) -> None:
+        """Comptabilise le stockage d'un cache (facturé au token et à l'heure)"""
+        price = tokens / 1_000_000 * max(seconds, 0.0) / 3600 * get_pricing(self.model).cache_storage_per_hour
+        self._pending_cache_storage_price += price
+        self.context_cache_storage_cost += price
+    
+    def _create_context_cache(self, key: str, file_infos: List[dict]) -> Optional[dict]:
+        """Crée un cache de contexte contenant les fichiers ; None si Gemini le refuse"""
+        ttl = int(self.config.gemini_context_cache_ttl)
+        try:
+            cache = self.client.caches.create(
+                model=self.model,
+                config=types.CreateCachedContentConfig(
+                    display_name=f"documents-{key[:12]}",
+                    system_instruction=self.system_instruction,
+                    tools=self.chat_tools,
+                    contents=[file_info['file'] for file_info in file_infos],
+                    ttl=f"{ttl}s"
+                )
+            )
+        except Exception as e:
+            # Ex: documents sous le minimum de tokens d'un cache -> fichiers joints aux messages
+            print(f"AVERTISSEMENT: Cache de contexte non créé ({e}), fichiers joints aux messages", file=sys.stderr)
+            self._uncacheable_keys.add(key)
+            return None
+        
+        usage_metadata = getattr(cache, 'usage_metadata', None)
+        entry = {
+            'name': cache.name,
+            'expire_time': cache.expire_time.timestamp() if cache.expire_time else time.time() + ttl,
+            'tokens': getattr(usage_metadata, 'total_token_count', None) or 0,
+            'file_ids': [file_info['id'] for file_info in file_infos]
+        }
+        self._add_cache_storage_cost(entry['tokens'], entry['expire_time'] - time.time())
+        self.context_caches[key] = entry
+        print(f"🗄️ Cache de contexte créé pour {len(file_infos)} fichier(s) ({entry['tokens']} tokens)")
+        return entry
+    
+    def _refresh_context_cache(self, key: str, entry: dict) -> Optional[dict]:
+        """Prolonge le TTL d'un cache de contexte ; None s'il n'existe plus côté Gemini"""
+        ttl = int(self.config.gemini_context_cache_ttl)
+        try:
+            cache = self.client.caches.update(
+                name=entry['name'],
+                config=types.UpdateCachedContentConfig(ttl=f"{ttl}s")
+            )
+        except Exception as e:
+            print(f"AVERTISSEMENT: Cache de contexte non prolongé ({e})", file=sys.stderr)
+            self.context_caches.pop(key, None)
+            return None
+        
+        new_expire_time = cache.expire_time.timestamp() if cache.expire_time else time.time() + ttl
+        self._add_cache_storage_cost(entry['tokens'], new_expire_time - entry['expire_time'])
+        entry['expire_time'] = new_expire_time
+        return entry
+    
+    def _get_context_cache(self, file_infos: List[dict]) -> Optional[dict]:
+        """Retourne un cache de contexte valide pour ces fichiers (réutilisé, prolongé ou créé)"""
+        key = self._context_cache_key(file_infos)
+        if key in self._uncacheable_keys:
+            return None
+        
+        now = time.time()
+        entry = self.context_caches.get(key)
+        if entry is not None and entry['expire_time'] - now < self.config.gemini_context_cache_refresh_margin:
+            if entry['expire_time'] > now:
+                entry = self._refresh_context_cache(key, entry)
+            else:
+                self.context_caches.pop(key, None)
+                entry = None
+        
+        if entry is None:
+            entry = self._create_context_cache(key, file_infos)
+        return entry
+    
+    def _history_without_files(self) -> List[Any]:
+        """Historique du chat sans les fichiers joints (désormais portés par le cache de contexte)"""
+        history = []
+        for content in self.chat.get_history():
+            parts = [part for part in (content.parts or []) if not getattr(part, 'file_data', None)]
+            if parts:
+                history.append(types.Content(role=content.role, parts=parts))
+        return history
+    
+    def _sync_context_cache(self) -> None:
+        """
+        Aligne le chat sur le cache de contexte des fichiers uploadés.
+        Si le cache change (nouveaux fichiers, expiration), le chat est recréé avec son historique.
+        """
+        if not self.config.gemini_context_cache_enabled or self.chat is None:
+            return
+        
+        entry = self._get_context_cache(self.uploaded_files) if self.uploaded_files else None
+        current_name = self.active_context_cache['name'] if self.active_context_cache else None
+        if (entry['name'] if entry else None) == current_name:
+            return
+        
+        history = self._history_without_files()
+        self.active_context_cache = entry
+        self._create_chat(history)
+        self.files_sent_to_chat = set(entry['file_ids']) if entry else set()
+    
+    def _pack_history(self, message: str) -> None:
+        """
+        Ramène l'historique du chat dans le budget de tokens d'entrée du modèle.
+        Les documents (cache de contexte ou fichiers joints) et le prompt système sont comptés ;
+        si des tours anciens sont écartés, le chat est recréé avec l'historique retenu.
+        """
+        history = self.chat.get_history()
+        if not history:
+            self.last_packed_context = None
+            return
+        
+        if self.active_context_cache:
+            # Le prompt système fait partie du cache
+            system_prompt = ""
+            documents_tokens = self.active_context_cache['tokens']
+        else:
+            system_prompt = self.system_instruction
+            # Fichiers déjà joints à l'historique ou joints à ce tour
+            documents_tokens = sum(f.get('tokens', 0) for f in self.uploaded_files)
+        
+        packed = self.context_packer.pack(
+            history,
+            query="\n".join(self.pending_context + [message]),
+            system_prompt=system_prompt,
+            documents_tokens=documents_tokens
+        )
+        self.last_packed_context = packed
+        if packed.dropped_turns:
+            self._create_chat(packed.messages)
+            print(f"🧮 {packed.dropped_turns} tour(s) ancien(s) écarté(s) du contexte (~{packed.tokens}/{packed.budget} tokens)")
     
-    def _is_file_already_uploaded(self, file_path: Path) -> Optional[str]:
+    def get_context_cache_info(self) -> Optional[dict]:
+        """Informations sur le cache de contexte actif (nom, tokens, secondes restantes)"""
+        if not self.active_context_cache:
+            return None
+        return {
+            'name': self.active_context_cache['name'],
+            'tokens': self.active_context_cache['tokens'],
+            'files': len(self.active_context_cache['file_ids']),
+            'expires_in': max(self.active_context_cache['expire_time'] - time.time(), 0.0)
+        }
+    
+    def _is_file_already_uploaded(self, sha256: str) -> Optional[str]:
         """
-        Vérifie si un fichier est déjà uploadé en comparant les chemins absolus.
+        Vérifie si un contenu est déjà uploadé (même empreinte, quel que soit le chemin).
         
         Returns:
             Le nom du fichier existant si trouvé, None sinon
         """
-        absolute_path = file_path.resolve()
+        file_info = self.files_by_hash.get(sha256)
+        return file_info['name'] if file_info else None
+    
+    def _get_remote_file(self, sha256: str) -> Optional[types.File]:
+        """Fichier distant encore valide portant ce contenu, d'après le manifeste (sans appel réseau)"""
+        entry = self.file_manifest.get(sha256)
+        if entry is None:
+            return None
+        return types.File(
+            name=entry['remote_name'],
+            uri=entry['uri'],
+            mime_type=entry['mime_type'],
+            expiration_time=datetime.fromtimestamp(entry['expire_time'], tz=timezone.utc)
+        )
+    
+    def _upload_remote_file(self, source: Union[Path, bytes], sha256: str, name: str) -> types.File:
+        """Envoie un fichier (chemin ou contenu en mémoire) à l'API Files et l'enregistre dans le manifeste"""
+        if isinstance(source, Path):
+            uploaded_file = self.client.files.upload(file=source)
+        else:
+            # Contenu en mémoire : pas de fichier temporaire
+            uploaded_file = self.client.files.upload(
+                file=io.BytesIO(source),
+                config=types.UploadFileConfig(mime_type="application/pdf", display_name=name)
+            )
+        
+        # Les fichiers distants expirent après 48h
+        if uploaded_file.expiration_time:
+            expire_time = uploaded_file.expiration_time.timestamp()
+        else:
+            expire_time = time.time() + 48 * 3600
+        
+        self.file_manifest.put(
+            sha256,
+            remote_name=uploaded_file.name,
+            uri=uploaded_file.uri,
+            mime_type=uploaded_file.mime_type or "application/pdf",
+            expire_time=expire_time
+        )
+        return uploaded_file
+    
+    def _is_remote_file_expired(self, file_info: dict) -> bool:
+        """Vérifie si le fichier distant expire (ou a expiré) dans la marge configurée"""
+        expiration_time = getattr(file_info['file'], 'expiration_time', None)
+        if not expiration_time:
+            return False
+        return expiration_time.timestamp() - time.time() <= self.config.gemini_file_expiry_margin
+    
+    def _refresh_expired_files(self) -> None:
+        """
+        Renvoie paresseusement les fichiers dont la copie distante a expiré.
+        Le chat est recréé sans les anciennes références, et les fichiers sont rejoints au prochain tour.
+        """
+        expired = [file_info for file_info in self.uploaded_files if self._is_remote_file_expired(file_info)]
+        if not expired:
+            return
         
-        for file_info in self.uploaded_files:
-            existing_path = Path(file_info['path']).resolve()
-            if absolute_path == existing_path:
-                return file_info['name']
+        for file_info in expired:
+            self.file_manifest.remove(file_info['sha256'])
+            file_path = Path(file_info['path']) if file_info.get('path') else None
+            if file_info.get('buffer') is not None:
+                file_info['file'] = self._upload_remote_file(file_info['buffer'], file_info['sha256'], file_info['name'])
+                print(f"🔄 Fichier '{file_info['name']}' expiré côté Gemini, renvoyé")
+            elif file_path and file_path.exists() and hash_file(file_path) == file_info['sha256']:
+                file_info['file'] = self._upload_remote_file(file_path, file_info['sha256'], file_info['name'])
+                print(f"🔄 Fichier '{file_info['name']}' expiré côté Gemini, renvoyé")
+            else:
+                # Contenu introuvable localement : le fichier est retiré de la conversation
+                print(f"AVERTISSEMENT: '{file_info['name']}' a expiré et n'est plus disponible localement, retiré", file=sys.stderr)
+                self.uploaded_files.remove(file_info)
+                self.files_by_hash.pop(file_info['sha256'], None)
         
-        return None
+        # L'historique ne doit plus référencer les fichiers expirés
+        if self.chat is not None and not self.active_context_cache:
+            self._create_chat(self._history_without_files())
+            self.files_sent_to_chat.clear()
     
     def get_uploaded_file_paths(self) -> List[str]:
         """Retourne la liste des chemins absolus des fichiers uploadés (pour debug)"""
-        return [str(Path(file_info['path']).resolve()) for file_info in self.uploaded_files]
+        return [str(Path(file_info['path']).resolve()) for file_info in self.uploaded_files if file_info.get('path')]
+    
+    def _read_upload_source(self, source: Any) -> dict:
+        """
+        Lit une source d'upload : chemin (Path/str) ou tampon en mémoire
+        (objet avec `name` et `getvalue()`, ex: UploadedFile Streamlit, BytesIO nommé)
+        """
+        if isinstance(source, (str, Path)):
+            file_path = Path(source)
+            if not file_path.exists():
+                raise FileNotFoundError(f"Le fichier {file_path} n'existe pas")
+            name, path, buffer = file_path.name, file_path.resolve(), None
+            size = file_path.stat().st_size
+        else:
+            name, path = getattr(source, 'name', None) or "document.pdf", None
+            buffer = bytes(source.getvalue())
+            size = len(buffer)
+        
+        if Path(name).suffix.lower() != '.pdf':
+            raise ValueError("Seuls les fichiers PDF sont supportés")
+        
+        sha256 = hash_file(path) if path else hashlib.sha256(buffer).hexdigest()
+        tokens = estimate_pdf_tokens(path or buffer, "gemini")
+        return {'name': name, 'path': path, 'buffer': buffer, 'size': size, 'sha256': sha256, 'tokens': tokens}
+    
+    def _register_file(self, source: dict, uploaded_file: types.File, reused: bool) -> dict:
+        """Ajoute un fichier uploadé à la liste et à l'index par empreinte"""
+        file_info = {
+            'file': uploaded_file,
+            'name': source['name'],
+            'path': str(source['path']) if source['path'] else None,  # Chemin absolu (renvoi après expiration)
+            'buffer': source['buffer'],  # Contenu en mémoire (renvoi après expiration, sans fichier local)
+            'size': source['size'],
+            'tokens': source['tokens'],  # Estimation des tokens d'entrée du document
+            'sha256': source['sha256'],
+            'id': source['sha256'],  # Identifiant basé sur le contenu
+            'reused': reused
+        }
+        self.uploaded_files.append(file_info)
+        self.files_by_hash[source['sha256']] = file_info
+        return file_info
     
     def upload_file(self, file_path: Path) -> Optional[dict]:
         """Upload un fichier vers Gemini avec vérification des doublons"""
         try:
-            if not file_path.exists():
-                raise FileNotFoundError(f"Le fichier {file_path} n'existe pas")
-            
-            if file_path.suffix.lower() != '.pdf':
-                raise ValueError("Seuls les fichiers PDF sont supportés")
+            source = self._read_upload_source(file_path)
             
-            # Vérifier les doublons
-            existing_name = self._is_file_already_uploaded(file_path)
+            # Vérifier les doublons (même contenu, quel que soit le nom ou le chemin)
+            existing_name = self._is_file_already_uploaded(source['sha256'])
             if existing_name:
-                raise DuplicateFileError(file_path, existing_name)
+                raise DuplicateFileError(Path(source['name']), existing_name)
             
-            uploaded_file = self.client.files.upload(file=file_path)
+            # Réutiliser la copie distante encore valide du même contenu, sinon l'envoyer
+            uploaded_file = self._get_remote_file(source['sha256'])
+            reused = uploaded_file is not None
+            if uploaded_file is None:
+                uploaded_file = self._upload_remote_file(source['path'], source['sha256'], source['name'])
             
-            # Utiliser le chemin absolu comme identifiant unique
-            absolute_path = file_path.resolve()
-            
-            file_info = {
-                'file': uploaded_file,
-                'name': file_path.name,
-                'path': str(absolute_path),  # Stocker le chemin absolu
-                'size': file_path.stat().st_size,
-                'id': str(absolute_path)  # Identifiant basé sur le chemin absolu
-            }
-            
-            self.uploaded_files.append(file_info)
-            return file_info
+            return self._register_file(source, uploaded_file, reused)
             
         except Exception as e:
             # Re-lever les exceptions personnalisées sans modification
@@ -130,10 +465,89 @@ class GeminiClient:
                 raise
             raise Exception(f"Erreur lors de l'upload: {e}")
     
+    def upload_files(
+        self,
+        sources: List[Any],
+        on_progress: Optional[Callable[[str, str, str], None]] = None,
+        max_workers: Optional[int] = None
+    ) -> BatchUploadResult:
+        """
+        Upload d'un lot de PDF en parallèle (pool borné)
+        
+        Args:
+            sources: Chemins (Path/str) ou tampons en mémoire (objets avec `name` et `getvalue()`)
+            on_progress: Appelé dans le thread appelant pour chaque fichier avec (nom, statut, détail),
+                statut parmi "uploaded", "reused", "duplicate" et "error"
+            max_workers: Nombre d'uploads simultanés (config.gemini_upload_max_workers par défaut)
+        
+        Returns:
+            BatchUploadResult : fichiers enregistrés, doublons ignorés et erreurs par nom de fichier
+        """
+        result = BatchUploadResult()
+        
+        def report(name: str, status: str, detail: str = "") -> None:
+            if on_progress:
+                on_progress(name, status, detail)
+        
+        # Lecture, empreinte et dédoublonnage dans l'ordre du lot
+        to_upload: List[dict] = []
+        batch_hashes: Set[str] = set()
+        for source in sources:
+            name = Path(source).name if isinstance(source, (str, Path)) else getattr(source, 'name', "document.pdf")
+            try:
+                prepared = self._read_upload_source(source)
+            except Exception as e:
+                result.errors[name] = str(e)
+                report(name, "error", str(e))
+                continue
+            
+            existing_name = self._is_file_already_uploaded(prepared['sha256'])
+            if existing_name or prepared['sha256'] in batch_hashes:
+                result.duplicates.append(name)
+                report(name, "duplicate", existing_name or "")
+                continue
+            batch_hashes.add(prepared['sha256'])
+            
+            uploaded_file = self._get_remote_file(prepared['sha256'])
+            if uploaded_file is not None:
+                result.uploaded.append(self._register_file(prepared, uploaded_file, reused=True))
+                report(name, "reused")
+            else:
+                to_upload.append(prepared)
+        
+        if not to_upload:
+            return result
+        
+        # Uploads réseau en parallèle ; les fichiers sont enregistrés au fil des réponses
+        workers = min(max_workers or self.config.gemini_upload_max_workers, len(to_upload))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(
+                    self._upload_remote_file,
+                    prepared['path'] if prepared['path'] else prepared['buffer'],
+                    prepared['sha256'],
+                    prepared['name']
+                ): prepared
+                for prepared in to_upload
+            }
+            for future in as_completed(futures):
+                prepared = futures[future]
+                try:
+                    uploaded_file = future.result()
+                except Exception as e:
+                    result.errors[prepared['name']] = str(e)
+                    report(prepared['name'], "error", str(e))
+                    continue
+                result.uploaded.append(self._register_file(prepared, uploaded_file, reused=False))
+                report(prepared['name'], "uploaded")
+        
+        return result
+    
     def remove_file(self, index: int) -> bool:
         """Supprime un fichier uploadé de la liste des fichiers uploadés"""
         if 0 <= index < len(self.uploaded_files):
             file_info = self.uploaded_files.pop(index)
+            self.files_by_hash.pop(file_info.get('sha256'), None)
             # Retirer aussi du tracking si présent
             self.files_sent_to_chat.discard(file_info.get('id'))
             return True
@@ -142,6 +556,7 @@ class GeminiClient:
     def clear_files(self) -> None:
         """Efface tous les fichiers uploadés"""
         self.uploaded_files.clear()
+        self.files_by_hash.clear()
         self.files_sent_to_chat.clear()
     
     def get_files_info(self) -> List[dict]:
@@ -164,23 +579,30 @@ class GeminiClient:
         """Remet à zéro le tracking des fichiers (pour forcer leur re-envoi)"""
         self.files_sent_to_chat.clear()
     
-    def send_message_stream(self, message: str, force_include_all_files: bool = False) -> Generator[str, None, None]:
+    def queue_context(self, context: str) -> None:
         """
-        Envoie un message et retourne un générateur de réponse avec gestion améliorée des function calls.
-        
-        Args:
-            message: Le message à envoyer
-            force_include_all_files: Si True, inclut tous les fichiers même s'ils ont déjà été envoyés
+        Met en attente un contexte (ex: résultats de recherche) sans appeler le modèle.
+        Il sera joint au prochain message envoyé, dans le même tour.
         """
-        if not self.chat:
-            raise RuntimeError("Chat non initialisé")
+        if context:
+            self.pending_context.append(context)
+    
+    def _build_content_parts(self, message: str, force_include_all_files: bool = False) -> List[Any]:
+        """Construit les parts d'un tour : contexte en attente, message puis fichiers"""
+        content_parts: List[Any] = []
         
-        # Préparer le contenu
-        content_parts = [message]
+        # Joindre le contexte en attente avant le message de l'utilisateur
+        if self.pending_context:
+            content_parts.extend(self.pending_context)
+            self.pending_context.clear()
+        
+        content_parts.append(message)
         
         # Déterminer quels fichiers ajouter
         if force_include_all_files:
-            files_to_send = self.uploaded_files.copy()
+            # Les fichiers du cache de contexte sont déjà dans le contexte du modèle
+            cached_ids = set(self.active_context_cache['file_ids']) if self.active_context_cache else set()
+            files_to_send = [f for f in self.uploaded_files if f.get('id') not in cached_ids]
         else:
             # Inclure automatiquement seulement les nouveaux fichiers
             files_to_send = self.get_new_files()
@@ -194,84 +616,158 @@ class GeminiClient:
             self.mark_files_as_sent(files_to_send)
             print(f"📎 {len(files_to_send)} fichier(s) ajouté(s) au contexte: {[f['name'] for f in files_to_send]}")
         
-        # Envoyer et streamer la réponse
-        response_stream = self.chat.send_message_stream(content_parts)
+        return content_parts
+    
+    def send_message_stream(self, message: str, force_include_all_files: bool = False) -> Generator[StreamEvent, None, None]:
+        """
+        Envoie un message et retourne un générateur d'événements typés (StreamEvent).
         
-        # Variables pour collecter les function calls
-        collected_function_calls: List[Any] = []
-        has_text_content = False
+        Les fonctions de self.function_handlers sont exécutées dans le même tour : le générateur
+        émet un événement TOOL_RESULT puis streame la suite de la réponse de Gemini.
+        Les autres function calls sont laissés à l'interface (TOOL_CALL).
+        Le flux se termine par USAGE (tokens et prix numériques) puis DONE.
         
-        # Variables pour compter les tokens de cette interaction
-        interaction_total_prompt_tokens = 0
-        interaction_total_output_tokens = 0
-        prompt_tokens_counted = False
-
-        # Traiter le streaming
-        for chunk in response_stream:
-            # Compter les tokens à partir des métadonnées d'utilisation
-            if hasattr(chunk, 'usage_metadata') and chunk.usage_metadata:
-                # Tokens d'entrée (prompt)
-                if hasattr(chunk.usage_metadata, 'prompt_token_count'):
-                    prompt_tokens_value_from_chunk = chunk.usage_metadata.prompt_token_count
-                    if not prompt_tokens_counted:
-                        interaction_total_prompt_tokens = prompt_tokens_value_from_chunk if prompt_tokens_value_from_chunk is not None else 0
-                        prompt_tokens_counted = True
-                
-                # Tokens de sortie (candidates/générés)
-                if hasattr(chunk.usage_metadata, 'candidates_token_count'):
-                    output_tokens_value_from_chunk = chunk.usage_metadata.candidates_token_count
-                    if output_tokens_value_from_chunk is not None:
-                        interaction_total_output_tokens += output_tokens_value_from_chunk
-            
-            # Collecter les "function calls"
-            try:
-                if hasattr(chunk, 'candidates') and chunk.candidates:
-                    candidate = chunk.candidates[0]
-                    if hasattr(candidate, 'content') and candidate.content and hasattr(candidate.content, 'parts'):
-                        for part in candidate.content.parts:
-                            if hasattr(part, 'function_call') and part.function_call:
-                                collected_function_calls.append(part.function_call)
-            except Exception as e:
-                print(f"AVERTISSEMENT: Erreur lors du parsing d'un function call: {e}", file=sys.stderr)
-                pass
-            
-            # Vérifier s'il y a du contenu texte
-            if hasattr(chunk, 'text') and chunk.text:
-                has_text_content = True
-            
-            # Afficher le texte en streaming seulement s'il n'y a pas de function calls
-            if not collected_function_calls and has_text_content and hasattr(chunk, 'text') and chunk.text:
-                yield chunk.text
+        Args:
+            message: Le message à envoyer
+            force_include_all_files: Si True, inclut tous les fichiers même s'ils ont déjà été envoyés
+        """
+        if not self.chat:
+            raise RuntimeError("Chat non initialisé")
+        
+        # Renvoyer les fichiers expirés, rattacher le chat au cache de contexte (création ou prolongation)
+        # puis ramener l'historique dans le budget de tokens du modèle
+        self._refresh_expired_files()
+        self._sync_context_cache()
+        self._pack_history(message)
         
-        # Traitement des function calls collectés
-        if collected_function_calls:
+        # Préparer le contenu
+        content_parts = self._build_content_parts(message, force_include_all_files)
+        
+        # Envoyer et streamer la réponse
+        timer = get_registry().stream("gemini", self.model)
+        failed = False
+        try:
+            # Budget du tour (réponse et recherches Perplexity qu'elle déclenche)
+            turn = self.governor.start_turn() if self.governor else None
+            if turn:
+                turn.begin_stream(self.model, self.last_packed_context.tokens if self.last_packed_context else 0)
+
+            response_stream = self.chat.send_message_stream(content_parts)
+
+            # Usage de cette interaction (tous tours d'outils compris)
+            interaction_usage = Usage("gemini", self.model)
+            tool_rounds = 0
+            stopped = False
+
+            while True:
+                # Variables pour collecter les function calls de ce tour
+                collected_function_calls: List[Any] = []
+                has_text_content = False
+                # Compteurs cumulés depuis le début de la requête : seul le dernier chunk fait foi
+                last_usage_metadata = None
+
+                # Traiter le streaming
+                for chunk in response_stream:
+                    if getattr(chunk, 'usage_metadata', None):
+                        last_usage_metadata = chunk.usage_metadata
+
+                    # Collecter les "function calls"
+                    try:
+                        if hasattr(chunk, 'candidates') and chunk.candidates:
+                            candidate = chunk.candidates[0]
+                            if hasattr(candidate, 'content') and candidate.content and hasattr(candidate.content, 'parts'):
+                                for part in candidate.content.parts:
+                                    if hasattr(part, 'function_call') and part.function_call:
+                                        collected_function_calls.append(part.function_call)
+                    except Exception as e:
+                        print(f"AVERTISSEMENT: Erreur lors du parsing d'un function call: {e}", file=sys.stderr)
+                        pass
+
+                    # Vérifier s'il y a du contenu texte
+                    if hasattr(chunk, 'text') and chunk.text:
+                        has_text_content = True
+
+                    # Afficher le texte en streaming seulement s'il n'y a pas de function calls
+                    if not collected_function_calls and has_text_content and hasattr(chunk, 'text') and chunk.text:
+                        timer.on_delta(len(chunk.text.encode("utf-8")))
+                        yield StreamEvent(StreamEventType.TEXT_DELTA, text=chunk.text)
+                        if turn and not turn.on_text(chunk.text):
+                            stopped = True
+                            break
+
+                round_usage = gemini_usage(last_usage_metadata, self.model)
+                if last_usage_metadata is None and turn:
+                    round_usage = turn.estimated_usage("gemini", self.model)
+                interaction_usage.add(round_usage)
+                if turn:
+                    turn.record(round_usage)
+
+                if stopped:
+                    # Plafond atteint : la génération est interrompue, aucun outil n'est exécuté
+                    collected_function_calls = []
+                    yield StreamEvent(StreamEventType.TEXT_DELTA, text=f"\n\n⚠️ Réponse interrompue : {turn.stop_reason}.")
+                    break
+
+                # Exécuter nous-mêmes les fonctions enregistrées et renvoyer leurs résultats dans le même tour
+                executable_calls = [
+                    function_call for function_call in collected_function_calls
+                    if getattr(function_call, 'name', '') in self.function_handlers
+                ]
+                if (
+                    executable_calls
+                    and len(executable_calls) == len(collected_function_calls)
+                    and tool_rounds < self.max_tool_rounds
+                ):
+                    tool_rounds += 1
+                    response_parts = []
+                    for function_call in executable_calls:
+                        function_name = getattr(function_call, 'name', '')
+                        args = getattr(function_call, 'args', {})
+                        query = args.get("query", "") if hasattr(args, 'get') else ""
+
+                        with timer.tool_call(function_name):
+                            result = self.function_handlers[function_name](query)
+                        yield StreamEvent(StreamEventType.TOOL_RESULT, tool_name=function_name, query=query)
+
+                        response_parts.append(types.Part.from_function_response(
+                            name=function_name,
+                            response={"result": result}
+                        ))
+
+                    # La synthèse est streamée directement à la suite de la recherche
+                    if turn:
+                        turn.begin_stream(self.model)
+                    response_stream = self.chat.send_message_stream(response_parts)
+                    continue
+
+                break
+
+            # Function calls laissés à l'interface (ex: recherche directe)
             for function_call in collected_function_calls:
                 function_name = getattr(function_call, 'name', '')
                 args = getattr(function_call, 'args', {})
                 query = args.get("query", "") if hasattr(args, 'get') else ""
-                
-                if function_name == "perplexity_direct_search":
-                    # Recherche directe - réponse immédiate à l'utilisateur
-                    yield f"FUNCTION_CALL:perplexity_direct_search:{query}"
-                    
-                elif function_name == "perplexity_help_search":
-                    # Recherche d'aide - informations pour Gemini
-                    yield f"FUNCTION_CALL:perplexity_help_search:{query}"
-                    
-                else:
-                    # Function call non reconnu
-                    yield f"FUNCTION_CALL_UNKNOWN:{function_name}:{query}"
+                yield StreamEvent(StreamEventType.TOOL_CALL, tool_name=function_name, query=query)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            # Aussi quand le consommateur ferme le générateur avant la fin (GeneratorExit)
+            timer.finish(error=failed)
 
-        # Yield les comptes totaux de tokens
-        yield f"\nGEMINI_PROMPT_TOKENS : {interaction_total_prompt_tokens}\n"
-        yield f"GEMINI_OUTPUT_TOKENS : {interaction_total_output_tokens}\n"
-        
-        # Prix
-        input_price = (interaction_total_prompt_tokens * self.config.gemini_input_price_per_token) 
-        output_price = (interaction_total_output_tokens * self.config.gemini_output_price_per_token)
-        yield f"GEMINI_TOTAL_INPUT_PRICE : {input_price:.10f}$\n"
-        yield f"GEMINI_TOTAL_OUTPUT_PRICE : {output_price:.10f}$\n"
-        yield f"GEMINI_TOTAL_PRICE : {(input_price + output_price):.10f}$\n"
+        # Tokens et prix de l'interaction (les tokens servis par le cache de contexte sont facturés au tarif réduit)
+        costs = interaction_usage.costs()
+        usage = GeminiUsage(
+            prompt_tokens=interaction_usage.input_tokens + interaction_usage.cache_read_tokens,
+            output_tokens=interaction_usage.output_tokens,
+            input_price=costs["entry_cost"] + costs["cache_cost"],
+            output_price=costs["output_cost"],
+            cached_tokens=interaction_usage.cache_read_tokens,
+            cache_storage_price=self._pending_cache_storage_price
+        )
+        self._pending_cache_storage_price = 0.0
+        yield StreamEvent(StreamEventType.USAGE, usage=usage)
+        yield StreamEvent(StreamEventType.DONE)
 
     def send_message(self, message: str, force_include_all_files: bool = False) -> str:
         """
@@ -284,23 +780,10 @@ class GeminiClient:
         if not self.chat:
             raise RuntimeError("Chat non initialisé")
         
-        content = [message]
-        
-        # Déterminer quels fichiers ajouter
-        if force_include_all_files:
-            files_to_send = self.uploaded_files.copy()
-        else:
-            # Inclure automatiquement seulement les nouveaux fichiers
-            files_to_send = self.get_new_files()
-        
-        # Ajouter les fichiers déterminés
-        for file_info in files_to_send:
-            content.append(file_info['file'])
-        
-        # Marquer les fichiers comme envoyés
-        if files_to_send:
-            self.mark_files_as_sent(files_to_send)
-            print(f"📎 {len(files_to_send)} fichier(s) ajouté(s) au contexte: {[f['name'] for f in files_to_send]}")
+        self._refresh_expired_files()
+        self._sync_context_cache()
+        self._pack_history(message)
+        content = self._build_content_parts(message, force_include_all_files)
         
         response = self.chat.send_message(content)
         return response.text if hasattr(response, 'text') else str(response)
\ No newline at end of file
@@ -1,21 +1,103 @@
 """Client pour l'API Perplexity avec calcul de coût"""
 
 import json
+import asyncio
+import threading
+from contextlib import aclosing
 import httpx
-from typing import Optional, Generator
+from typing import Optional, Generator, Callable
 from urllib.parse import urlparse
 
 from ..utils.config import Config
+from ..utils.search_cache import SearchCache
+from ..utils.metrics import get_registry
+from ..utils.usage import BudgetGovernor, openai_usage
+from ..utils.context_packer import estimate_tokens
+from ..utils.search_profile import SearchProfile, get_search_profile
 from ..models.citation import Citation, SearchResult
 
 
 class PerplexityClient:
     """Client pour l'API Perplexity"""
     
+    system_prompt = "Tu es un expert juridique français. Donne une réponse précise et complète avec les références légales appropriées."
+    
     def __init__(self, config: Config):
         self.config = config
         self.api_key = config.perplexity_api_key
-        self.base_url = "https://api.perplexity.ai/chat/completions"
+        self.base_url = f"{config.perplexity_base_url.rstrip('/')}/chat/completions"
+        
+        # Cache disque des résultats (None si désactivé)
+        self.cache: Optional[SearchCache] = None
+        if config.perplexity_cache_enabled:
+            self.cache = SearchCache(
+                config.cache_dir / "perplexity_search.sqlite3",
+                ttl=config.perplexity_cache_ttl,
+                max_entries=config.perplexity_cache_max_entries,
+                semantic_threshold=config.perplexity_cache_similarity_threshold,
+                query_log_path=config.cache_dir / "query_log.jsonl" if config.perplexity_query_log_enabled else None,
+                query_log_max_bytes=config.perplexity_query_log_max_bytes
+            )
+        
+        # Transport partagé : un seul pool de connexions (keep-alive, HTTP/2) et
+        # une boucle d'événements dédiée pour toute la durée de vie du client
+        self._http_client: Optional[httpx.AsyncClient] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+        
+        # Plafonds de la session : les recherches sont imputées au tour en cours du gouverneur
+        self.governor: Optional[BudgetGovernor] = None
+    
+    def _http2_available(self) -> bool:
+        """Vérifie si le support HTTP/2 (paquet h2) est installé"""
+        if not self.config.perplexity_http2:
+            return False
+        try:
+            import h2  # noqa: F401
+            return True
+        except ImportError:
+            return False
+    
+    def _get_http_client(self) -> httpx.AsyncClient:
+        """Retourne le client HTTP partagé, créé à la première utilisation"""
+        if self._http_client is None or self._http_client.is_closed:
+            limits = httpx.Limits(
+                max_connections=self.config.perplexity_max_connections,
+                max_keepalive_connections=self.config.perplexity_max_keepalive_connections,
+                keepalive_expiry=self.config.perplexity_keepalive_expiry
+            )
+            self._http_client = httpx.AsyncClient(
+                http2=self._http2_available(),
+                limits=limits,
+                timeout=httpx.Timeout(self.config.perplexity_timeout, connect=10.0),
+                headers={"Authorization": f"Bearer {self.api_key}"}
+            )
+        return self._http_client
+    
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        """Retourne la boucle d'événements propre au client"""
+        if self._loop is None or self._loop.is_closed():
+            self._loop = asyncio.new_event_loop()
+        return self._loop
+    
+    def close(self) -> None:
+        """Ferme le pool de connexions et la boucle d'événements du client"""
+        with self._lock:
+            if self._http_client is not None and not self._http_client.is_closed:
+                self._get_loop().run_until_complete(self._http_client.aclose())
+            self._http_client = None
+            if self._loop is not None and not self._loop.is_closed():
+                self._loop.close()
+            self._loop = None
+            if self.cache is not None:
+                self.cache.close()
+                self.cache = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
     
     def _extract_domain(self, url: str) -> str:
         """Extrait le domaine d'une URL"""
@@ -26,13 +108,38 @@ class PerplexityClient:
         except:
             return ""
     
-    async def search_stream_async(self, query: str):
-        """Effectue une recherche avec streaming asynchrone et calcul de coût"""
+    def get_profile(self, query: str) -> SearchProfile:
+        """Profil de recherche de la requête (fixe, d'après la configuration, si ADAPTIVE_SEARCH=0)"""
+        if self.config.adaptive_search:
+            return get_search_profile(query)
+        return SearchProfile(
+            "defaut", "Profil fixe", "medium", self.config.perplexity_model, self.config.perplexity_max_tokens, 3
+        )
+    
+    async def search_stream_async(
+        self,
+        query: str,
+        on_delta: Optional[Callable[[str], None]] = None,
+        profile: Optional[SearchProfile] = None
+    ):
+        """
+        Effectue une recherche avec streaming asynchrone et calcul de coût.
+        
+        Doit s'exécuter sur la boucle du client (voir search()), le pool de
+        connexions partagé y étant attaché.
+        
+        Args:
+            query: La requête de recherche
+            on_delta: Callback optionnel appelé avec chaque fragment de texte reçu
+            profile: Profondeur de recherche (déduite de la requête par défaut)
+        """
         if not self.api_key:
             raise ValueError("PERPLEXITY_API_KEY manquante")
         
+        profile = profile or self.get_profile(query)
+        model = profile.perplexity_model
+        
         headers = {
-            "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
         }
         
@@ -45,11 +152,11 @@ class PerplexityClient:
             "stream": True,
             "presence_penalty": 0,
             "frequency_penalty": 1,
-            "web_search_options": {"search_context_size": "medium"},
-            "model": self.config.perplexity_model,
+            "web_search_options": {"search_context_size": profile.search_context_size},
+            "model": model,
             "messages": [
                 {
-                    "content": "Tu es un expert juridique français. Donne une réponse précise et complète avec les références légales appropriées.",
+                    "content": self.system_prompt,
                     "role": "system"
                 },
                 {
@@ -57,75 +164,92 @@ class PerplexityClient:
                     "content": query
                 }
             ],
-            "max_tokens": self.config.perplexity_max_tokens,
+            "max_tokens": profile.max_tokens,
             "search_domain_filter": self.config.allowed_domains
         }
         
         citations = []
         full_message = ""
         
-        # Variables pour les coûts
-        input_tokens = 0
-        output_tokens = 0
-        total_tokens = 0
+        # Tour en cours du gouverneur de budget (la génération s'arrête au plafond)
+        turn = self.governor.turn if self.governor else None
+        if turn:
+            turn.begin_stream(model, estimate_tokens(self.system_prompt + query))
+        stopped = False
         
         # Import ici pour éviter les dépendances circulaires
         from rich.console import Console
         console = Console()
         
+        timer = get_registry().stream("perplexity", model)
         try:
             console.print("🌐 Recherche Perplexity en cours...", style="cyan")
             last_chunk = None
-            async with httpx.AsyncClient() as client:
-                async with client.stream('POST', self.base_url, json=payload, headers=headers) as response:
-                    async for line in response.aiter_lines():
-                        if line.startswith('data: '):
-                            data = line[6:]
-                            if data != '[DONE]' and data.strip():
-                                try:
-                                    chunk = json.loads(data)
-                                    last_chunk = chunk  # Mémoriser le dernier chunk pour les citations
-                                    
-                                    # Contenu du message - afficher en BLANC (pas de style)
-                                    if chunk and 'choices' in chunk and len(chunk['choices']) > 0:
-                                        delta = chunk['choices'][0].get('delta', {})
-                                        if 'content' in delta:
-                                            message = delta['content']
-                                            full_message += message
-                                            # Afficher le chunk en temps réel EN BLANC
-                                            console.print(message, end="")
-                                    
-                                    # Citations - collecter sans afficher
-                                    if 'citations' in chunk and chunk['citations']:
-                                        raw_citations = chunk['citations']
-                                        citations = []
-                                        for i, citation_url in enumerate(raw_citations, 1):
-                                            citation = Citation(
-                                                number=i,
-                                                title=f"Source {i}",
-                                                url=citation_url,
-                                                snippet="",
-                                                source=self._extract_domain(citation_url)
-                                            )
-                                            citations.append(citation)
-                                            
-                                            
-                                except json.JSONDecodeError:
-                                    continue
+            client = self._get_http_client()
+            async with client.stream('POST', self.base_url, json=payload, headers=headers) as response, \
+                    aclosing(response.aiter_lines()) as lines:
+                async for line in lines:
+                    timer.on_bytes(len(line.encode("utf-8")) + 1)
+                    if line.startswith('data: '):
+                        data = line[6:]
+                        if data != '[DONE]' and data.strip():
+                            try:
+                                chunk = json.loads(data)
+                                last_chunk = chunk  # Mémoriser le dernier chunk pour les citations
+                                
+                                # Contenu du message - afficher en BLANC (pas de style)
+                                if chunk and 'choices' in chunk and len(chunk['choices']) > 0:
+                                    delta = chunk['choices'][0].get('delta', {})
+                                    if 'content' in delta:
+                                        message = delta['content']
+                                        timer.on_delta()
+                                        full_message += message
+                                        # Afficher le chunk en temps réel EN BLANC
+                                        console.print(message, end="")
+                                        if on_delta:
+                                            on_delta(message)
+                                        if turn and not turn.on_text(message):
+                                            stopped = True
+                                
+                                # Citations - collecter sans afficher
+                                if 'citations' in chunk and chunk['citations']:
+                                    raw_citations = chunk['citations']
+                                    citations = []
+                                    for i, citation_url in enumerate(raw_citations, 1):
+                                        citation = Citation(
+                                            number=i,
+                                            title=f"Source {i}",
+                                            url=citation_url,
+                                            snippet="",
+                                            source=self._extract_domain(citation_url)
+                                        )
+                                        citations.append(citation)
+                                        
+                                        
+                            except json.JSONDecodeError:
+                                continue
+                    if stopped:
+                        break
             
+            timer.finish(error=response.status_code >= 400)
             console.print("\n")  # Nouvelle ligne à la fin
             
-            # Extraire les informations de coût
-            if last_chunk and 'usage' in last_chunk:
-                usage = last_chunk['usage']
-                input_tokens = usage.get('prompt_tokens', 0)
-                output_tokens = usage.get('completion_tokens', 0)
-                total_tokens = usage.get('total_tokens', 0)
+            # Usage réel (dernier chunk) ; estimation si le stream a été interrompu avant
+            if last_chunk and last_chunk.get('usage'):
+                usage = openai_usage(last_chunk['usage'], "perplexity", model)
+            elif turn:
+                usage = turn.estimated_usage("perplexity", model)
+            else:
+                usage = openai_usage(None, "perplexity", model)
+            if turn:
+                turn.record(usage)
+            if stopped:
+                full_message += f"\n\n⚠️ Recherche interrompue : {turn.stop_reason}."
             
-            # Calculer le coût total
-            input_price = input_tokens * self.config.perplexity_input_price_per_token
-            output_price = output_tokens * self.config.perplexity_output_price_per_token
-            total_cost = self.config.perplexity_base_search_price + input_price + output_price
+            input_tokens = usage.input_tokens
+            output_tokens = usage.output_tokens
+            total_tokens = usage.total_tokens
+            total_cost = usage.total_cost
             
             # Afficher les informations de coût (comme avant)
             print("PERPLEXITY_INPUT TOKENS :", input_tokens)
@@ -140,31 +264,73 @@ class PerplexityClient:
                 input_tokens=input_tokens,
                 output_tokens=output_tokens,
                 total_tokens=total_tokens,
-                total_cost=total_cost
+                total_cost=total_cost,
+                search_profile=profile.name
             )
             
         except Exception as e:
+            timer.finish(error=True)
             console.print(f"\n❌ Erreur lors de la recherche: {e}", style="red")
             raise Exception(f"Erreur lors de la recherche: {e}")
 
-    def search(self, query: str) -> SearchResult:
-        """Recherche synchrone qui retourne le résultat complet"""
-        import asyncio
+    def _cache_scope(self, profile: SearchProfile) -> str:
+        """Périmètre de cache d'un profil de recherche (modèle, contexte, domaines, prompt)"""
+        return SearchCache.make_scope(
+            profile.perplexity_model, self.config.allowed_domains, self.system_prompt, profile.search_context_size
+        )
+    
+    def search(
+        self,
+        query: str,
+        on_delta: Optional[Callable[[str], None]] = None,
+        use_cache: bool = True,
+        profile: Optional[SearchProfile] = None
+    ) -> SearchResult:
+        """
+        Recherche synchrone qui retourne le résultat complet.
         
-        # Exécuter la recherche asynchrone
-        try:
-            loop = asyncio.get_event_loop()
-        except RuntimeError:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
+        Exécute la recherche sur la boucle propre au client pour réutiliser
+        les connexions déjà ouvertes d'un appel à l'autre. Les résultats sont
+        servis depuis le cache disque, y compris pour une paraphrase d'une requête
+        déjà en cache, quand c'est possible (use_cache=False pour l'ignorer) ;
+        un résultat servi par le cache a un coût nul et cached=True.
+        La profondeur de recherche (profile) est déduite de la requête si elle n'est pas fournie.
+        """
+        profile = profile or self.get_profile(query)
+        cache_scope = self._cache_scope(profile) if use_cache and self.cache is not None else None
+        if cache_scope:
+            cached_result = self.cache.lookup(query, cache_scope)
+            if cached_result is not None:
+                cached_result.query = query
+                cached_result.total_cost = 0.0
+                cached_result.cached = True
+                if on_delta:
+                    on_delta(cached_result.content)
+                return cached_result
+        
+        # Les recherches payantes sont décomptées du budget du tour en cours
+        turn = self.governor.turn if self.governor else None
+        if turn and not turn.allow_search():
+            return SearchResult(
+                content=f"Recherche non effectuée : {turn.stop_reason}.",
+                citations=[],
+                query=query,
+                total_cost=0.0
+            )
         
         try:
-            result = loop.run_until_complete(self.search_stream_async(query))
-            return result
+            with self._lock:
+                loop = self._get_loop()
+                result = loop.run_until_complete(self.search_stream_async(query, on_delta=on_delta, profile=profile))
         except Exception as e:
             return SearchResult(
                 content=f"Erreur lors de la recherche: {e}",
                 citations=[],
                 query=query,
                 total_cost=0.0
-            )
\ No newline at end of file
+            )
+        
+        # Ne mettre en cache que les réponses complètes (pas celles interrompues par le budget)
+        if cache_scope and result.content and not (turn and turn.stop_reason):
+            self.cache.store(query, cache_scope, result)
+        return result
@@ -1,9 +1,12 @@
 """Modèles pour les citations et résultats de recherche avec coût"""
 
-from dataclasses import dataclass
-from typing import List, Optional
+from dataclasses import dataclass, asdict
+from typing import List, Optional, TYPE_CHECKING
 from datetime import datetime
 
+if TYPE_CHECKING:
+    from ..utils.store import ConversationStore
+
 
 @dataclass
 class Citation:
@@ -30,21 +33,57 @@ class SearchResult:
     output_tokens: int = 0
     total_tokens: int = 0
     total_cost: float = 0.0
+    # Servi depuis le cache local (aucun coût réel)
+    cached: bool = False
+    # Profondeur de recherche utilisée (voir utils/search_profile.py)
+    search_profile: str = ""
     
     def __post_init__(self):
         if self.timestamp is None:
             self.timestamp = datetime.now()
+    
+    def to_dict(self) -> dict:
+        """Sérialise le résultat (pour le cache disque)"""
+        return {
+            "content": self.content,
+            "citations": [asdict(citation) for citation in self.citations],
+            "query": self.query,
+            "timestamp": self.timestamp.isoformat(),
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            "total_tokens": self.total_tokens,
+            "total_cost": self.total_cost,
+            "search_profile": self.search_profile
+        }
+    
+    @classmethod
+    def from_dict(cls, data: dict) -> "SearchResult":
+        """Reconstruit un résultat sérialisé par to_dict()"""
+        return cls(
+            content=data["content"],
+            citations=[Citation(**citation) for citation in data.get("citations", [])],
+            query=data.get("query", ""),
+            timestamp=datetime.fromisoformat(data["timestamp"]) if data.get("timestamp") else None,
+            input_tokens=data.get("input_tokens", 0),
+            output_tokens=data.get("output_tokens", 0),
+            total_tokens=data.get("total_tokens", 0),
+            total_cost=data.get("total_cost", 0.0),
+            search_profile=data.get("search_profile", "")
+        )
 
 
 class CitationManager:
-    """Gestionnaire des citations par interaction"""
+    """Gestionnaire des citations par interaction (enregistrées en base si un store est fourni)"""
     
-    def __init__(self):
+    def __init__(self, store: Optional["ConversationStore"] = None):
         self._search_results: List[SearchResult] = []
+        self.store = store
     
     def add_search_result(self, result: SearchResult) -> None:
         """Ajoute un résultat de recherche"""
         self._search_results.append(result)
+        if self.store is not None:
+            self.store.add_search_result(result)
     
     def get_latest_citations(self) -> List[Citation]:
         """Retourne les citations de la dernière recherche"""
@@ -59,7 +98,9 @@ class CitationManager:
         return self._search_results[-1].total_cost
     
     def get_all_search_results(self) -> List[SearchResult]:
-        """Retourne tous les résultats de recherche"""
+        """Retourne tous les résultats de recherche (de la session en base si un store est fourni)"""
+        if self.store is not None:
+            return self.store.get_search_results()
         return self._search_results.copy()
     
     def clear(self) -> None:
@@ -68,12 +109,13 @@ class CitationManager:
     
     def format_citations_by_interaction(self) -> str:
         """Formate les citations par interaction"""
-        if not self._search_results:
+        search_results = self.get_all_search_results()
+        if not search_results:
             return "Aucune citation disponible."
         
         lines = ["📚 Citations par interaction:\n"]
         
-        for i, search_result in enumerate(self._search_results, 1):
+        for i, search_result in enumerate(search_results, 1):
             lines.append(f"🔍 Interaction {i}: {search_result.query}")
             lines.append(f"📅 {search_result.timestamp.strftime('%H:%M:%S')}")
             lines.append(f"💰 Coût: {search_result.total_cost:.6f}$")
@@ -0,0 +1,39 @@
+"""Modèles pour les événements du streaming Gemini"""
+
+from dataclasses import dataclass
+from typing import Optional
+from enum import Enum
+
+
+class StreamEventType(Enum):
+    """Types d'événements émis par GeminiClient.send_message_stream"""
+    TEXT_DELTA = "text_delta"
+    TOOL_CALL = "tool_call"  # Function call laissé à l'interface
+    TOOL_RESULT = "tool_result"  # Function call exécuté dans le tour par le client
+    USAGE = "usage"
+    DONE = "done"
+
+
+@dataclass
+class GeminiUsage:
+    """Tokens et coût d'une interaction Gemini"""
+    prompt_tokens: int = 0
+    output_tokens: int = 0
+    input_price: float = 0.0
+    output_price: float = 0.0
+    cached_tokens: int = 0  # Part de prompt_tokens servie par le cache de contexte
+    cache_storage_price: float = 0.0  # Stockage du cache de contexte créé/prolongé pendant l'interaction
+
+    @property
+    def total_price(self) -> float:
+        return self.input_price + self.output_price + self.cache_storage_price
+
+
+@dataclass
+class StreamEvent:
+    """Événement du streaming Gemini"""
+    type: StreamEventType
+    text: str = ""
+    tool_name: str = ""
+    query: str = ""
+    usage: Optional[GeminiUsage] = None
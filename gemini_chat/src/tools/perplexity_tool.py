@@ -1,10 +1,11 @@
 """Outil Google pour intégrer Perplexity à Gemini avec gestion des coûts"""
 
 from google.genai import types
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 
 from ..clients.perplexity_client import PerplexityClient
 from ..models.citation import CitationManager
+from ..utils.search_profile import SearchProfile
 
 
 class PerplexityTool:
@@ -14,6 +15,7 @@ class PerplexityTool:
         self.perplexity_client = perplexity_client
         self.citation_manager = citation_manager
         self.last_search_cost = 0.0  # Stockage du dernier coût
+        self.last_search_profile: Optional[SearchProfile] = None  # Profondeur de la dernière recherche
     
     def get_direct_search_function_declaration(self) -> types.FunctionDeclaration:
         """
@@ -77,8 +79,9 @@ class PerplexityTool:
         Utilise tous les domaines disponibles
         """
         try:
-            # Recherche avec tous les domaines pour une réponse complète
-            result = self.perplexity_client.search(query)
+            # Recherche avec tous les domaines, à la profondeur adaptée à la requête
+            self.last_search_profile = self.perplexity_client.get_profile(query)
+            result = self.perplexity_client.search(query, profile=self.last_search_profile)
             self.citation_manager.add_search_result(result)
             
             # Stocker le coût de cette recherche
@@ -96,8 +99,9 @@ class PerplexityTool:
         Limitée aux domaines fiables (legifrance, service-public, etc.)
         """
         try:
-            # Recherche limitée aux domaines officiels pour information fiable
-            result = self.perplexity_client.search(query)
+            # Recherche limitée aux domaines officiels, à la profondeur adaptée à la requête
+            self.last_search_profile = self.perplexity_client.get_profile(query)
+            result = self.perplexity_client.search(query, profile=self.last_search_profile)
             self.citation_manager.add_search_result(result)
             
             # Stocker le coût de cette recherche
@@ -113,9 +117,14 @@ class PerplexityTool:
         """Retourne le coût de la dernière recherche effectuée"""
         return self.last_search_cost
     
+    def get_last_search_profile(self) -> Optional[SearchProfile]:
+        """Retourne le profil de recherche (classe de la requête) de la dernière recherche"""
+        return self.last_search_profile
+    
     def reset_cost_tracking(self) -> None:
         """Remet à zéro le tracking des coûts"""
         self.last_search_cost = 0.0
+        self.last_search_profile = None
     
     def get_tool_config(self) -> types.Tool:
         """Retourne la configuration des deux outils pour Gemini"""
@@ -129,4 +138,13 @@ class PerplexityTool:
         return {
             "perplexity_direct_search": self.execute_direct_search,
             "perplexity_help_search": self.execute_help_search
-        }
\ No newline at end of file
+        }
+    
+    def get_in_turn_function_mapping(self) -> Dict[str, callable]:
+        """
+        Retourne les fonctions que Gemini exécute dans le même tour (FunctionResponse).
+        La recherche directe reste gérée par l'interface car sa réponse va à l'utilisateur.
+        """
+        return {
+            "perplexity_help_search": self.execute_help_search
+        }
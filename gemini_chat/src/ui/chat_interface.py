@@ -16,7 +16,10 @@ from ..clients.perplexity_client import PerplexityClient
 from ..tools.perplexity_tool import PerplexityTool
 from ..models.citation import CitationManager
 from ..models.message import MessageRole
+from ..models.stream_event import StreamEventType
 from ..utils.history import ChatHistory
+from ..utils.store import ConversationStore
+from ..utils.usage import BudgetGovernor, BudgetExceededError
 from ..ui.file_manager import FileManager
 
 
@@ -31,8 +34,15 @@ class ChatInterface:
         # Clients et outils
         self.gemini_client = GeminiClient(config)
         self.perplexity_client = PerplexityClient(config) if config.has_perplexity else None
-        self.citation_manager = CitationManager()
-        self.history = ChatHistory(config)
+        
+        # Plafonds de tokens et de dépense, partagés par Gemini et les recherches qu'il déclenche
+        self.governor = BudgetGovernor(config.budget_limits)
+        self.gemini_client.governor = self.governor
+        if self.perplexity_client:
+            self.perplexity_client.governor = self.governor
+        self.store = ConversationStore(config.store_path, config.store_batch_size, config.store_flush_interval)
+        self.citation_manager = CitationManager(self.store)
+        self.history = ChatHistory(config, self.store)
         self.file_manager = FileManager()
         
         # Stocker perplexity_tool comme attribut d'instance
@@ -55,11 +65,13 @@ class ChatInterface:
     def _initialize_chat(self):
         """Initialise le chat Gemini avec les outils"""
         tools = None
+        function_handlers = None
         if self.perplexity_client:
             self.perplexity_tool = PerplexityTool(self.perplexity_client, self.citation_manager)
             tools = [self.perplexity_tool.get_tool_config()]
+            function_handlers = self.perplexity_tool.get_in_turn_function_mapping()
         
-        self.gemini_client.initialize_chat(tools)
+        self.gemini_client.initialize_chat(tools, function_handlers)
     
 
     def _simple_input(self) -> Optional[str]:
@@ -98,134 +110,84 @@ class ChatInterface:
         try:
             self.console.print("🤖 Gemini:", style="green bold")
             
-            for chunk in self.gemini_client.send_message_stream(message):
+            for event in self.gemini_client.send_message_stream(message):
                 if self.interrupted:
                     self.console.print("\n🛑 Réponse interrompue", style="yellow")
                     break
                 
-                # Extraire le coût Gemini
-                if chunk.startswith("GEMINI_TOTAL_PRICE :"):
-                    try:
-                        gemini_cost = float(chunk.split(":")[1].strip().replace("$", ""))
-                    except:
-                        pass
+                if event.type == StreamEventType.TEXT_DELTA:
+                    # Affichage normal du streaming (seulement si pas de recherche directe)
+                    if not direct_search_completed:
+                        self.console.print(event.text, end="")
+                        full_response += event.text
                 
-                # Vérifier si c'est un function call
-                if chunk.startswith("FUNCTION_CALL:"):
-                    parts = chunk.split(":", 2)
-                    if len(parts) == 3:
-                        tool_name = parts[1]
-                        query = parts[2]
-                        
-                        if tool_name == "perplexity_direct_search":
-                            # RECHERCHE DIRECTE - Réponse finale à l'utilisateur
-                            if self.perplexity_client and self.perplexity_tool:
-                                try:
-                                    self.console.print(f"\n🔍 Recherche directe : {query}", style="cyan bold")
-                                    search_result = self.perplexity_client.search(query)
-                                    self.citation_manager.add_search_result(search_result)
-                                    
-                                    # Ajouter le coût de cette recherche
-                                    perplexity_total_cost += search_result.total_cost
-                                    
-                                    # Afficher les citations
-                                    if search_result.citations:
-                                        self.console.print("\n📚 Sources :", style="cyan bold")
-                                        for citation in search_result.citations:
-                                            self.console.print(f"  {citation}", style="cyan")
-                                    
-                                    # Ajouter le contenu complet au contexte Gemini
-                                    context_message = (
-                                        f"[RECHERCHE DIRECTE] Question de l'utilisateur: {query}\n\n"
-                                        f"Réponse Perplexity fournie à l'utilisateur:\n{search_result.content}\n\n"
-                                        f"Sources utilisées: {[c.url for c in search_result.citations]}\n\n"
-                                        f"[Cette information complète est maintenant disponible dans ton contexte "
-                                        f"pour enrichir tes prochaines réponses et répondre aux questions de suivi]"
-                                    )
-                                    self.gemini_client.send_message(context_message)
-                                    
-                                    full_response = f"[Recherche directe: {query}]\n{search_result.content}"
-                                    direct_search_completed = True
-                                    
-                                    # Arrêter le streaming car la réponse finale est donnée
-                                    break
-                                    
-                                except Exception as e:
-                                    error_msg = f"❌ Erreur lors de la recherche directe: {e}"
-                                    self.console.print(error_msg, style="red")
-                                    full_response += error_msg
-                        
-                        elif tool_name == "perplexity_help_search":
-                            # RECHERCHE D'AIDE - Informations pour Gemini
-                            if self.perplexity_client and self.perplexity_tool:
-                                try:
-                                    self.console.print(f"\n🔍 Recherche d'informations complémentaires : {query}", style="cyan")
-                                    search_result = self.perplexity_client.search(query)
-                                    self.citation_manager.add_search_result(search_result)
-                                    
-                                    # Ajouter le coût de cette recherche
-                                    perplexity_total_cost += search_result.total_cost
-                                    
-                                    # Ajouter au contexte Gemini SILENCIEUSEMENT
-                                    context_message = (
-                                        f"[INFORMATIONS COMPLÉMENTAIRES] Recherche: {query}\n\n"
-                                        f"Résultats trouvés:\n{search_result.content}\n\n"
-                                        f"Sources: {[c.url for c in search_result.citations]}\n\n"
-                                        f"[Utilise ces informations pour enrichir ta réponse initiale]"
-                                    )
-                                    self.gemini_client.send_message(context_message)
-                                    
-                                    self.console.print(f"✅ Informations ajoutées au contexte", style="green")
-                                    full_response += f"[Recherche d'aide effectuée: {query}]"
-                                    
-                                    # Relancer le streaming pour que Gemini synthétise
-                                    self.console.print("\n🤖 Synthèse avec les informations trouvées :", style="green bold")
-                                    
-                                    synthesis_prompt = "Maintenant, réponds à la question initiale en utilisant les informations complémentaires."
-                                    
-                                    for synthesis_chunk in self.gemini_client.send_message_stream(synthesis_prompt):
-                                        if self.interrupted:
-                                            break
-                                        
-                                        # Extraire le coût Gemini de la synthèse aussi
-                                        if synthesis_chunk.startswith("GEMINI_TOTAL_PRICE :"):
-                                            try:
-                                                synthesis_cost = float(synthesis_chunk.split(":")[1].strip().replace("$", ""))
-                                                gemini_cost += synthesis_cost
-                                            except:
-                                                pass
-                                        
-                                        # Ignorer les métadonnées pour la synthèse
-                                        if not synthesis_chunk.startswith(("GEMINI_", "FUNCTION_CALL:")):
-                                            self.console.print(synthesis_chunk, end="")
-                                            full_response += synthesis_chunk
-                                    
-                                except Exception as e:
-                                    error_msg = f"❌ Erreur lors de la recherche d'aide: {e}"
-                                    self.console.print(error_msg, style="red")
-                                    full_response += error_msg
-                        
-                        elif tool_name == "FUNCTION_CALL_UNKNOWN":
-                            # Function call non reconnu
-                            self.console.print(f"⚠️ Outil non reconnu: {query}", style="yellow")
-                            
-                else:
-                    # Gestion de l'affichage des informations de tokens et prix
-                    if chunk.startswith("GEMINI_PROMPT_TOKENS"):
-                        self.console.print(f"\n{chunk.strip()}", style="dim")
-                    elif chunk.startswith("GEMINI_OUTPUT_TOKENS"):
-                        self.console.print(f"{chunk.strip()}", style="dim")
-                    elif chunk.startswith("GEMINI_TOTAL_INPUT_PRICE"):
-                        self.console.print(f"{chunk.strip()}", style="dim")
-                    elif chunk.startswith("GEMINI_TOTAL_OUTPUT_PRICE"):
-                        self.console.print(f"{chunk.strip()}", style="dim")
-                    elif chunk.startswith("GEMINI_TOTAL_PRICE"):
-                        self.console.print(f"{chunk.strip()}", style="cyan bold")
+                elif event.type == StreamEventType.TOOL_CALL:
+                    query = event.query
+                    
+                    if event.tool_name == "perplexity_direct_search":
+                        # RECHERCHE DIRECTE - Réponse finale à l'utilisateur
+                        if self.perplexity_client and self.perplexity_tool:
+                            try:
+                                self.console.print(f"\n🔍 Recherche directe : {query}", style="cyan bold")
+                                search_result = self.perplexity_client.search(query)
+                                self.citation_manager.add_search_result(search_result)
+                                
+                                # Ajouter le coût de cette recherche
+                                perplexity_total_cost += search_result.total_cost
+                                
+                                # Afficher les citations
+                                if search_result.citations:
+                                    self.console.print("\n📚 Sources :", style="cyan bold")
+                                    for citation in search_result.citations:
+                                        self.console.print(f"  {citation}", style="cyan")
+                                
+                                # Ajouter le contenu complet au contexte Gemini
+                                context_message = (
+                                    f"[RECHERCHE DIRECTE] Question de l'utilisateur: {query}\n\n"
+                                    f"Réponse Perplexity fournie à l'utilisateur:\n{search_result.content}\n\n"
+                                    f"Sources utilisées: {[c.url for c in search_result.citations]}\n\n"
+                                    f"[Cette information complète est maintenant disponible dans ton contexte "
+                                    f"pour enrichir tes prochaines réponses et répondre aux questions de suivi]"
+                                )
+                                self.gemini_client.queue_context(context_message)
+                                
+                                # La réponse finale est donnée : on ne lit plus que l'usage
+                                full_response = f"[Recherche directe: {query}]\n{search_result.content}"
+                                direct_search_completed = True
+                                
+                            except Exception as e:
+                                error_msg = f"❌ Erreur lors de la recherche directe: {e}"
+                                self.console.print(error_msg, style="red")
+                                full_response += error_msg
+                    
                     else:
-                        # Affichage normal du streaming (seulement si pas de recherche directe)
-                        if not direct_search_completed and chunk and not chunk.startswith(("GEMINI_", "FUNCTION_CALL:")):
-                            self.console.print(chunk, end="")
-                            full_response += chunk
+                        # Function call non reconnu
+                        self.console.print(f"⚠️ Outil non reconnu: {event.tool_name}", style="yellow")
+                
+                # Recherche d'aide exécutée dans le tour par le client, la synthèse suit directement
+                elif event.type == StreamEventType.TOOL_RESULT:
+                    perplexity_total_cost += self.perplexity_tool.get_last_search_cost() if self.perplexity_tool else 0.0
+                    self.console.print(f"\n🔍 Recherche d'informations complémentaires : {event.query}", style="cyan")
+                    self.console.print(f"✅ Informations ajoutées au contexte", style="green")
+                    self.console.print("\n🤖 Synthèse avec les informations trouvées :", style="green bold")
+                    full_response += f"[Recherche d'aide effectuée: {event.query}]"
+                
+                elif event.type == StreamEventType.USAGE:
+                    # Informations de tokens et prix
+                    usage = event.usage
+                    gemini_cost = usage.total_price
+                    self.store.add_usage(
+                        "gemini", usage.prompt_tokens, usage.output_tokens, usage.cached_tokens, usage.total_price
+                    )
+                    self.console.print(f"\nGEMINI_PROMPT_TOKENS : {usage.prompt_tokens}", style="dim")
+                    self.console.print(f"GEMINI_OUTPUT_TOKENS : {usage.output_tokens}", style="dim")
+                    if usage.cached_tokens:
+                        self.console.print(f"GEMINI_CACHED_TOKENS : {usage.cached_tokens}", style="dim")
+                    if usage.cache_storage_price:
+                        self.console.print(f"GEMINI_CACHE_STORAGE_PRICE : {usage.cache_storage_price:.10f}$", style="dim")
+                    self.console.print(f"GEMINI_TOTAL_INPUT_PRICE : {usage.input_price:.10f}$", style="dim")
+                    self.console.print(f"GEMINI_TOTAL_OUTPUT_PRICE : {usage.output_price:.10f}$", style="dim")
+                    self.console.print(f"GEMINI_TOTAL_PRICE : {usage.total_price:.10f}$", style="cyan bold")
             
             # Nouvelle ligne à la fin si streaming normal
             if not direct_search_completed and not full_response.startswith("[Recherche"):
@@ -253,6 +215,11 @@ class ChatInterface:
                 self.console.print("="*50, style="cyan")
             
             return full_response
+        
+        except BudgetExceededError as e:
+            error_msg = f"⛔ {e}"
+            self.console.print(error_msg, style="yellow")
+            return error_msg
             
         except Exception as e:
             error_msg = f"❌ Erreur lors de la génération: {e}"
@@ -299,21 +266,37 @@ class ChatInterface:
         return True
     
     def _handle_upload_command(self, args: str):
-        """Gère la commande /upload avec gestion des doublons"""
+        """Gère la commande /upload (fichier, dossier ou motif glob) avec gestion des doublons"""
         if args:
-            # Upload direct par chemin
-            file_path = Path(args)
-            if self.file_manager.validate_pdf_file(file_path):
-                try:
-                    file_info = self.gemini_client.upload_file(file_path)
-                    self.console.print(f"✅ Fichier '{file_info['name']}' uploadé", style="green")
-                except DuplicateFileError as e:
-                    self.console.print(f"⚠️ {e}", style="yellow")
-                    self.console.print("💡 Utilisez /list pour voir les fichiers déjà uploadés", style="cyan")
-                except Exception as e:
-                    self.console.print(f"❌ Erreur lors de l'upload: {e}", style="red")
-            else:
-                self.console.print(f"❌ Fichier invalide: {file_path}", style="red")
+            # Upload direct par chemin, dossier ou motif (ex: /upload contrats/*.pdf)
+            file_paths = self.file_manager.expand_pdf_paths(args)
+            if not file_paths:
+                self.console.print(f"❌ Aucun fichier PDF valide: {args}", style="red")
+                return
+            
+            status_messages = {
+                "uploaded": ("✅ Fichier '{name}' uploadé", "green"),
+                "reused": ("✅ Fichier '{name}' uploadé (déjà présent côté Gemini, non renvoyé)", "green"),
+                "duplicate": ("⚠️ Le fichier '{name}' est déjà uploadé {detail}", "yellow"),
+                "error": ("❌ Erreur lors de l'upload de '{name}': {detail}", "red")
+            }
+            
+            def on_progress(name: str, status: str, detail: str):
+                if status == "duplicate" and detail:
+                    detail = f"sous le nom '{detail}'"
+                message, style = status_messages[status]
+                self.console.print(message.format(name=name, detail=detail), style=style)
+            
+            result = self.gemini_client.upload_files(file_paths, on_progress=on_progress)
+            
+            if len(file_paths) > 1:
+                self.console.print(
+                    f"📦 {len(result.uploaded)}/{len(file_paths)} fichier(s) uploadé(s), "
+                    f"{len(result.duplicates)} doublon(s), {len(result.errors)} erreur(s)",
+                    style="cyan"
+                )
+            if result.duplicates:
+                self.console.print("💡 Utilisez /list pour voir les fichiers déjà uploadés", style="cyan")
         else:
             # Sélection graphique
             try:
@@ -376,12 +359,36 @@ class ChatInterface:
             filename = args.split(maxsplit=1)[1] if " " in args else None
             result = self.history.save_to_file(filename)
             self.console.print(result)
+        elif args == "sessions":
+            self._display_sessions()
+        elif args.startswith("load "):
+            file_path = Path(args.split(maxsplit=1)[1])
+            if not file_path.exists():
+                file_path = self.config.history_dir / file_path
+            result = self.history.load_from_file(file_path)
+            self.console.print(result)
         elif args.isdigit():
             limit = int(args)
             history_text = self.history.format_for_display(limit)
             self.console.print(history_text)
         else:
-            self.console.print("Usage: /history [clear|save [filename]|<number>]", style="yellow")
+            self.console.print("Usage: /history [clear|save [filename]|load <filename>|sessions|<number>]", style="yellow")
+    
+    def _display_sessions(self, limit: int = 20):
+        """Affiche les dernières sessions enregistrées en base"""
+        sessions = self.store.list_sessions(limit)
+        if not sessions:
+            self.console.print("📋 Aucune session enregistrée", style="yellow")
+            return
+        
+        self.console.print("🗂️ Dernières sessions:", style="cyan bold")
+        for session in sessions:
+            journal = Path(session['journal_path']).name if session['journal_path'] else "-"
+            self.console.print(
+                f"  #{session['id']} | {session['started_at'].strftime('%Y-%m-%d %H:%M')} | "
+                f"{session['messages']} message(s) | 💰 {session['cost']:.6f}$"
+            )
+            self.console.print(f"     📁 {journal}", style="dim")
     
     def _handle_search_command(self, args: str):
         """Gère la commande /search"""
@@ -410,7 +417,7 @@ class ChatInterface:
                 
                 # Ajouter au contexte Gemini silencieusement
                 context_message = f"[CONTEXTE INTERNE] Recherche manuelle effectuée: {query}\n\nRésultats:\n{result.content}\n\n[Ces informations sont maintenant disponibles pour tes prochaines réponses]"
-                self.gemini_client.send_message(context_message)
+                self.gemini_client.queue_context(context_message)
                 
                 self.console.print(f"\n✅ Recherche ajoutée au contexte Gemini", style="green")
                 
@@ -419,25 +426,55 @@ class ChatInterface:
 
     def _handle_costs_command(self):
         """Gère la commande /costs - affiche l'historique des coûts par recherche"""
-        search_results = self.citation_manager.get_all_search_results()
-        if not search_results:
+        if self.governor.enabled:
+            self.console.print(f"💳 Budget de session: {self.governor.summary()}", style="dim")
+        
+        cache_info = self.gemini_client.get_context_cache_info()
+        if cache_info:
+            self.console.print(
+                f"🗄️ Cache de contexte Gemini: {cache_info['files']} fichier(s), {cache_info['tokens']} tokens, "
+                f"expire dans {cache_info['expires_in'] / 60:.0f} min - stockage cumulé "
+                f"{self.gemini_client.context_cache_storage_cost:.6f}$",
+                style="dim"
+            )
+        
+        summary = self.store.get_cost_summary()
+        gemini_usage = summary["providers"].get("gemini")
+        if gemini_usage:
+            self.console.print(
+                f"🤖 Gemini: {gemini_usage['turns']} tour(s) | {gemini_usage['prompt_tokens']}→{gemini_usage['output_tokens']} tokens "
+                f"(dont {gemini_usage['cached_tokens']} en cache) | 💰 {gemini_usage['cost']:.6f}$",
+                style="cyan"
+            )
+        
+        if not summary["searches"]:
             self.console.print("💰 Aucun coût de recherche enregistré", style="yellow")
             return
         
-        total_cost = sum(result.total_cost for result in search_results)
+        search_results = self.citation_manager.get_all_search_results()
+        total_cost = summary["perplexity"]
         
         self.console.print("💰 Historique des coûts de recherche Perplexity:", style="cyan bold")
         self.console.print("="*60, style="cyan")
         
         for i, result in enumerate(search_results, 1):
             self.console.print(f"{i}. {result.query[:50]}{'...' if len(result.query) > 50 else ''}")
-            self.console.print(f"   📅 {result.timestamp.strftime('%H:%M:%S')} | 💰 {result.total_cost:.6f}$")
+            cache_label = " (cache)" if result.cached else ""
+            self.console.print(f"   📅 {result.timestamp.strftime('%H:%M:%S')} | 💰 {result.total_cost:.6f}${cache_label}")
             self.console.print(f"   📊 Tokens: {result.input_tokens}→{result.output_tokens} ({result.total_tokens} total)")
             self.console.print()
         
         self.console.print("="*60, style="cyan")
         self.console.print(f"💰 TOTAL PERPLEXITY: {total_cost:.6f}$", style="cyan bold")
         self.console.print("="*60, style="cyan")
+        
+        if self.perplexity_client and self.perplexity_client.cache is not None:
+            stats = self.perplexity_client.cache.get_stats()
+            self.console.print(
+                f"🗄️ Cache: {stats['hits']} hit(s) dont {stats['semantic_hits']} par similarité / {stats['misses']} miss(es) "
+                f"({stats['hit_rate']:.0%}) - {stats['entries']} entrée(s)",
+                style="dim"
+            )
 
     def _handle_citations_command(self):
         """Gère la commande /citations - affiche par interaction avec coûts"""
@@ -448,13 +485,15 @@ class ChatInterface:
         """Affiche l'aide"""
         help_text = """
 📚 Commandes disponibles:
-  /upload [chemin]    - Upload un fichier PDF
+  /upload [chemin]    - Upload un PDF, un dossier ou un motif (ex: docs/*.pdf)
   /list              - Liste les fichiers uploadés
   /remove <index>    - Supprime un fichier
   /clear             - Supprime tous les fichiers
   /history           - Affiche l'historique
   /history clear     - Efface l'historique
-  /history save      - Sauvegarde l'historique
+  /history save      - Sauvegarde l'historique (copie du journal si un nom est donné)
+  /history load <f>  - Reprend une conversation sauvegardée
+  /history sessions  - Liste les dernières sessions enregistrées
   /search <requête>  - Recherche avec Perplexity
   /citations         - Affiche les citations avec coûts
   /costs             - Affiche l'historique des coûts Perplexity
@@ -548,4 +587,12 @@ class ChatInterface:
                     break
             
             except Exception as e:
-                self.console.print(f"❌ Erreur inattendue: {e}", style="red")
\ No newline at end of file
+                self.console.print(f"❌ Erreur inattendue: {e}", style="red")
+        
+        # Synchroniser le journal de l'historique et la base locale
+        self.history.close()
+        self.store.close()
+        
+        # Libérer le pool de connexions Perplexity
+        if self.perplexity_client:
+            self.perplexity_client.close()
\ No newline at end of file
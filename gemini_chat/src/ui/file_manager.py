@@ -1,5 +1,6 @@
 """Gestionnaire de fichiers avec interface de sélection"""
 
+import glob
 from pathlib import Path
 from typing import List, Optional
 import tkinter as tk
@@ -61,6 +62,17 @@ class FileManager:
         files = self.select_files(multiple=False, file_types=file_types)
         return files[0] if files else None
     
+    def expand_pdf_paths(self, pattern: str) -> List[Path]:
+        """Résout un chemin, un dossier (PDF qu'il contient, récursivement) ou un motif glob en fichiers PDF"""
+        path = Path(pattern).expanduser()
+        if path.is_dir():
+            candidates = path.rglob("*")
+        elif glob.has_magic(pattern):
+            candidates = (Path(match) for match in glob.glob(str(path), recursive=True))
+        else:
+            candidates = [path]
+        return sorted(p for p in candidates if self.validate_pdf_file(p))
+    
     def validate_pdf_file(self, file_path: Path) -> bool:
         """Valide qu'un fichier est un PDF existant"""
         return (
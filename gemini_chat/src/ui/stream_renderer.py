@@ -0,0 +1,103 @@
+"""Rendu throttlé d'une réponse streamée dans un placeholder Streamlit"""
+
+import time
+from dataclasses import dataclass
+from typing import List, Optional, Any
+
+
+@dataclass
+class RenderStats:
+    """Compteurs de rendu cumulés (par session)"""
+    deltas: int = 0
+    frames: int = 0
+    skipped_frames: int = 0
+    bytes_sent: int = 0
+    render_time: float = 0.0
+
+    def summary(self) -> str:
+        """Résumé lisible des compteurs"""
+        return (
+            f"🖼️ {self.frames} rendus pour {self.deltas} fragments "
+            f"({self.skipped_frames} redondants évités) | "
+            f"{self.bytes_sent / 1024:.1f} Ko envoyés | {self.render_time * 1000:.0f} ms de rendu"
+        )
+
+
+class ThrottledStreamRenderer:
+    """
+    Affiche un texte streamé dans un placeholder (objet exposant `markdown`).
+
+    Les fragments sont accumulés dans une liste et le placeholder n'est redessiné
+    qu'au plus `max_fps` fois par seconde ; un rendu identique au précédent est ignoré.
+    """
+
+    def __init__(
+        self,
+        placeholder: Any,
+        prefix: str = "",
+        max_fps: float = 12.0,
+        cursor: str = "▌",
+        stats: Optional[RenderStats] = None
+    ):
+        self.placeholder = placeholder
+        self.prefix = prefix
+        self.min_interval = 1.0 / max_fps
+        self.cursor = cursor
+        self.stats = stats if stats is not None else RenderStats()
+        self.parts: List[str] = []
+        self._pending = False
+        self._last_render = 0.0
+        self._last_content: Optional[str] = None
+
+    @property
+    def text(self) -> str:
+        """Texte streamé reçu jusqu'ici (sans le préfixe)"""
+        return "".join(self.parts)
+
+    def _render(self, content: str) -> None:
+        """Redessine le placeholder si le contenu a changé"""
+        if content == self._last_content:
+            self.stats.skipped_frames += 1
+            return
+        start = time.perf_counter()
+        self.placeholder.markdown(content)
+        self.stats.render_time += time.perf_counter() - start
+        self.stats.frames += 1
+        self.stats.bytes_sent += len(content.encode("utf-8"))
+        self._last_content = content
+
+    def append(self, text: str) -> None:
+        """Ajoute un fragment, affiché au prochain créneau de rendu"""
+        if not text:
+            return
+        self.parts.append(text)
+        self.stats.deltas += 1
+        self._pending = True
+        now = time.perf_counter()
+        if now - self._last_render >= self.min_interval:
+            self._last_render = now
+            self._pending = False
+            self._render(self.prefix + self.text + self.cursor)
+
+    def flush(self) -> None:
+        """Affiche immédiatement les fragments en attente (avec curseur)"""
+        if self._pending:
+            self._pending = False
+            self._last_render = time.perf_counter()
+            self._render(self.prefix + self.text + self.cursor)
+
+    def rebase(self, prefix: str) -> None:
+        """Repart d'un nouveau préfixe (ex: texte déjà affiché + transition) et d'une liste vide"""
+        self.prefix = prefix
+        self.parts = []
+
+    def show(self, content: str) -> None:
+        """Affiche un contenu arbitraire (message d'attente, transition...)"""
+        self._render(content)
+
+    def finalize(self, content: Optional[str] = None) -> str:
+        """Affichage final sans curseur ; retourne le contenu affiché"""
+        self._pending = False
+        final_content = content if content is not None else self.prefix + self.text
+        self._render(final_content)
+        return final_content
@@ -0,0 +1,177 @@
+"""Compaction de l'historique : les anciens échanges sont remplacés par un résumé tenu à jour"""
+
+import re
+from dataclasses import dataclass
+from typing import List, Optional, Any, Callable
+
+from .context_packer import (
+    estimate_tokens, message_text, message_role, split_turns, MESSAGE_OVERHEAD_TOKENS
+)
+
+
+URL_PATTERN = re.compile(r"https?://[^\s<>\"')\]]+")
+HTML_TAG_PATTERN = re.compile(r"<[^>]+>")
+
+SUMMARY_INSTRUCTIONS = (
+    "Tu tiens à jour le résumé d'une consultation juridique. Intègre les nouveaux échanges "
+    "au résumé existant sans le réécrire entièrement : garde les faits, les questions posées, "
+    "les conclusions, les textes de loi, articles, décisions et dates cités, ainsi que les "
+    "références numérotées [n]. Réponds uniquement par le résumé mis à jour, en français."
+)
+
+
+def build_summary_prompt(previous_summary: str, transcript: str) -> str:
+    """Prompt de mise à jour incrémentale du résumé"""
+    return (
+        f"{SUMMARY_INSTRUCTIONS}\n\n"
+        f"RÉSUMÉ ACTUEL :\n{previous_summary or '(aucun)'}\n\n"
+        f"NOUVEAUX ÉCHANGES :\n{transcript}"
+    )
+
+
+def _turn_transcript(turn: List[Any]) -> str:
+    """Transcription texte d'un échange (balises HTML retirées)"""
+    lines = []
+    for message in turn:
+        text = HTML_TAG_PATTERN.sub(" ", message_text(message))
+        text = re.sub(r"[ \t]+", " ", text).strip()
+        if text:
+            speaker = "Utilisateur" if message_role(message) == "user" else "Assistant"
+            lines.append(f"{speaker} : {text}")
+    return "\n".join(lines)
+
+
+def _turn_citations(turn: List[Any]) -> List[str]:
+    """URLs citées dans un échange : dans le texte, ou dans la clé `citations` d'un message dict"""
+    urls = []
+    for message in turn:
+        urls.extend(URL_PATTERN.findall(message_text(message)))
+        if isinstance(message, dict):
+            urls.extend(str(url) for url in message.get("citations") or [])
+    return urls
+
+
+def _turn_tokens(turn: List[Any]) -> int:
+    return sum(estimate_tokens(message_text(m)) + MESSAGE_OVERHEAD_TOKENS for m in turn)
+
+
+@dataclass
+class CompactionResult:
+    """Historique après compaction et tokens économisés sur cette requête"""
+    messages: List[Any]
+    summary: str
+    tokens_before: int
+    tokens_after: int
+    newly_compacted_turns: int = 0
+
+    @property
+    def tokens_saved(self) -> int:
+        return max(self.tokens_before - self.tokens_after, 0)
+
+
+class ConversationCompactor:
+    """
+    Remplace les anciens échanges d'une conversation par un résumé glissant.
+
+    Dès que l'historique dépasse `threshold_tokens`, les échanges sortis de la fenêtre
+    des `keep_recent_turns` derniers sont intégrés au résumé existant : seul ce qui est
+    nouveau est envoyé au résumeur, le résumé n'est jamais reconstruit depuis le début.
+    Les URLs citées dans les échanges compactés (texte ou clé `citations` des messages)
+    sont conservées à côté du résumé.
+    Les échanges épinglés (ex: ceux qui portent un document) ne sont jamais compactés.
+
+    L'état (résumé, sources, nombre d'échanges compactés) est gardé par l'instance ;
+    l'historique ne doit que croître, sinon appeler reset().
+    """
+
+    def __init__(
+        self,
+        threshold_tokens: int = 6000,
+        keep_recent_turns: int = 4,
+        is_pinned: Optional[Callable[[Any], bool]] = None
+    ):
+        self.threshold_tokens = threshold_tokens
+        self.keep_recent_turns = keep_recent_turns
+        self.is_pinned = is_pinned
+        self.reset()
+
+    def reset(self) -> None:
+        """Oublie le résumé (nouvelle conversation)"""
+        self.summary = ""
+        self.citations: List[str] = []
+        self.compacted_until = 0  # Nombre d'échanges déjà examinés pour le résumé
+        self.summary_calls = 0
+        self.tokens_saved_per_request: List[int] = []
+
+    @property
+    def total_tokens_saved(self) -> int:
+        return sum(self.tokens_saved_per_request)
+
+    def _pinned(self, turn: List[Any]) -> bool:
+        return bool(self.is_pinned) and any(self.is_pinned(m) for m in turn)
+
+    def summary_block(self) -> str:
+        """Résumé et sources des échanges compactés, à placer dans le prompt système"""
+        if not self.summary:
+            return ""
+        block = f"Résumé des échanges précédents de la conversation :\n{self.summary}"
+        if self.citations:
+            sources = "\n".join(f"- {url}" for url in self.citations)
+            block += f"\n\nSources citées dans ces échanges :\n{sources}"
+        return block
+
+    def compact(self, messages: List[Any], summarize: Callable[[str], str]) -> CompactionResult:
+        """
+        Compacte l'historique si besoin
+
+        Args:
+            messages: Historique complet (sans la nouvelle question)
+            summarize: Appel au modèle de résumé (prompt -> texte)
+        """
+        turns = split_turns(messages)
+        costs = [_turn_tokens(turn) for turn in turns]
+        tokens_before = sum(costs)
+        recent_start = max(len(turns) - self.keep_recent_turns, 0)
+
+        newly_compacted = 0
+        if tokens_before > self.threshold_tokens and recent_start > self.compacted_until:
+            new_turns = [
+                turn for turn in turns[self.compacted_until:recent_start] if not self._pinned(turn)
+            ]
+            transcript = "\n\n".join(_turn_transcript(turn) for turn in new_turns)
+            try:
+                summary = summarize(build_summary_prompt(self.summary, transcript)).strip() if new_turns else self.summary
+            except Exception as e:
+                # Le résumé n'a pas pu être mis à jour : ces échanges restent envoyés tels quels
+                print(f"AVERTISSEMENT: Compaction de l'historique impossible: {e}")
+            else:
+                if new_turns:
+                    self.summary_calls += 1
+                for turn in new_turns:
+                    for url in _turn_citations(turn):
+                        if url not in self.citations:
+                            self.citations.append(url)
+                self.summary = summary
+                newly_compacted = len(new_turns)
+                self.compacted_until = recent_start
+
+        kept = [
+            message
+            for i, turn in enumerate(turns)
+            if i >= self.compacted_until or self._pinned(turn)
+            for message in turn
+        ]
+        summary = self.summary_block()
+        tokens_after = sum(
+            cost for i, cost in enumerate(costs) if i >= self.compacted_until or self._pinned(turns[i])
+        ) + estimate_tokens(summary)
+
+        result = CompactionResult(
+            messages=kept,
+            summary=summary,
+            tokens_before=tokens_before,
+            tokens_after=tokens_after,
+            newly_compacted_turns=newly_compacted
+        )
+        self.tokens_saved_per_request.append(result.tokens_saved)
+        return result
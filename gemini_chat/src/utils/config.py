@@ -5,6 +5,8 @@ from pathlib import Path
 from typing import Optional
 from dotenv import load_dotenv
 
+from .usage import BudgetLimits
+
 
 class Config:
     """Gestionnaire de configuration centralisé"""
@@ -21,24 +23,59 @@ class Config:
         self.gemini_api_key = os.getenv("GEMINI_API_KEY")
         self.perplexity_api_key = os.getenv("PERPLEXITY_API_KEY")
         
+        # URLs des API (surchargées pour pointer vers l'émulateur local, cf. benchmarks/)
+        self.perplexity_base_url = os.getenv("PERPLEXITY_BASE_URL", "https://api.perplexity.ai")
+        self.gemini_base_url = os.getenv("GEMINI_BASE_URL")
+        
         # Configuration du chat
         self.max_tokens = 3000
         self.temperature = 0.3
         self.max_history_length = 100
         
-        # prix gemini
-        self.gemini_input_price_per_token = 0.0000001 
-        self.gemini_output_price_per_token = 0.000004
+        # Journal de l'historique : fsync groupé toutes les N lignes ou toutes les N secondes
+        self.history_fsync_batch = 20
+        self.history_fsync_interval = 1.0
+        
+        # Base SQLite locale des conversations (insertions groupées)
+        self.store_batch_size = 50
+        self.store_flush_interval = 2.0
         
-        # prix perplexity
-        self.perplexity_input_price_per_token = 0.000001
-        self.perplexity_output_price_per_token = 0.000001
-        self.perplexity_base_search_price = 0.008
+        # Tarifs des modèles : table PRICING de src/utils/usage.py
+        # Plafonds de tokens et de dépense par session et par tour (BUDGET_*, illimités par défaut)
+        self.budget_limits = BudgetLimits.from_env()
     
+        # Cache de contexte Gemini des documents uploadés (GEMINI_CONTEXT_CACHE=0 pour le désactiver)
+        self.gemini_context_cache_enabled = os.getenv("GEMINI_CONTEXT_CACHE", "1") != "0"
+        self.gemini_context_cache_ttl = 3600  # secondes
+        self.gemini_context_cache_refresh_margin = 300  # prolongé s'il expire dans moins de 5 min
+        
         # Configuration Perplexity
         self.perplexity_timeout = 90
         self.perplexity_max_tokens = 3000
         
+        # Profondeur de recherche selon la question (modèle, contexte, tokens ; ADAPTIVE_SEARCH=0
+        # pour s'en tenir à perplexity_model / perplexity_max_tokens et un contexte "medium")
+        self.adaptive_search = os.getenv("ADAPTIVE_SEARCH", "1") != "0"
+
+        # Transport HTTP Perplexity (pool de connexions partagé)
+        self.perplexity_http2 = True
+        self.perplexity_max_connections = 10
+        self.perplexity_max_keepalive_connections = 5
+        self.perplexity_keepalive_expiry = 30.0
+
+        # Cache disque des recherches Perplexity (PERPLEXITY_CACHE=0 pour le désactiver)
+        self.perplexity_cache_enabled = os.getenv("PERPLEXITY_CACHE", "1") != "0"
+        self.perplexity_cache_ttl = 7 * 24 * 3600  # secondes
+        self.perplexity_cache_max_entries = 500
+
+        # Rapprochement des paraphrases dans le cache (None pour le désactiver)
+        self.perplexity_cache_similarity_threshold = 0.9
+        # Journal des requêtes du cache (rejouable avec python -m src.utils.query_index) : il contient
+        # les questions des utilisateurs, d'où PERPLEXITY_QUERY_LOG=1 pour l'activer ; au-delà de la
+        # taille maximale, il est renommé en query_log.jsonl.1 (l'archive précédente est écrasée)
+        self.perplexity_query_log_enabled = os.getenv("PERPLEXITY_QUERY_LOG", "0") == "1"
+        self.perplexity_query_log_max_bytes = 5 * 1024 * 1024
+
         #domaines 
         self.allowed_domains = ["legifrance.gouv.fr", "service-public.fr", "economie.gouv.fr" ]
         
@@ -46,13 +83,20 @@ class Config:
         self.data_dir = Path("data")
         self.uploads_dir = self.data_dir / "uploads"
         self.history_dir = self.data_dir / "history"
+        self.cache_dir = self.data_dir / "cache"
+        self.store_path = self.data_dir / "conversations.db"
+        
+        # Manifeste des fichiers envoyés à Gemini (réutilisés tant qu'ils n'expirent pas)
+        self.gemini_files_manifest_path = self.cache_dir / "gemini_files.json"
+        self.gemini_file_expiry_margin = 3600  # secondes avant expiration où le fichier est renvoyé
+        self.gemini_upload_max_workers = 4  # uploads simultanés pour un lot de fichiers
         
         # Créer les dossiers si nécessaire
         self._create_directories()
     
     def _create_directories(self):
         """Crée les dossiers nécessaires"""
-        for directory in [self.data_dir, self.uploads_dir, self.history_dir]:
+        for directory in [self.data_dir, self.uploads_dir, self.history_dir, self.cache_dir]:
             directory.mkdir(exist_ok=True)
     
     def validate(self) -> list[str]:
@@ -0,0 +1,258 @@
+"""Sélection de l'historique envoyé aux modèles dans un budget explicite de tokens d'entrée"""
+
+import re
+import mmap
+from pathlib import Path
+from dataclasses import dataclass
+from typing import List, Optional, Any, Callable, Union
+
+from .query_index import normalize_for_similarity
+
+
+# Estimation approximative : 1 token ≈ 4 caractères
+CHARS_PER_TOKEN = 4
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Tokens facturés par page de PDF (texte + image de la page côté Anthropic, forfait côté Gemini)
+PDF_TOKENS_PER_PAGE = {"anthropic": 2000, "gemini": 258}
+
+# Budget de tokens d'entrée par modèle : prompt système, documents, historique et question compris
+DEFAULT_INPUT_BUDGET = 16000
+MODEL_INPUT_BUDGETS = {
+    "sonar": 8000,
+    "sonar-pro": 16000,
+    "gemini-2.0-flash": 32000,
+    "gemini-2.5-flash": 32000,
+    "claude-3-5-haiku": 24000,
+    "claude-3-7-sonnet": 48000,
+    "claude-sonnet-4": 48000,
+    "claude-opus-4": 48000,
+}
+
+
+def get_input_budget(model: str) -> int:
+    """Budget d'entrée d'un modèle (préfixe le plus long du tableau, sinon budget par défaut)"""
+    for prefix in sorted(MODEL_INPUT_BUDGETS, key=len, reverse=True):
+        if model.startswith(prefix):
+            return MODEL_INPUT_BUDGETS[prefix]
+    return DEFAULT_INPUT_BUDGET
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimation du nombre de tokens d'un texte"""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def count_pdf_pages(data: Any) -> int:
+    """Nombre de pages d'un PDF (bytes ou mmap), estimé par ses objets /Type /Page"""
+    pages = len(re.findall(rb"/Type\s*/Page(?![s\w])", data))
+    return pages or max(1, len(data) // 50000)
+
+
+def estimate_pdf_tokens(source: Union[bytes, Path], provider: str = "anthropic") -> int:
+    """Estimation des tokens d'entrée d'un PDF (contenu ou chemin, lu par mappage mémoire) pour un fournisseur"""
+    if isinstance(source, Path):
+        if not source.stat().st_size:
+            return 0
+        with open(source, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return count_pdf_pages(data) * PDF_TOKENS_PER_PAGE[provider]
+    return count_pdf_pages(source) * PDF_TOKENS_PER_PAGE[provider] if source else 0
+
+
+def message_text(message: Any) -> str:
+    """
+    Texte d'un message, quelle que soit sa forme : dict {"role", "content"} (contenu texte ou
+    liste de blocs) ou Content du SDK Gemini (parts texte, function call ou function response).
+    Les documents sont exclus : ils sont comptés à part.
+    """
+    if isinstance(message, dict):
+        content = message.get("content", "")
+        if isinstance(content, str):
+            return content
+        texts = []
+        for block in content or []:
+            if isinstance(block, dict) and block.get("type") != "document":
+                texts.append(str(block.get("text") or block.get("content") or block.get("input") or ""))
+        return "\n".join(texts)
+
+    texts = []
+    for part in getattr(message, "parts", None) or []:
+        if getattr(part, "text", None):
+            texts.append(part.text)
+        elif getattr(part, "function_call", None):
+            texts.append(str(part.function_call.args))
+        elif getattr(part, "function_response", None):
+            texts.append(str(part.function_response.response))
+    return "\n".join(texts)
+
+
+def message_role(message: Any) -> str:
+    """Rôle d'un message (dict ou Content du SDK Gemini)"""
+    if isinstance(message, dict):
+        return message.get("role", "")
+    return getattr(message, "role", "") or ""
+
+
+def _starts_turn(message: Any) -> bool:
+    """Un échange commence à chaque message de l'utilisateur (hors réponses de fonctions Gemini)"""
+    if message_role(message) != "user":
+        return False
+    if isinstance(message, dict):
+        return True
+    return any(getattr(part, "text", None) for part in getattr(message, "parts", None) or [])
+
+
+def split_turns(messages: List[Any]) -> List[List[Any]]:
+    """Découpe un historique en échanges (un message utilisateur et ses réponses)"""
+    turns: List[List[Any]] = []
+    for message in messages:
+        if not turns or _starts_turn(message):
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+@dataclass
+class PackedContext:
+    """Historique retenu et estimation des tokens d'entrée"""
+    messages: List[Any]
+    tokens: int
+    budget: int
+    dropped_turns: int = 0
+    truncated_turns: int = 0
+
+    @property
+    def over_budget(self) -> bool:
+        return self.tokens > self.budget
+
+
+class ContextPacker:
+    """
+    Remplit un budget de tokens d'entrée avec l'historique le plus utile.
+
+    Le prompt système, les documents et la question sont comptés d'abord. Les échanges
+    (un message utilisateur et ses réponses) épinglés (ex: ceux qui portent un document)
+    sont toujours gardés, puis les plus récents, puis les plus anciens par pertinence
+    vis-à-vis de la question et par récence. Un échange récent trop long est tronqué
+    plutôt qu'écarté. L'ordre chronologique est conservé.
+
+    Avec by_relevance=False, les plus anciens sont écartés en premier : l'historique
+    gardé est une suite continue d'échanges, dont le début ne dépend pas de la question
+    (préfixe stable pour un cache de prompt).
+    """
+
+    def __init__(
+        self,
+        budget: int,
+        keep_recent_turns: int = 1,
+        is_pinned: Optional[Callable[[Any], bool]] = None,
+        min_truncated_chars: int = 200,
+        by_relevance: bool = True
+    ):
+        self.budget = budget
+        self.keep_recent_turns = keep_recent_turns
+        self.is_pinned = is_pinned
+        self.min_truncated_chars = min_truncated_chars
+        self.by_relevance = by_relevance
+
+    @classmethod
+    def for_model(cls, model: str, **kwargs) -> "ContextPacker":
+        """Packer avec le budget d'entrée du modèle"""
+        return cls(get_input_budget(model), **kwargs)
+
+    @staticmethod
+    def _message_tokens(message: Any) -> int:
+        return estimate_tokens(message_text(message)) + MESSAGE_OVERHEAD_TOKENS
+
+    def _truncate_turn(self, turn: List[Any], available_tokens: int) -> Optional[List[Any]]:
+        """Tronque le plus long message texte d'un échange pour tenir dans le budget restant"""
+        text_messages = [
+            i for i, message in enumerate(turn)
+            if isinstance(message, dict) and isinstance(message.get("content"), str)
+        ]
+        if not text_messages:
+            return None
+
+        longest = max(text_messages, key=lambda i: len(turn[i]["content"]))
+        other_tokens = sum(self._message_tokens(m) for i, m in enumerate(turn) if i != longest)
+        allowed_chars = (available_tokens - other_tokens - MESSAGE_OVERHEAD_TOKENS) * CHARS_PER_TOKEN - 8
+        if allowed_chars < self.min_truncated_chars:
+            return None
+
+        truncated = list(turn)
+        truncated[longest] = {**turn[longest], "content": turn[longest]["content"][:allowed_chars] + "\n[…]"}
+        return truncated
+
+    def pack(
+        self,
+        messages: List[Any],
+        query: str = "",
+        system_prompt: str = "",
+        documents_tokens: int = 0
+    ) -> PackedContext:
+        """
+        Sélectionne l'historique à envoyer
+
+        Args:
+            messages: Historique (dicts ou Content Gemini), sans la nouvelle question si elle est passée dans `query`
+            query: Nouvelle question (comptée et utilisée pour la pertinence)
+            system_prompt: Prompt système (compté)
+            documents_tokens: Tokens des documents joints (comptés)
+        """
+        fixed_tokens = estimate_tokens(system_prompt) + estimate_tokens(query) + documents_tokens
+        available = self.budget - fixed_tokens
+
+        turns = split_turns(messages)
+        costs = [sum(self._message_tokens(m) for m in turn) for turn in turns]
+        selected = {}
+        used = 0
+
+        # 1. Échanges épinglés (documents) : toujours gardés
+        if self.is_pinned:
+            for i, turn in enumerate(turns):
+                if any(self.is_pinned(m) for m in turn):
+                    selected[i] = turn
+                    used += costs[i]
+
+        # 2. Échanges les plus récents, tronqués s'il le faut
+        recent = [i for i in reversed(range(len(turns))) if i not in selected][:self.keep_recent_turns]
+        truncated_turns = 0
+        for i in recent:
+            if used + costs[i] <= available:
+                selected[i] = turns[i]
+                used += costs[i]
+                continue
+            truncated = self._truncate_turn(turns[i], available - used)
+            if truncated is not None:
+                selected[i] = truncated
+                used += sum(self._message_tokens(m) for m in truncated)
+                truncated_turns += 1
+
+        # 3. Échanges plus anciens, par pertinence pour la question puis récence
+        # (ou du plus récent au plus ancien, jusqu'au premier qui ne tient pas)
+        query_words = set(normalize_for_similarity(query).split()) if query and self.by_relevance else set()
+        older = [i for i in range(len(turns)) if i not in selected and i not in recent]
+
+        def score(i: int) -> float:
+            recency = 1.0 / (len(turns) - i)
+            if not query_words:
+                return recency
+            turn_words = set(normalize_for_similarity(" ".join(message_text(m) for m in turns[i])).split())
+            relevance = len(query_words & turn_words) / len(query_words)
+            return 0.6 * relevance + 0.4 * recency
+
+        for i in sorted(older, key=score, reverse=True):
+            if used + costs[i] <= available:
+                selected[i] = turns[i]
+                used += costs[i]
+            elif not self.by_relevance:
+                break
+
+        packed = [message for i in sorted(selected) for message in selected[i]]
+        return PackedContext(
+            messages=packed,
+            tokens=fixed_tokens + used,
+            budget=self.budget,
+            dropped_turns=len(turns) - len(selected),
+            truncated_turns=truncated_turns
+        )
@@ -0,0 +1,83 @@
+"""Manifeste local des fichiers envoyés à l'API Files de Gemini (empreinte SHA-256 -> fichier distant)"""
+
+import os
+import json
+import mmap
+import time
+import hashlib
+import threading
+from pathlib import Path
+from typing import Optional, Dict
+
+
+def hash_file(file_path: Path) -> str:
+    """Empreinte SHA-256 d'un fichier, lu par mappage mémoire (pas de copie du contenu)"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                digest.update(mapped)
+    return digest.hexdigest()
+
+
+class RemoteFileManifest:
+    """
+    Associe l'empreinte d'un contenu au fichier distant Gemini qui le porte
+    (nom, URI, type MIME, date d'expiration), persisté en JSON.
+
+    Permet de ne pas renvoyer un contenu déjà présent côté Gemini, y compris
+    sous un autre nom de fichier ou après un redémarrage.
+    """
+
+    def __init__(self, path: Path, expiry_margin: float = 0.0):
+        self.path = Path(path)
+        self.expiry_margin = expiry_margin
+        self._lock = threading.Lock()
+        self._entries: Dict[str, dict] = {}
+        if self.path.exists():
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError):
+                # Manifeste illisible : on repart d'un manifeste vide
+                self._entries = {}
+
+    def _save(self) -> None:
+        """Écrit le manifeste de façon atomique (verrou tenu)"""
+        temp_path = self.path.with_suffix(".tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(self._entries, f, ensure_ascii=False, indent=2)
+        os.replace(temp_path, self.path)
+
+    def get(self, sha256: str) -> Optional[dict]:
+        """Retourne l'entrée du contenu si le fichier distant est encore valide, sinon None"""
+        with self._lock:
+            entry = self._entries.get(sha256)
+            if entry is None:
+                return None
+            if entry["expire_time"] - time.time() <= self.expiry_margin:
+                del self._entries[sha256]
+                self._save()
+                return None
+            return dict(entry)
+
+    def put(self, sha256: str, remote_name: str, uri: str, mime_type: str, expire_time: float) -> None:
+        """Enregistre le fichier distant qui porte ce contenu"""
+        with self._lock:
+            self._entries[sha256] = {
+                "remote_name": remote_name,
+                "uri": uri,
+                "mime_type": mime_type,
+                "expire_time": expire_time
+            }
+            self._save()
+
+    def remove(self, sha256: str) -> None:
+        """Oublie un contenu (fichier distant supprimé ou introuvable)"""
+        with self._lock:
+            if self._entries.pop(sha256, None) is not None:
+                self._save()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
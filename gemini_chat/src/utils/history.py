@@ -1,107 +1,310 @@
 """Gestion de l'historique des conversations"""
 
+import os
 import json
+import time
+import queue
+import atexit
+import shutil
+import threading
+from collections import deque
 from pathlib import Path
-from typing import List, Optional
+from typing import List, Optional, Iterator, TYPE_CHECKING
 from datetime import datetime
 
 from ..models.message import ChatMessage, MessageRole
 from ..utils.config import Config
 
+if TYPE_CHECKING:
+    from .store import ConversationStore
+
+
+def _serialize_message(message: ChatMessage) -> bytes:
+    """Ligne JSONL d'un message"""
+    record = {
+        "role": message.role.value,
+        "content": message.content,
+        "timestamp": message.timestamp.isoformat(),
+        "files": message.files
+    }
+    return (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def _deserialize_message(line: bytes) -> ChatMessage:
+    """Message depuis une ligne JSONL (ou une entrée de l'ancien format JSON)"""
+    data = json.loads(line) if isinstance(line, (bytes, str)) else line
+    return ChatMessage(
+        role=MessageRole(data["role"]),
+        content=data["content"],
+        timestamp=datetime.fromisoformat(data["timestamp"]),
+        files=data.get("files", [])
+    )
+
 
 class ChatHistory:
-    """Gestionnaire de l'historique des conversations"""
-    
-    def __init__(self, config: Config):
+    """
+    Gestionnaire de l'historique des conversations.
+
+    Chaque message est ajouté à un journal JSONL (append-only) par un thread d'écriture,
+    avec fsync groupé : l'enregistrement coûte O(1) par message. Seuls les derniers
+    messages sont gardés en mémoire (tampon circulaire) ; les plus anciens restent
+    accessibles sur disque grâce à l'index des positions de chaque ligne.
+    Si une base (ConversationStore) est fournie, les messages y sont aussi indexés
+    et l'affichage passe par une requête indexée.
+    """
+
+    def __init__(self, config: Config, store: Optional["ConversationStore"] = None):
         self.config = config
-        self.messages: List[ChatMessage] = []
-    
+        self.store = store
+        self.messages: deque = deque(maxlen=config.max_history_length)
+        self.journal_path = self._new_journal_path()
+        self.total_messages = 0
+        if self.store is not None:
+            self.store.start_session(self.journal_path)
+
+        # Positions (octets) de chaque message dans le journal, remplies par le thread d'écriture
+        self._offsets: List[int] = []
+        self._lock = threading.Lock()
+        self._queue: queue.Queue = queue.Queue()
+        self._writer: Optional[threading.Thread] = None
+        atexit.register(self.close)
+
+    def _new_journal_path(self) -> Path:
+        """Chemin d'un nouveau journal de session (unique même pour deux sessions dans la même seconde)"""
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+        return self.config.history_dir / f"conversation_{timestamp}.jsonl"
+
+    def _ensure_writer(self) -> None:
+        """Démarre le thread d'écriture au premier message"""
+        if self._writer is None or not self._writer.is_alive():
+            self._writer = threading.Thread(target=self._writer_loop, name="chat-history-writer", daemon=True)
+            self._writer.start()
+
+    def _writer_loop(self) -> None:
+        """Écrit les lignes en attente et fait un fsync par lot (nombre de lignes ou délai)"""
+        journal = None
+        journal_path = None
+        unsynced = 0
+        last_sync = time.monotonic()
+
+        def sync():
+            nonlocal unsynced, last_sync
+            if journal is not None and unsynced:
+                journal.flush()
+                os.fsync(journal.fileno())
+            unsynced = 0
+            last_sync = time.monotonic()
+
+        while True:
+            try:
+                command, payload = self._queue.get(timeout=self.config.history_fsync_interval)
+            except queue.Empty:
+                sync()
+                continue
+
+            try:
+                if command == "append":
+                    path, line = payload
+                    if journal_path != path:
+                        sync()
+                        if journal is not None:
+                            journal.close()
+                        journal = open(path, "ab")
+                        journal_path = path
+                    offset = journal.tell()
+                    journal.write(line)
+                    with self._lock:
+                        self._offsets.append(offset)
+                    unsynced += 1
+                    if (
+                        unsynced >= self.config.history_fsync_batch
+                        or time.monotonic() - last_sync >= self.config.history_fsync_interval
+                    ):
+                        sync()
+                elif command == "flush":
+                    sync()
+                    payload.set()
+                elif command == "stop":
+                    sync()
+                    if journal is not None:
+                        journal.close()
+                    payload.set()
+                    return
+            except Exception as e:
+                print(f"AVERTISSEMENT: Erreur d'écriture de l'historique: {e}")
+                if command in ("flush", "stop"):
+                    payload.set()
+            finally:
+                self._queue.task_done()
+
     def add_message(self, role: MessageRole, content: str, files: Optional[List[str]] = None) -> None:
-        """Ajoute un message à l'historique"""
-        message = ChatMessage(
+        """Ajoute un message à l'historique (et au journal, en arrière-plan)"""
+        self._append(ChatMessage(
             role=role,
             content=content,
             files=files or []
-        )
+        ))
+
+    def _append(self, message: ChatMessage) -> None:
+        """Ajoute un message au tampon circulaire et le met en file pour le journal"""
+        # Le tampon circulaire évince lui-même les messages au-delà de max_history_length
         self.messages.append(message)
-        
-        # Limiter la taille de l'historique
-        if len(self.messages) > self.config.max_history_length:
-            self.messages = self.messages[-self.config.max_history_length:]
-    
+        self.total_messages += 1
+        if self.store is not None:
+            self.store.add_message(self.total_messages - 1, message)
+
+        self._ensure_writer()
+        self._queue.put(("append", (self.journal_path, _serialize_message(message))))
+
+    def flush(self) -> None:
+        """Attend que les messages en attente soient écrits et synchronisés sur disque"""
+        if self._writer is None or not self._writer.is_alive():
+            return
+        done = threading.Event()
+        self._queue.put(("flush", done))
+        done.wait()
+
+    def close(self) -> None:
+        """Synchronise le journal et arrête le thread d'écriture"""
+        if self._writer is None or not self._writer.is_alive():
+            return
+        done = threading.Event()
+        self._queue.put(("stop", done))
+        done.wait()
+        self._writer = None
+
+    def _read_from_journal(self, start: int, stop: int) -> Iterator[ChatMessage]:
+        """Lit les messages [start, stop) du journal à partir de l'index des positions"""
+        self.flush()
+        with self._lock:
+            offsets = self._offsets[start:stop]
+        if not offsets:
+            return
+        with open(self.journal_path, "rb") as f:
+            f.seek(offsets[0])
+            for _ in offsets:
+                yield _deserialize_message(f.readline())
+
+    def get_message(self, index: int) -> ChatMessage:
+        """Accès direct au message d'index donné (mémoire, sinon journal)"""
+        if index < 0:
+            index += self.total_messages
+        if not 0 <= index < self.total_messages:
+            raise IndexError("Index de message hors de l'historique")
+
+        first_in_memory = self.total_messages - len(self.messages)
+        if index >= first_in_memory:
+            return self.messages[index - first_in_memory]
+        return next(self._read_from_journal(index, index + 1))
+
     def get_messages(self, limit: Optional[int] = None) -> List[ChatMessage]:
-        """Retourne les messages (optionnellement limités)"""
-        if limit:
-            return self.messages[-limit:]
-        return self.messages.copy()
-    
+        """Retourne les messages (optionnellement limités), relus sur disque au-delà du tampon"""
+        if not limit:
+            return list(self.messages)
+        if limit <= len(self.messages):
+            return list(self.messages)[-limit:]
+
+        start = max(self.total_messages - limit, 0)
+        first_in_memory = self.total_messages - len(self.messages)
+        return list(self._read_from_journal(start, first_in_memory)) + list(self.messages)
+
     def clear(self) -> None:
-        """Efface l'historique"""
+        """Efface l'historique et démarre un nouveau journal (l'ancien reste sur disque)"""
+        self.flush()
         self.messages.clear()
-    
+        self.total_messages = 0
+        with self._lock:
+            self._offsets = []
+        self.journal_path = self._new_journal_path()
+        if self.store is not None:
+            self.store.start_session(self.journal_path)
+
     def format_for_display(self, limit: Optional[int] = None) -> str:
         """Formate l'historique pour affichage"""
-        messages = self.get_messages(limit)
-        
+        if self.store is not None:
+            messages = self.store.get_messages(limit or self.config.max_history_length)
+        else:
+            messages = self.get_messages(limit)
+
         if not messages:
             return "📋 Aucun message dans l'historique."
-        
+
         lines = ["📚 Historique de conversation:", "=" * 50]
-        
+
         for i, message in enumerate(messages, 1):
             lines.append(f"\n{i}. {message.format_for_display()}")
-        
+
         return "\n".join(lines)
-    
+
     def save_to_file(self, filename: Optional[str] = None) -> str:
-        """Sauvegarde l'historique dans un fichier"""
-        if not filename:
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"conversation_{timestamp}.json"
-        
-        file_path = self.config.history_dir / filename
-        
+        """Synchronise le journal et, si un nom est donné, en exporte une copie"""
         try:
-            # Préparer les données pour la sérialisation
-            data = {
-                "timestamp": datetime.now().isoformat(),
-                "messages": [
-                    {
-                        "role": msg.role.value,
-                        "content": msg.content,
-                        "timestamp": msg.timestamp.isoformat(),
-                        "files": msg.files
-                    }
-                    for msg in self.messages
-                ]
-            }
-            
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
-            
+            self.flush()
+            if not self.total_messages:
+                return "📋 Aucun message à sauvegarder."
+
+            if not filename:
+                return f"✅ Historique sauvegardé dans {self.journal_path}"
+
+            if not filename.endswith(".jsonl"):
+                filename = f"{Path(filename).stem}.jsonl"
+            file_path = self.config.history_dir / filename
+            shutil.copyfile(self.journal_path, file_path)
+
             return f"✅ Historique sauvegardé dans {file_path}"
-            
+
         except Exception as e:
             return f"❌ Erreur lors de la sauvegarde: {e}"
-    
+
     def load_from_file(self, file_path: Path) -> str:
-        """Charge l'historique depuis un fichier"""
+        """
+        Charge l'historique depuis un fichier et reprend la conversation.
+        Journal JSONL : seul l'index des positions est construit, les derniers messages
+        sont chargés en mémoire et les suivants sont ajoutés à ce journal.
+        Ancien format JSON : les messages sont importés dans un nouveau journal.
+        """
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            self.messages.clear()
-            
-            for msg_data in data.get("messages", []):
-                message = ChatMessage(
-                    role=MessageRole(msg_data["role"]),
-                    content=msg_data["content"],
-                    timestamp=datetime.fromisoformat(msg_data["timestamp"]),
-                    files=msg_data.get("files", [])
-                )
-                self.messages.append(message)
-            
+            file_path = Path(file_path)
+            self.flush()
+
+            if file_path.suffix != ".jsonl":
+                with open(file_path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                self.clear()
+                for msg_data in data.get("messages", []):
+                    self._append(_deserialize_message(msg_data))
+                return f"✅ Historique chargé depuis {file_path}"
+
+            # Indexer les lignes complètes ; une dernière ligne tronquée (arrêt brutal) est écartée
+            offsets = []
+            position = 0
+            with open(file_path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    offsets.append(position)
+                    position += len(line)
+            if position != file_path.stat().st_size:
+                with open(file_path, "r+b") as f:
+                    f.truncate(position)
+
+            recent = deque(maxlen=self.config.max_history_length)
+            with open(file_path, "rb") as f:
+                f.seek(offsets[-recent.maxlen] if len(offsets) > recent.maxlen else 0)
+                for line in f:
+                    recent.append(_deserialize_message(line))
+
+            self.messages = recent
+            self.total_messages = len(offsets)
+            with self._lock:
+                self._offsets = offsets
+            self.journal_path = file_path
+
+            # Reprendre la session en base (import du journal s'il n'y est pas encore)
+            if self.store is not None:
+                self.store.open_session(file_path, self._read_from_journal(0, len(offsets)))
+
             return f"✅ Historique chargé depuis {file_path}"
-            
+
         except Exception as e:
-            return f"❌ Erreur lors du chargement: {e}"
\ No newline at end of file
+            return f"❌ Erreur lors du chargement: {e}"
@@ -0,0 +1,354 @@
+"""Mesures de latence des fournisseurs (TTFT, intervalles entre tokens, recherches) au format Prometheus"""
+
+import os
+import sys
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+
+# Bornes des histogrammes (secondes), des intervalles entre tokens aux réponses longues
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+HISTOGRAMS = {
+    "llm_ttft_seconds": "Délai avant le premier token",
+    "llm_inter_token_seconds": "Intervalle entre deux fragments de texte",
+    "llm_response_seconds": "Durée totale de la réponse (stream ou requête)",
+    "llm_tool_call_seconds": "Durée d'exécution d'un outil local",
+    "llm_search_seconds": "Durée d'une recherche web",
+}
+
+COUNTERS = {
+    "llm_requests_total": "Réponses reçues, par statut",
+    "llm_retries_total": "Nouvelles tentatives après une réponse 429 ou 5xx",
+    "llm_received_bytes_total": "Octets de réponse reçus",
+}
+
+# Seuils d'alerte sur le p95 (secondes), évalués par fournisseur et modèle
+DEFAULT_ALERT_RULES = {
+    "llm_ttft_seconds": 5.0,
+    "llm_inter_token_seconds": 0.5,
+    "llm_response_seconds": 60.0,
+    "llm_search_seconds": 15.0,
+}
+
+# Statuts HTTP que les SDK retentent d'eux-mêmes
+RETRIED_STATUSES = {408, 409, 429, 500, 502, 503, 504, 529}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    escaped = (
+        name + '="' + value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+        for name, value in pairs
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Percentile au rang le plus proche"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(int(round(pct / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+class Histogram:
+    """Histogramme cumulatif à bornes fixes, avec une fenêtre des dernières valeurs pour les percentiles"""
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, window: int = 500):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.recent: Deque[float] = deque(maxlen=window)
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+
+
+@dataclass
+class LatencyAlert:
+    """Dépassement du seuil de p95 d'une mesure"""
+    metric: str
+    labels: Dict[str, str]
+    p95: float
+    threshold: float
+    samples: int
+
+    def message(self) -> str:
+        where = ", ".join(f"{name}={value}" for name, value in self.labels.items())
+        return (f"{self.metric} p95={self.p95 * 1000:.0f} ms > seuil {self.threshold * 1000:.0f} ms "
+                f"({where}, {self.samples} mesures)")
+
+
+class StreamTimer:
+    """
+    Chronomètre d'une réponse : TTFT et intervalles entre fragments, octets reçus,
+    recherches web et outils locaux. Appeler finish() à la fin (ou en cas d'erreur).
+    """
+
+    def __init__(self, registry: "MetricsRegistry", provider: str, model: str):
+        self.registry = registry
+        self.labels = {"provider": provider, "model": model}
+        self.started = time.perf_counter()
+        self.first_token: Optional[float] = None
+        self._last_token: Optional[float] = None
+        self._search_started: Optional[float] = None
+        self.received_bytes = 0
+        self.finished = False
+
+    def on_bytes(self, count: int) -> None:
+        """Octets reçus (lignes SSE brutes, ou tout ce qui n'est pas passé à on_delta)"""
+        self.received_bytes += count
+
+    def on_delta(self, size: int = 0) -> None:
+        """Fragment de texte reçu (size : octets à compter, 0 s'ils le sont déjà par on_bytes)"""
+        now = time.perf_counter()
+        if self._last_token is None:
+            self.first_token = now
+            self.registry.observe("llm_ttft_seconds", now - self.started, **self.labels)
+        else:
+            self.registry.observe("llm_inter_token_seconds", now - self._last_token, **self.labels)
+        self._last_token = now
+        self.received_bytes += size
+
+    def search_started(self) -> None:
+        self._search_started = time.perf_counter()
+
+    def search_finished(self) -> None:
+        if self._search_started is not None:
+            self.registry.observe("llm_search_seconds", time.perf_counter() - self._search_started, **self.labels)
+            self._search_started = None
+        # Le texte qui suit une recherche ne compte pas comme un intervalle entre tokens
+        self._last_token = None if self.first_token is None else time.perf_counter()
+
+    @contextmanager
+    def tool_call(self, tool: str) -> Iterator[None]:
+        """Mesure l'exécution d'un outil local (la recherche Perplexity compte aussi comme recherche)"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.registry.observe("llm_tool_call_seconds", elapsed, tool=tool, **self.labels)
+            if "search" in tool or "perplexity" in tool:
+                self.registry.observe("llm_search_seconds", elapsed, **self.labels)
+            if self._last_token is not None:
+                self._last_token = time.perf_counter()
+
+    def retry(self) -> None:
+        self.registry.inc("llm_retries_total", **self.labels)
+
+    def finish(self, error: bool = False) -> None:
+        """Enregistre la durée totale, les octets reçus et le statut (une seule fois)"""
+        if self.finished:
+            return
+        self.finished = True
+        self.registry.observe("llm_response_seconds", time.perf_counter() - self.started, **self.labels)
+        self.registry.inc("llm_received_bytes_total", self.received_bytes, **self.labels)
+        self.registry.inc("llm_requests_total", status="error" if error else "ok", **self.labels)
+        self.registry.response_finished(self.labels)
+
+
+class MetricsRegistry:
+    """
+    Registre en mémoire des histogrammes et compteurs, étiquetés par fournisseur et modèle.
+
+    Exposition au format texte Prometheus : render_prometheus(), write_prometheus(path)
+    ou serve(port) (endpoint /metrics). Après chaque réponse, le p95 des mesures ayant
+    un seuil (alert_rules) est comparé au seuil ; un dépassement est signalé une fois
+    sur stderr et reste dans active_alerts tant que le p95 ne repasse pas sous le seuil.
+    """
+
+    def __init__(
+        self,
+        alert_rules: Optional[Dict[str, float]] = None,
+        min_alert_samples: int = 20,
+        window: int = 500,
+        export_path: Optional[Path] = None,
+        export_interval: float = 5.0
+    ):
+        self.alert_rules = dict(DEFAULT_ALERT_RULES if alert_rules is None else alert_rules)
+        self.min_alert_samples = min_alert_samples
+        self.window = window
+        self.export_path = Path(export_path) if export_path else None
+        self.export_interval = export_interval
+        self.active_alerts: Dict[Tuple[str, Labels], LatencyAlert] = {}
+        self._histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._last_export = 0.0
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._lock = threading.Lock()
+
+    def stream(self, provider: str, model: str) -> StreamTimer:
+        """Nouveau chronomètre de réponse"""
+        return StreamTimer(self, provider, model)
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            key = _labels(labels)
+            if key not in series:
+                series[key] = Histogram(window=self.window)
+            series[key].observe(value)
+
+    def inc(self, name: str, amount: float = 1, **labels: str) -> None:
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            key = _labels(labels)
+            series[key] = series.get(key, 0) + amount
+
+    def retry_hook(self, provider: str, model: str) -> Callable:
+        """Hook de réponse httpx qui compte les réponses que le SDK va retenter"""
+        def hook(response) -> None:
+            if response.status_code in RETRIED_STATUSES:
+                self.inc("llm_retries_total", provider=provider, model=model)
+        return hook
+
+    def percentile(self, name: str, pct: float, **labels: str) -> float:
+        """Percentile des dernières valeurs d'une série"""
+        with self._lock:
+            histogram = self._histograms.get(name, {}).get(_labels(labels))
+            return percentile(list(histogram.recent), pct) if histogram else 0.0
+
+    def check_alerts(self, labels: Optional[Dict[str, str]] = None) -> List[LatencyAlert]:
+        """Évalue les seuils de p95 (d'une série ou de toutes) et retourne les nouveaux dépassements"""
+        new_alerts = []
+        with self._lock:
+            for metric, threshold in self.alert_rules.items():
+                for key, histogram in self._histograms.get(metric, {}).items():
+                    if labels is not None and key != _labels(labels):
+                        continue
+                    if len(histogram.recent) < self.min_alert_samples:
+                        continue
+                    p95 = percentile(list(histogram.recent), 95)
+                    if p95 > threshold:
+                        if (metric, key) not in self.active_alerts:
+                            alert = LatencyAlert(metric, dict(key), p95, threshold, len(histogram.recent))
+                            self.active_alerts[(metric, key)] = alert
+                            new_alerts.append(alert)
+                        else:
+                            self.active_alerts[(metric, key)].p95 = p95
+                    else:
+                        self.active_alerts.pop((metric, key), None)
+        return new_alerts
+
+    def response_finished(self, labels: Dict[str, str]) -> None:
+        """Alertes et export périodique après chaque réponse"""
+        for alert in self.check_alerts(labels):
+            print(f"AVERTISSEMENT: Régression de latence: {alert.message()}", file=sys.stderr)
+        if self.export_path and time.monotonic() - self._last_export >= self.export_interval:
+            self._last_export = time.monotonic()
+            try:
+                self.write_prometheus(self.export_path)
+            except OSError as e:
+                print(f"AVERTISSEMENT: Export des métriques impossible: {e}", file=sys.stderr)
+
+    def render_prometheus(self) -> str:
+        """Métriques au format texte d'exposition Prometheus"""
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._histograms.items()):
+                lines.append(f"# HELP {name} {HISTOGRAMS.get(name, name)}")
+                lines.append(f"# TYPE {name} histogram")
+                for key, histogram in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_format_labels(key, ('le', f'{bound:g}'))} {cumulative}")
+                    lines.append(f"{name}_bucket{_format_labels(key, ('le', '+Inf'))} {histogram.count}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {histogram.sum:.6f}")
+                    lines.append(f"{name}_count{_format_labels(key)} {histogram.count}")
+
+            for name, series in sorted(self._counters.items()):
+                lines.append(f"# HELP {name} {COUNTERS.get(name, name)}")
+                lines.append(f"# TYPE {name} counter")
+                for key, value in sorted(series.items()):
+                    lines.append(f"{name}{_format_labels(key)} {value:g}")
+
+            lines.append("# HELP llm_latency_alert Seuil de p95 dépassé (1) ou non (0)")
+            lines.append("# TYPE llm_latency_alert gauge")
+            for metric in sorted(self.alert_rules):
+                for key in sorted(self._histograms.get(metric, {})):
+                    active = int((metric, key) in self.active_alerts)
+                    lines.append(f"llm_latency_alert{_format_labels(key, ('metric', metric))} {active}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: Path) -> None:
+        """Écrit les métriques dans un fichier (pour le textfile collector de node_exporter)"""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(path.suffix + ".tmp")
+        tmp_path.write_text(self.render_prometheus(), encoding="utf-8")
+        tmp_path.replace(path)
+
+    def serve(self, port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+        """Démarre l'endpoint /metrics dans un thread (une seule fois)"""
+        if self._server is not None:
+            return self._server
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):  # noqa: A002 - signature de BaseHTTPRequestHandler
+                pass
+
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                data = registry.render_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="metrics-endpoint", daemon=True).start()
+        return self._server
+
+
+_registry: Optional[MetricsRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def get_registry() -> MetricsRegistry:
+    """
+    Registre partagé du processus (survit aux reruns Streamlit).
+    METRICS_FILE : fichier Prometheus réécrit après les réponses (au plus toutes les 5 s)
+    METRICS_PORT : port de l'endpoint /metrics
+    """
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            export_path = os.getenv("METRICS_FILE")
+            _registry = MetricsRegistry(export_path=Path(export_path) if export_path else None)
+            port = os.getenv("METRICS_PORT")
+            if port:
+                try:
+                    _registry.serve(int(port))
+                except (OSError, ValueError) as e:
+                    print(f"AVERTISSEMENT: Endpoint des métriques indisponible: {e}", file=sys.stderr)
+        return _registry
@@ -0,0 +1,183 @@
+"""Index local de similarité entre requêtes (n-grammes de caractères hachés, TF-IDF)"""
+
+import re
+import sys
+import json
+import zlib
+import unicodedata
+from pathlib import Path
+from typing import Optional, List, Tuple
+
+import numpy as np
+
+
+# Abréviations juridiques courantes, développées avant comparaison
+LEGAL_ABBREVIATIONS = [
+    (r"\bc\.?\s*trav\b\.?", "code du travail"),
+    (r"\bc\.?\s*civ\b\.?", "code civil"),
+    (r"\bc\.?\s*com\b\.?", "code de commerce"),
+    (r"\bc\.?\s*pen\b\.?", "code penal"),
+    (r"\bcss\b", "code de la securite sociale"),
+    (r"\bcgi\b", "code general des impots"),
+    (r"\bart\b\.?", "article"),
+]
+
+STOPWORDS = {
+    "a", "au", "aux", "ce", "ces", "d", "de", "des", "dit", "du", "en", "est", "et", "l", "la",
+    "le", "les", "qu", "que", "quel", "quelle", "quels", "quelles", "quoi", "selon", "sur",
+    "un", "une", "dans", "pour", "par", "me", "moi", "peux", "tu", "dire", "explique"
+}
+
+
+def normalize_for_similarity(query: str) -> str:
+    """Normalisation agressive : accents, abréviations, références d'articles, mots vides"""
+    text = unicodedata.normalize("NFKD", query.casefold())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    for pattern, replacement in LEGAL_ABBREVIATIONS:
+        text = re.sub(pattern, replacement, text)
+    # "L.1234-5", "l 1234-5" -> "l1234-5"
+    text = re.sub(r"\b([lrd])\.?\s*(\d+(?:-\d+)*)", r"\1\2", text)
+    # Ponctuation -> espaces, en gardant les tirets internes aux références
+    text = re.sub(r"(?<!\d)-|-(?!\d)", " ", text)
+    text = re.sub(r"[^\w\s-]", " ", text)
+    return " ".join(word for word in text.split() if word not in STOPWORDS)
+
+
+def extract_references(normalized_query: str) -> frozenset:
+    """Références numériques (articles, années...) qui doivent être identiques pour un rapprochement"""
+    return frozenset(re.findall(r"\b[a-z]?\d+(?:-\d+)*\b", normalized_query))
+
+
+class QueryIndex:
+    """
+    Index en mémoire des requêtes déjà servies, pour retrouver une paraphrase.
+
+    Chaque requête est représentée par un vecteur de n-grammes de caractères hachés
+    pondéré TF-IDF ; deux requêtes ne sont rapprochées que si elles partagent le même
+    périmètre (modèle, domaines, prompt) et exactement les mêmes références numériques.
+    """
+
+    def __init__(self, threshold: float, dim: int = 2 ** 12, ngram_range: Tuple[int, int] = (3, 5)):
+        self.threshold = threshold
+        self.dim = dim
+        self.ngram_range = ngram_range
+        self._keys: List[str] = []
+        self._scopes: List[str] = []
+        self._references: List[frozenset] = []
+        self._tf = np.zeros((0, dim), dtype=np.float32)
+        self._df = np.zeros(dim, dtype=np.float32)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def _vectorize(self, normalized_query: str) -> np.ndarray:
+        """Vecteur TF (sous-linéaire) des n-grammes de caractères hachés"""
+        vector = np.zeros(self.dim, dtype=np.float32)
+        padded = f" {normalized_query} "
+        for n in range(self.ngram_range[0], self.ngram_range[1] + 1):
+            for i in range(len(padded) - n + 1):
+                vector[zlib.crc32(padded[i:i + n].encode("utf-8")) % self.dim] += 1.0
+        nonzero = vector > 0
+        vector[nonzero] = 1.0 + np.log(vector[nonzero])
+        return vector
+
+    def add(self, key: str, query: str, scope: str) -> None:
+        """Ajoute (ou remplace) une requête indexée sous la clé de cache `key`"""
+        self.remove(key)
+        normalized = normalize_for_similarity(query)
+        vector = self._vectorize(normalized)
+        self._keys.append(key)
+        self._scopes.append(scope)
+        self._references.append(extract_references(normalized))
+        self._tf = np.vstack([self._tf, vector])
+        self._df += vector > 0
+
+    def remove(self, key: str) -> None:
+        """Retire une requête de l'index (entrée expirée ou évincée)"""
+        if key not in self._keys:
+            return
+        index = self._keys.index(key)
+        self._df -= self._tf[index] > 0
+        self._tf = np.delete(self._tf, index, axis=0)
+        del self._keys[index]
+        del self._scopes[index]
+        del self._references[index]
+
+    def find(self, query: str, scope: str) -> Optional[Tuple[str, float]]:
+        """Retourne (clé, similarité) de la requête indexée la plus proche au-dessus du seuil"""
+        if not self._keys:
+            return None
+
+        normalized = normalize_for_similarity(query)
+        references = extract_references(normalized)
+        candidates = [
+            i for i in range(len(self._keys))
+            if self._scopes[i] == scope and self._references[i] == references
+        ]
+        if not candidates:
+            return None
+
+        idf = np.log((1.0 + len(self._keys)) / (1.0 + self._df)) + 1.0
+        query_vector = self._vectorize(normalized) * idf
+        matrix = self._tf[candidates] * idf
+
+        norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(query_vector)
+        norms[norms == 0] = 1.0
+        similarities = (matrix @ query_vector) / norms
+
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.threshold:
+            return None
+        return self._keys[candidates[best]], float(similarities[best])
+
+
+def replay_query_log(log_path: Path, threshold: float) -> dict:
+    """
+    Rejoue un journal de requêtes (JSONL, champs "query" et "scope") et compare le taux
+    de hit d'un cache exact à celui d'un cache avec rapprochement sémantique.
+    Chaque requête manquée est supposée mise en cache ensuite.
+    """
+    from .search_cache import normalize_query
+
+    exact_seen = set()
+    index = QueryIndex(threshold)
+    total = exact_hits = semantic_hits = 0
+
+    with open(log_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            query, scope = entry["query"], entry.get("scope", "")
+            total += 1
+
+            exact_key = (scope, normalize_query(query))
+            if exact_key in exact_seen:
+                exact_hits += 1
+                semantic_hits += 1
+                continue
+
+            if index.find(query, scope):
+                semantic_hits += 1
+            else:
+                index.add(f"{scope}:{query}", query, scope)
+            exact_seen.add(exact_key)
+
+    return {
+        "queries": total,
+        "exact_hit_rate": exact_hits / total if total else 0.0,
+        "semantic_hit_rate": semantic_hits / total if total else 0.0
+    }
+
+
+if __name__ == "__main__":
+    # Usage : python -m src.utils.query_index data/cache/query_log.jsonl [seuil]
+    # Seuil par défaut : celui du cache (perplexity_cache_similarity_threshold)
+    from .config import Config
+
+    log_file = Path(sys.argv[1]) if len(sys.argv) > 1 else Path("data/cache/query_log.jsonl")
+    threshold_arg = float(sys.argv[2]) if len(sys.argv) > 2 else Config().perplexity_cache_similarity_threshold
+    report = replay_query_log(log_file, threshold_arg)
+    print(f"Requêtes rejouées : {report['queries']}")
+    print(f"Taux de hit exact : {report['exact_hit_rate']:.1%}")
+    print(f"Taux de hit avec rapprochement (seuil {threshold_arg}) : {report['semantic_hit_rate']:.1%}")
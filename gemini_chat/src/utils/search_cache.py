@@ -0,0 +1,209 @@
+"""Cache disque des recherches Perplexity (TTL + éviction LRU + rapprochement sémantique)"""
+
+import os
+import json
+import hashlib
+import sqlite3
+import threading
+import time
+import unicodedata
+from pathlib import Path
+from typing import Optional, List
+
+from ..models.citation import SearchResult
+from .query_index import QueryIndex
+
+
+def normalize_query(query: str) -> str:
+    """Normalise une requête pour la clé de cache (casse, espaces, ponctuation finale)"""
+    query = unicodedata.normalize("NFKC", query).casefold()
+    query = " ".join(query.split())
+    return query.rstrip(" ?!.;:")
+
+
+class SearchCache:
+    """
+    Cache persistant des SearchResult, stocké dans une base SQLite locale.
+
+    Les entrées expirent après `ttl` secondes et les moins récemment utilisées
+    sont évincées au-delà de `max_entries`. Si `semantic_threshold` est fourni,
+    une requête absente du cache peut être servie par une paraphrase déjà en
+    cache dans le même périmètre (voir QueryIndex). Le journal des requêtes
+    n'est tenu que si `query_log_path` est fourni, et renouvelé au-delà de
+    `query_log_max_bytes`.
+    """
+
+    def __init__(
+        self,
+        db_path: Path,
+        ttl: float,
+        max_entries: int,
+        semantic_threshold: Optional[float] = None,
+        query_log_path: Optional[Path] = None,
+        query_log_max_bytes: Optional[int] = None
+    ):
+        self.db_path = Path(db_path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.query_log_path = Path(query_log_path) if query_log_path else None
+        self.query_log_max_bytes = query_log_max_bytes
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS search_cache ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " last_access REAL NOT NULL)"
+        )
+        # Colonnes ajoutées pour l'index sémantique (bases créées avant leur ajout)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(search_cache)")}
+        for column in ("query", "scope"):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE search_cache ADD COLUMN {column} TEXT NOT NULL DEFAULT ''")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_search_cache_access ON search_cache(last_access)")
+        self._conn.commit()
+
+        self.index: Optional[QueryIndex] = None
+        if semantic_threshold is not None:
+            self.index = QueryIndex(semantic_threshold)
+            rows = self._conn.execute(
+                "SELECT key, query, scope FROM search_cache WHERE created_at >= ? AND query != ''",
+                (time.time() - self.ttl,)
+            ).fetchall()
+            for key, query, scope in rows:
+                self.index.add(key, query, scope)
+
+    @staticmethod
+    def make_scope(
+        model: str, allowed_domains: List[str], system_prompt: str, search_context_size: str = "medium"
+    ) -> str:
+        """Périmètre d'une recherche : modèle, domaines autorisés, prompt système et taille du contexte de recherche"""
+        raw = json.dumps(
+            [model, sorted(allowed_domains or []), system_prompt, search_context_size], ensure_ascii=False
+        )
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def make_key(query: str, scope: str) -> str:
+        """Clé exacte : périmètre et requête normalisée"""
+        raw = f"{scope}\n{normalize_query(query)}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _get(self, key: str, now: float) -> Optional[SearchResult]:
+        """Lit une entrée non expirée et met à jour son dernier accès (verrou tenu)"""
+        row = self._conn.execute(
+            "SELECT value, created_at FROM search_cache WHERE key = ?", (key,)
+        ).fetchone()
+
+        if row is None or now - row[1] > self.ttl:
+            if row is not None:
+                self._conn.execute("DELETE FROM search_cache WHERE key = ?", (key,))
+                self._conn.commit()
+            if self.index is not None:
+                self.index.remove(key)
+            return None
+
+        self._conn.execute("UPDATE search_cache SET last_access = ? WHERE key = ?", (now, key))
+        self._conn.commit()
+        return SearchResult.from_dict(json.loads(row[0]))
+
+    def _log_query(self, query: str, scope: str, outcome: str) -> None:
+        """Enregistre la requête dans le journal (rejouable avec query_index.replay_query_log)"""
+        if not self.query_log_path:
+            return
+        entry = {"timestamp": time.time(), "query": query, "scope": scope, "outcome": outcome}
+        # Taille plafonnée : le journal plein devient l'archive .1 (une seule archive gardée)
+        if (
+            self.query_log_max_bytes is not None
+            and self.query_log_path.exists()
+            and self.query_log_path.stat().st_size >= self.query_log_max_bytes
+        ):
+            os.replace(self.query_log_path, self.query_log_path.with_name(self.query_log_path.name + ".1"))
+        with open(self.query_log_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def lookup(self, query: str, scope: str) -> Optional[SearchResult]:
+        """Retourne le résultat en cache pour la requête (exact puis paraphrase), ou None"""
+        now = time.time()
+        with self._lock:
+            result = self._get(self.make_key(query, scope), now)
+            outcome = "hit"
+
+            if result is None and self.index is not None:
+                match = self.index.find(query, scope)
+                if match is not None:
+                    result = self._get(match[0], now)
+                    outcome = "semantic_hit"
+
+            if result is None:
+                self.misses += 1
+                outcome = "miss"
+            elif outcome == "hit":
+                self.hits += 1
+            else:
+                self.semantic_hits += 1
+
+            self._log_query(query, scope, outcome)
+
+        return result
+
+    def store(self, query: str, scope: str, result: SearchResult) -> None:
+        """Enregistre un résultat et évince les entrées expirées ou les moins récemment utilisées"""
+        now = time.time()
+        key = self.make_key(query, scope)
+        value = json.dumps(result.to_dict(), ensure_ascii=False)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO search_cache (key, value, created_at, last_access, query, scope) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, value, now, now, query, scope)
+            )
+            evicted = self._conn.execute(
+                "SELECT key FROM search_cache WHERE created_at < ? OR key NOT IN "
+                "(SELECT key FROM search_cache ORDER BY last_access DESC LIMIT ?)",
+                (now - self.ttl, self.max_entries)
+            ).fetchall()
+            self._conn.executemany("DELETE FROM search_cache WHERE key = ?", evicted)
+            self._conn.commit()
+
+            if self.index is not None:
+                self.index.add(key, query, scope)
+                for (evicted_key,) in evicted:
+                    self.index.remove(evicted_key)
+
+    def clear(self) -> None:
+        """Vide le cache et remet les compteurs à zéro"""
+        with self._lock:
+            self._conn.execute("DELETE FROM search_cache")
+            self._conn.commit()
+            if self.index is not None:
+                self.index = QueryIndex(self.index.threshold)
+            self.hits = 0
+            self.semantic_hits = 0
+            self.misses = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM search_cache").fetchone()[0]
+
+    def get_stats(self) -> dict:
+        """Retourne les compteurs du cache"""
+        total_hits = self.hits + self.semantic_hits
+        lookups = total_hits + self.misses
+        return {
+            "hits": total_hits,
+            "exact_hits": self.hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": total_hits / lookups if lookups else 0.0,
+            "entries": len(self)
+        }
+
+    def close(self) -> None:
+        """Ferme la base du cache"""
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,78 @@
+"""Profondeur de recherche adaptée à la question (classification locale, sans appel au modèle)"""
+
+import re
+from dataclasses import dataclass
+from typing import Dict
+
+from .query_index import normalize_for_similarity
+
+
+@dataclass(frozen=True)
+class SearchProfile:
+    """Paramètres de recherche d'une classe de questions"""
+    name: str
+    label: str
+    search_context_size: str  # web_search_options Perplexity : "low", "medium" ou "high"
+    perplexity_model: str
+    max_tokens: int           # sortie Perplexity
+    max_uses: int             # recherches de l'outil web_search de Claude
+
+
+ARTICLE_LOOKUP = "article"
+PROCEDURE = "procedure"
+CASE_LAW = "jurisprudence"
+
+SEARCH_PROFILES: Dict[str, SearchProfile] = {
+    ARTICLE_LOOKUP: SearchProfile(ARTICLE_LOOKUP, "Recherche d'un texte", "low", "sonar", 1000, 1),
+    PROCEDURE: SearchProfile(PROCEDURE, "Question de procédure", "medium", "sonar", 2000, 2),
+    CASE_LAW: SearchProfile(CASE_LAW, "Question ouverte / jurisprudence", "high", "sonar-pro", 4000, 5),
+}
+
+# Les indices portent sur le texte normalisé (sans accents ni mots vides, abréviations
+# développées, références "L.1234-5" écrites "l1234-5") : voir normalize_for_similarity()
+TEXT_REFERENCE = re.compile(
+    r"\barticles?\s+(?:[lrd]?\d+|premier|preliminaire)"
+    r"|\b[lrd]\d+(?:-\d+)+\b"
+    r"|\b(?:loi|decret|ordonnance|arrete)\s+(?:n\s+)?\d"
+)
+CASE_LAW_CUES = re.compile(
+    r"\b(?:jurisprudences?|cassation|arrets?|conseil etat|cour appel|cours appel|revirements?"
+    r"|doctrines?|etat droit|interpretations?|portee|contentieux|juges?|jurisprudentiel\w*"
+    r"|responsabilite|faute|prejudice|validite|nullite|abusi\w+|contester|conteste)\b"
+)
+PROCEDURE_CUES = re.compile(
+    r"\b(?:procedures?|demarches?|delais?|comment|etapes?|formulaires?|cerfa|formalites?"
+    r"|justificatifs?|fournir|saisir|deposer|declarer|declaration|inscription|immatriculation"
+    r"|preavis|combien|demande|demander|recours|renouveler|renouvellement|obtenir|frais)\b"
+)
+
+# Sans indice, une entrée de cette longueur n'est pas une question juridique (salutation, remerciement)
+SMALL_TALK_MAX_WORDS = 3
+# Au-delà, la question décrit une situation : elle relève d'une analyse complète
+ARTICLE_LOOKUP_MAX_WORDS = 12
+PROCEDURE_MAX_WORDS = 30
+
+
+def classify_query(query: str) -> str:
+    """
+    Classe d'une question : ARTICLE_LOOKUP (consultation d'un texte précis), PROCEDURE
+    (démarche, délai, formalité) ou CASE_LAW (question ouverte).
+    Une entrée vide ou très courte sans indice ("Bonjour", "merci") prend le profil le moins
+    coûteux ; au-delà, dans le doute, la classe la plus complète (et la plus chère) est retenue.
+    """
+    text = normalize_for_similarity(query)
+    words = len(text.split())
+    if CASE_LAW_CUES.search(text):
+        return CASE_LAW
+    procedure = PROCEDURE_CUES.search(text) is not None
+    reference = TEXT_REFERENCE.search(text) is not None and words <= ARTICLE_LOOKUP_MAX_WORDS
+    if not procedure and (reference or words <= SMALL_TALK_MAX_WORDS):
+        return ARTICLE_LOOKUP
+    if procedure and words <= PROCEDURE_MAX_WORDS:
+        return PROCEDURE
+    return CASE_LAW
+
+
+def get_search_profile(query: str) -> SearchProfile:
+    """Profil de recherche adapté à la question"""
+    return SEARCH_PROFILES[classify_query(query)]
@@ -0,0 +1,325 @@
+"""Base SQLite locale des conversations : sessions, messages, recherches, citations et usage"""
+
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from pathlib import Path
+from typing import List, Optional, Tuple, Any
+from datetime import datetime
+
+from ..models.message import ChatMessage, MessageRole
+from ..models.citation import Citation, SearchResult
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started_at REAL NOT NULL,
+    journal_path TEXT UNIQUE
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    files TEXT NOT NULL DEFAULT '[]'
+);
+CREATE INDEX IF NOT EXISTS idx_messages_session ON messages(session_id, seq);
+CREATE TABLE IF NOT EXISTS search_results (
+    id TEXT PRIMARY KEY,
+    session_id INTEGER NOT NULL,
+    query TEXT NOT NULL,
+    content TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    input_tokens INTEGER NOT NULL DEFAULT 0,
+    output_tokens INTEGER NOT NULL DEFAULT 0,
+    total_tokens INTEGER NOT NULL DEFAULT 0,
+    total_cost REAL NOT NULL DEFAULT 0,
+    cached INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_search_results_session ON search_results(session_id, timestamp);
+CREATE TABLE IF NOT EXISTS citations (
+    search_id TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    title TEXT NOT NULL DEFAULT '',
+    url TEXT NOT NULL DEFAULT '',
+    snippet TEXT NOT NULL DEFAULT '',
+    source TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS idx_citations_search ON citations(search_id, number);
+CREATE INDEX IF NOT EXISTS idx_citations_url ON citations(url);
+CREATE TABLE IF NOT EXISTS usage (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id INTEGER NOT NULL,
+    timestamp REAL NOT NULL,
+    provider TEXT NOT NULL,
+    prompt_tokens INTEGER NOT NULL DEFAULT 0,
+    output_tokens INTEGER NOT NULL DEFAULT 0,
+    cached_tokens INTEGER NOT NULL DEFAULT 0,
+    cost REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_usage_session ON usage(session_id, provider);
+"""
+
+INSERTS = {
+    "messages": "INSERT INTO messages (session_id, seq, role, content, timestamp, files) VALUES (?, ?, ?, ?, ?, ?)",
+    "search_results": (
+        "INSERT OR REPLACE INTO search_results (id, session_id, query, content, timestamp, input_tokens, "
+        "output_tokens, total_tokens, total_cost, cached) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+    ),
+    "citations": "INSERT INTO citations (search_id, number, title, url, snippet, source) VALUES (?, ?, ?, ?, ?, ?)",
+    "usage": (
+        "INSERT INTO usage (session_id, timestamp, provider, prompt_tokens, output_tokens, cached_tokens, cost) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)"
+    ),
+}
+
+
+class ConversationStore:
+    """
+    Stockage local (hors ligne) de l'historique, des recherches et de l'usage.
+
+    La base est en mode WAL ; les écritures sont regroupées et insérées par lots
+    (executemany dans une transaction), au plus tard avant toute lecture.
+    Une instance suit une session courante, créée à la première écriture.
+    """
+
+    def __init__(self, db_path: Path, batch_size: int = 50, flush_interval: float = 2.0):
+        self.db_path = Path(db_path)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.session_id: Optional[int] = None
+        self._session_journal: Optional[str] = None
+        self._pending: List[Tuple[str, tuple]] = []
+        self._last_flush = time.monotonic()
+        self._lock = threading.RLock()
+
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+
+    # --- Sessions ---
+
+    def start_session(self, journal_path: Optional[Path] = None) -> None:
+        """Démarre une nouvelle session (créée en base à la première écriture)"""
+        with self._lock:
+            self.flush()
+            self.session_id = None
+            self._session_journal = str(journal_path) if journal_path else None
+
+    def _ensure_session(self) -> int:
+        """Identifiant de la session courante, créée si nécessaire (verrou tenu)"""
+        if self.session_id is None:
+            cursor = self._conn.execute(
+                "INSERT INTO sessions (started_at, journal_path) VALUES (?, ?)",
+                (time.time(), self._session_journal)
+            )
+            self._conn.commit()
+            self.session_id = cursor.lastrowid
+        return self.session_id
+
+    def open_session(self, journal_path: Path, messages: Optional[List[ChatMessage]] = None) -> bool:
+        """
+        Reprend la session associée à un journal ; si elle est inconnue, elle est créée
+        et `messages` (itérable, ex: lecture du journal) y est importé.
+        Retourne True si la session existait déjà.
+        """
+        with self._lock:
+            self.flush()
+            row = self._conn.execute(
+                "SELECT id FROM sessions WHERE journal_path = ?", (str(journal_path),)
+            ).fetchone()
+            if row is not None:
+                self.session_id = row[0]
+                self._session_journal = str(journal_path)
+                return True
+
+            self.start_session(journal_path)
+            for seq, message in enumerate(messages or []):
+                self.add_message(seq, message)
+            self.flush()
+            return False
+
+    def list_sessions(self, limit: int = 20) -> List[dict]:
+        """Dernières sessions avec nombre de messages et coût total (sous-requêtes indexées)"""
+        with self._lock:
+            self.flush()
+            rows = self._conn.execute(
+                "SELECT s.id, s.started_at, s.journal_path,"
+                " (SELECT COUNT(*) FROM messages m WHERE m.session_id = s.id),"
+                " (SELECT COALESCE(SUM(cost), 0) FROM usage u WHERE u.session_id = s.id),"
+                " (SELECT COALESCE(SUM(total_cost), 0) FROM search_results r WHERE r.session_id = s.id)"
+                " FROM sessions s ORDER BY s.id DESC LIMIT ?",
+                (limit,)
+            ).fetchall()
+        return [
+            {
+                "id": session_id,
+                "started_at": datetime.fromtimestamp(started_at),
+                "journal_path": journal_path,
+                "messages": message_count,
+                "cost": usage_cost + search_cost
+            }
+            for session_id, started_at, journal_path, message_count, usage_cost, search_cost in rows
+        ]
+
+    # --- Écritures groupées ---
+
+    def _queue(self, table: str, params: tuple) -> None:
+        """Ajoute une insertion au lot, écrit le lot s'il est plein ou ancien (verrou tenu)"""
+        self._pending.append((table, params))
+        if len(self._pending) >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        """Insère les écritures en attente dans une seule transaction"""
+        with self._lock:
+            self._last_flush = time.monotonic()
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, []
+            by_table: dict = {}
+            for table, params in pending:
+                by_table.setdefault(table, []).append(params)
+            with self._conn:
+                for table, rows in by_table.items():
+                    self._conn.executemany(INSERTS[table], rows)
+
+    def add_message(self, seq: int, message: ChatMessage) -> None:
+        """Enregistre un message de la session courante"""
+        with self._lock:
+            session_id = self._ensure_session()
+            self._queue("messages", (
+                session_id, seq, message.role.value, message.content,
+                message.timestamp.isoformat(), json.dumps(message.files, ensure_ascii=False)
+            ))
+
+    def add_search_result(self, result: SearchResult) -> None:
+        """Enregistre un résultat de recherche et ses citations"""
+        with self._lock:
+            session_id = self._ensure_session()
+            search_id = uuid.uuid4().hex
+            self._queue("search_results", (
+                search_id, session_id, result.query, result.content, result.timestamp.isoformat(),
+                result.input_tokens, result.output_tokens, result.total_tokens, result.total_cost,
+                int(result.cached)
+            ))
+            for citation in result.citations:
+                self._queue("citations", (
+                    search_id, citation.number, citation.title, citation.url, citation.snippet, citation.source
+                ))
+
+    def add_usage(
+        self,
+        provider: str,
+        prompt_tokens: int = 0,
+        output_tokens: int = 0,
+        cached_tokens: int = 0,
+        cost: float = 0.0
+    ) -> None:
+        """Enregistre l'usage d'un tour (tokens et coût) pour un fournisseur"""
+        with self._lock:
+            session_id = self._ensure_session()
+            self._queue("usage", (session_id, time.time(), provider, prompt_tokens, output_tokens, cached_tokens, cost))
+
+    # --- Lectures ---
+
+    def _read(self, sql: str, params: tuple = ()) -> List[Any]:
+        """Requête de lecture après écriture du lot en attente"""
+        with self._lock:
+            self.flush()
+            return self._conn.execute(sql, params).fetchall()
+
+    def get_messages(self, limit: Optional[int] = None, session_id: Optional[int] = None) -> List[ChatMessage]:
+        """Derniers messages d'une session (courante par défaut), dans l'ordre"""
+        session_id = session_id if session_id is not None else self.session_id
+        if session_id is None:
+            return []
+        rows = self._read(
+            "SELECT role, content, timestamp, files FROM messages WHERE session_id = ? "
+            "ORDER BY seq DESC LIMIT ?",
+            (session_id, limit if limit else -1)
+        )
+        return [
+            ChatMessage(
+                role=MessageRole(role),
+                content=content,
+                timestamp=datetime.fromisoformat(timestamp),
+                files=json.loads(files)
+            )
+            for role, content, timestamp, files in reversed(rows)
+        ]
+
+    def get_search_results(self, session_id: Optional[int] = None) -> List[SearchResult]:
+        """Recherches d'une session (courante par défaut) avec leurs citations"""
+        session_id = session_id if session_id is not None else self.session_id
+        if session_id is None:
+            return []
+        rows = self._read(
+            "SELECT id, query, content, timestamp, input_tokens, output_tokens, total_tokens, total_cost, cached "
+            "FROM search_results WHERE session_id = ? ORDER BY timestamp",
+            (session_id,)
+        )
+        citation_rows = self._read(
+            "SELECT c.search_id, c.number, c.title, c.url, c.snippet, c.source FROM citations c "
+            "JOIN search_results r ON r.id = c.search_id WHERE r.session_id = ? ORDER BY c.search_id, c.number",
+            (session_id,)
+        )
+        citations: dict = {}
+        for search_id, number, title, url, snippet, source in citation_rows:
+            citations.setdefault(search_id, []).append(Citation(number, title, url, snippet, source))
+
+        return [
+            SearchResult(
+                content=content,
+                citations=citations.get(search_id, []),
+                query=query,
+                timestamp=datetime.fromisoformat(timestamp),
+                input_tokens=input_tokens,
+                output_tokens=output_tokens,
+                total_tokens=total_tokens,
+                total_cost=total_cost,
+                cached=bool(cached)
+            )
+            for search_id, query, content, timestamp, input_tokens, output_tokens, total_tokens, total_cost, cached in rows
+        ]
+
+    def get_cost_summary(self, session_id: Optional[int] = None) -> dict:
+        """Coûts et tokens agrégés par fournisseur pour une session (courante par défaut)"""
+        session_id = session_id if session_id is not None else self.session_id
+        summary = {"searches": 0, "cached_searches": 0, "perplexity": 0.0, "providers": {}}
+        if session_id is None:
+            return summary
+
+        searches, cached_searches, perplexity_cost = self._read(
+            "SELECT COUNT(*), COALESCE(SUM(cached), 0), COALESCE(SUM(total_cost), 0) "
+            "FROM search_results WHERE session_id = ?",
+            (session_id,)
+        )[0]
+        summary.update(searches=searches, cached_searches=cached_searches, perplexity=perplexity_cost)
+
+        for provider, turns, prompt_tokens, output_tokens, cached_tokens, cost in self._read(
+            "SELECT provider, COUNT(*), SUM(prompt_tokens), SUM(output_tokens), SUM(cached_tokens), SUM(cost) "
+            "FROM usage WHERE session_id = ? GROUP BY provider",
+            (session_id,)
+        ):
+            summary["providers"][provider] = {
+                "turns": turns,
+                "prompt_tokens": prompt_tokens,
+                "output_tokens": output_tokens,
+                "cached_tokens": cached_tokens,
+                "cost": cost
+            }
+        return summary
+
+    def close(self) -> None:
+        """Écrit le lot en attente et ferme la base"""
+        with self._lock:
+            self.flush()
+            self._conn.close()
@@ -0,0 +1,365 @@
+"""Comptabilité des tokens et des coûts des fournisseurs, et gouverneur de budget par session et par tour"""
+
+import os
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+from .context_packer import CHARS_PER_TOKEN
+
+
+@dataclass(frozen=True)
+class ModelPricing:
+    """Tarifs d'un modèle : USD par million de tokens, par recherche et par requête"""
+    input: float = 0.0
+    output: float = 0.0
+    cache_write: float = 0.0
+    cache_read: float = 0.0
+    cache_storage_per_hour: float = 0.0  # Stockage d'un cache de contexte (par million de tokens et par heure)
+    per_search: float = 0.0
+    per_request: float = 0.0
+
+
+# Par préfixe de nom de modèle (le plus long l'emporte)
+PRICING: Dict[str, ModelPricing] = {
+    "claude-3-5-haiku": ModelPricing(input=0.8, output=4.0, cache_write=1.0, cache_read=0.08, per_search=0.01),
+    "claude-3-5-sonnet": ModelPricing(input=3.0, output=15.0, cache_write=3.75, cache_read=0.3, per_search=0.01),
+    "claude-3-7-sonnet": ModelPricing(input=3.0, output=15.0, cache_write=3.75, cache_read=0.3, per_search=0.01),
+    "claude-sonnet-4": ModelPricing(input=3.0, output=15.0, cache_write=3.75, cache_read=0.3, per_search=0.01),
+    "claude-opus-4": ModelPricing(input=15.0, output=75.0, cache_write=18.75, cache_read=1.5, per_search=0.01),
+    "gemini-2.0-flash": ModelPricing(input=0.1, output=0.4, cache_read=0.025, cache_storage_per_hour=1.0,
+                                     per_search=0.035),
+    "gemini-2.5-flash": ModelPricing(input=0.1, output=4.0, cache_read=0.025, cache_storage_per_hour=1.0,
+                                     per_search=0.035),
+    "gemini-2.5-pro": ModelPricing(input=1.25, output=10.0, cache_read=0.31, cache_storage_per_hour=4.5,
+                                   per_search=0.035),
+    "sonar": ModelPricing(input=1.0, output=1.0, per_request=0.008),
+    "sonar-pro": ModelPricing(input=3.0, output=15.0, per_request=0.008),
+    "grok-3": ModelPricing(input=3.0, output=15.0, per_search=0.025),
+    "grok-3-fast": ModelPricing(input=5.0, output=25.0, per_search=0.025),
+    "grok-3-mini": ModelPricing(input=0.3, output=0.5, per_search=0.025),
+    "grok-3-mini-fast": ModelPricing(input=0.6, output=4.0, per_search=0.025),
+}
+
+
+def get_pricing(model: str) -> ModelPricing:
+    """Tarifs d'un modèle (préfixe le plus long du tableau, tarifs nuls si inconnu)"""
+    for prefix in sorted(PRICING, key=len, reverse=True):
+        if model.startswith(prefix):
+            return PRICING[prefix]
+    return ModelPricing()
+
+
+@dataclass
+class Usage:
+    """
+    Consommation réelle d'un ou plusieurs appels à un même modèle.
+
+    input_tokens ne compte que les tokens d'entrée facturés au plein tarif : les tokens
+    écrits dans le cache ou lus depuis le cache sont comptés à part.
+    """
+    provider: str = ""
+    model: str = ""
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cache_write_tokens: int = 0
+    cache_read_tokens: int = 0
+    searches: int = 0
+    requests: int = 0
+
+    @property
+    def total_tokens(self) -> int:
+        return self.input_tokens + self.output_tokens + self.cache_write_tokens + self.cache_read_tokens
+
+    def add(self, other: "Usage") -> "Usage":
+        """Ajoute la consommation d'un autre appel (au même modèle)"""
+        self.input_tokens += other.input_tokens
+        self.output_tokens += other.output_tokens
+        self.cache_write_tokens += other.cache_write_tokens
+        self.cache_read_tokens += other.cache_read_tokens
+        self.searches += other.searches
+        self.requests += other.requests
+        return self
+
+    def costs(self) -> Dict[str, float]:
+        """Détail des coûts (clés entry_cost, output_cost, cache_cost, search_cost, total_cost)"""
+        pricing = get_pricing(self.model)
+        entry_cost = self.input_tokens / 1_000_000 * pricing.input
+        output_cost = self.output_tokens / 1_000_000 * pricing.output
+        cache_cost = (self.cache_write_tokens * pricing.cache_write + self.cache_read_tokens * pricing.cache_read) / 1_000_000
+        search_cost = self.searches * pricing.per_search + self.requests * pricing.per_request
+        return {
+            "entry_cost": entry_cost,
+            "output_cost": output_cost,
+            "cache_cost": cache_cost,
+            "search_cost": search_cost,
+            "total_cost": entry_cost + output_cost + cache_cost + search_cost,
+        }
+
+    @property
+    def total_cost(self) -> float:
+        return self.costs()["total_cost"]
+
+
+# --- Lecture des métadonnées d'utilisation de chaque fournisseur ---
+
+def anthropic_usage(usage: Any, model: str) -> Usage:
+    """Usage d'un message Anthropic (message.usage)"""
+    if usage is None:
+        return Usage("anthropic", model, requests=1)
+    server_tool_use = getattr(usage, "server_tool_use", None)
+    return Usage(
+        provider="anthropic",
+        model=model,
+        input_tokens=getattr(usage, "input_tokens", 0) or 0,
+        output_tokens=getattr(usage, "output_tokens", 0) or 0,
+        cache_write_tokens=getattr(usage, "cache_creation_input_tokens", 0) or 0,
+        cache_read_tokens=getattr(usage, "cache_read_input_tokens", 0) or 0,
+        searches=(getattr(server_tool_use, "web_search_requests", 0) or 0) if server_tool_use else 0,
+        requests=1
+    )
+
+
+def gemini_usage(metadata: Any, model: str, searches: int = 0) -> Usage:
+    """
+    Usage d'une réponse Gemini (usage_metadata). En streaming, les compteurs de chaque
+    chunk sont cumulés depuis le début de la réponse : passer ceux du dernier chunk.
+    Les tokens de raisonnement sont facturés comme des tokens de sortie.
+    """
+    if metadata is None:
+        return Usage("gemini", model, searches=searches, requests=1)
+    prompt_tokens = getattr(metadata, "prompt_token_count", 0) or 0
+    cached_tokens = getattr(metadata, "cached_content_token_count", 0) or 0
+    return Usage(
+        provider="gemini",
+        model=model,
+        input_tokens=prompt_tokens - cached_tokens,
+        output_tokens=(getattr(metadata, "candidates_token_count", 0) or 0)
+        + (getattr(metadata, "thoughts_token_count", 0) or 0),
+        cache_read_tokens=cached_tokens,
+        searches=searches,
+        requests=1
+    )
+
+
+def gemini_search_count(response: Any) -> int:
+    """Nombre de recherches Google réellement lancées (grounding_metadata.web_search_queries)"""
+    count = 0
+    for candidate in getattr(response, "candidates", None) or []:
+        grounding = getattr(candidate, "grounding_metadata", None)
+        count += len(getattr(grounding, "web_search_queries", None) or [])
+    return count
+
+
+def openai_usage(usage: Optional[dict], provider: str, model: str) -> Usage:
+    """
+    Usage au format OpenAI (Perplexity, xAI) : prompt_tokens / completion_tokens.
+    Les recherches sont les sources utilisées par xAI (num_sources_used) ; Perplexity
+    facture un forfait par requête.
+    """
+    usage = usage or {}
+    return Usage(
+        provider=provider,
+        model=model,
+        input_tokens=usage.get("prompt_tokens", 0) or 0,
+        output_tokens=usage.get("completion_tokens", 0) or 0,
+        searches=usage.get("num_sources_used", 0) or 0,
+        requests=1
+    )
+
+
+# --- Gouverneur de budget ---
+
+class BudgetExceededError(Exception):
+    """Budget de la session épuisé : aucun nouvel appel n'est autorisé"""
+
+
+def _env_number(name: str, cast):
+    value = os.getenv(name)
+    return cast(value) if value else None
+
+
+@dataclass
+class BudgetLimits:
+    """Plafonds (None = illimité) de tokens, de dépense (USD) et de recherches"""
+    session_tokens: Optional[int] = None
+    session_cost: Optional[float] = None
+    turn_tokens: Optional[int] = None
+    turn_cost: Optional[float] = None
+    turn_searches: Optional[int] = None
+
+    @classmethod
+    def from_env(cls) -> "BudgetLimits":
+        """BUDGET_SESSION_TOKENS, BUDGET_SESSION_USD, BUDGET_TURN_TOKENS, BUDGET_TURN_USD, BUDGET_TURN_SEARCHES"""
+        return cls(
+            session_tokens=_env_number("BUDGET_SESSION_TOKENS", int),
+            session_cost=_env_number("BUDGET_SESSION_USD", float),
+            turn_tokens=_env_number("BUDGET_TURN_TOKENS", int),
+            turn_cost=_env_number("BUDGET_TURN_USD", float),
+            turn_searches=_env_number("BUDGET_TURN_SEARCHES", int),
+        )
+
+
+@dataclass
+class _ActiveStream:
+    """Réponse en cours : estimation tant que l'usage réel n'est pas connu"""
+    pricing: ModelPricing
+    input_tokens: int = 0
+    output_text_chars: int = 0
+
+    @property
+    def output_tokens(self) -> int:
+        return (self.output_text_chars + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+    @property
+    def tokens(self) -> int:
+        return self.input_tokens + self.output_tokens
+
+    @property
+    def cost(self) -> float:
+        return (self.input_tokens * self.pricing.input + self.output_tokens * self.pricing.output) / 1_000_000
+
+
+class TurnBudget:
+    """
+    Budget d'un tour (une question de l'utilisateur et tous les appels qu'elle déclenche).
+
+    Pendant un stream, on_text() compte la sortie au fil de l'eau (estimation) et
+    retourne False dès qu'un plafond du tour ou de la session est atteint : l'appelant
+    arrête alors la génération. record() remplace l'estimation par l'usage réel.
+    """
+
+    def __init__(self, governor: "BudgetGovernor"):
+        self.governor = governor
+        self.tokens = 0
+        self.cost = 0.0
+        self.searches = 0
+        self.stop_reason: Optional[str] = None
+        self._active: Optional[_ActiveStream] = None
+
+    def begin_stream(self, model: str, input_tokens: int = 0) -> None:
+        """Début d'une réponse (input_tokens : estimation de l'entrée, comptée tout de suite)"""
+        self._active = _ActiveStream(get_pricing(model), input_tokens)
+
+    def on_text(self, text: str) -> bool:
+        """Compte un fragment de texte streamé ; False si la génération doit s'arrêter"""
+        if self._active is not None:
+            self._active.output_text_chars += len(text)
+        return self.check()
+
+    def allow_search(self) -> bool:
+        """Réserve une recherche ; False si le plafond de recherches ou de dépense est atteint"""
+        limits = self.governor.limits
+        if limits.turn_searches is not None and self.searches >= limits.turn_searches:
+            self.stop_reason = self.stop_reason or f"plafond de {limits.turn_searches} recherche(s) par tour atteint"
+            return False
+        if not self.check():
+            return False
+        self.searches += 1
+        return True
+
+    def estimated_usage(self, provider: str, model: str) -> Usage:
+        """Estimation de la réponse en cours, quand le fournisseur n'a pas renvoyé d'usage (stream interrompu)"""
+        if self._active is None:
+            return Usage(provider, model)
+        return Usage(provider, model, input_tokens=self._active.input_tokens,
+                     output_tokens=self._active.output_tokens, requests=1)
+
+    def record(self, usage: Usage) -> None:
+        """Usage réel d'un appel terminé (remplace l'estimation de la réponse en cours)"""
+        self._active = None
+        self.tokens += usage.total_tokens
+        self.cost += usage.total_cost
+        self.governor._record(usage)
+
+    @property
+    def estimated_tokens(self) -> int:
+        return self.tokens + (self._active.tokens if self._active else 0)
+
+    @property
+    def estimated_cost(self) -> float:
+        return self.cost + (self._active.cost if self._active else 0.0)
+
+    def check(self) -> bool:
+        """Vérifie les plafonds du tour et de la session (estimation de la réponse en cours comprise)"""
+        if self.stop_reason:
+            return False
+        limits = self.governor.limits
+        pending_tokens = self.estimated_tokens - self.tokens
+        pending_cost = self.estimated_cost - self.cost
+        if limits.turn_tokens is not None and self.estimated_tokens >= limits.turn_tokens:
+            self.stop_reason = f"plafond de {limits.turn_tokens} tokens par tour atteint"
+        elif limits.turn_cost is not None and self.estimated_cost >= limits.turn_cost:
+            self.stop_reason = f"plafond de {limits.turn_cost:.4f} $ par tour atteint"
+        elif limits.session_tokens is not None and self.governor.session_tokens + pending_tokens >= limits.session_tokens:
+            self.stop_reason = f"plafond de {limits.session_tokens} tokens par session atteint"
+        elif limits.session_cost is not None and self.governor.session_cost + pending_cost >= limits.session_cost:
+            self.stop_reason = f"plafond de {limits.session_cost:.4f} $ par session atteint"
+        return self.stop_reason is None
+
+
+class BudgetGovernor:
+    """
+    Plafonds de tokens et de dépense d'une session et de chacun de ses tours.
+
+    start_turn() refuse un nouveau tour si la session a épuisé son budget ; le tour
+    retourné est partagé par tous les appels qu'il déclenche (réponse, recherches).
+    """
+
+    def __init__(self, limits: Optional[BudgetLimits] = None):
+        self.limits = limits or BudgetLimits()
+        self.session_tokens = 0
+        self.session_cost = 0.0
+        self.usage_by_model: Dict[str, Usage] = {}
+        self.turn: Optional[TurnBudget] = None
+
+    @property
+    def enabled(self) -> bool:
+        return any(value is not None for value in vars(self.limits).values())
+
+    def session_exhausted(self) -> Optional[str]:
+        """Raison de l'épuisement du budget de session, None s'il en reste"""
+        if self.limits.session_tokens is not None and self.session_tokens >= self.limits.session_tokens:
+            return f"budget de session épuisé ({self.session_tokens} / {self.limits.session_tokens} tokens)"
+        if self.limits.session_cost is not None and self.session_cost >= self.limits.session_cost:
+            return f"budget de session épuisé ({self.session_cost:.4f} / {self.limits.session_cost:.4f} $)"
+        return None
+
+    def start_turn(self) -> TurnBudget:
+        """Ouvre un tour ; BudgetExceededError si la session n'a plus de budget"""
+        reason = self.session_exhausted()
+        if reason:
+            raise BudgetExceededError(reason)
+        self.turn = TurnBudget(self)
+        return self.turn
+
+    def remaining_searches(self, requested: int) -> int:
+        """Nombre de recherches encore autorisées dans le tour courant (max_uses d'un outil serveur)"""
+        if self.limits.turn_searches is None:
+            return requested
+        used = self.turn.searches if self.turn else 0
+        return max(min(requested, self.limits.turn_searches - used), 0)
+
+    def _record(self, usage: Usage) -> None:
+        self.session_tokens += usage.total_tokens
+        self.session_cost += usage.total_cost
+        key = f"{usage.provider}:{usage.model}"
+        if key not in self.usage_by_model:
+            self.usage_by_model[key] = Usage(usage.provider, usage.model)
+        self.usage_by_model[key].add(usage)
+
+    def reset(self) -> None:
+        """Nouvelle session"""
+        self.session_tokens = 0
+        self.session_cost = 0.0
+        self.usage_by_model.clear()
+        self.turn = None
+
+    def summary(self) -> str:
+        """Consommation de la session, avec les plafonds"""
+        tokens = f"{self.session_tokens} tokens"
+        if self.limits.session_tokens is not None:
+            tokens += f" / {self.limits.session_tokens}"
+        cost = f"{self.session_cost:.4f} $"
+        if self.limits.session_cost is not None:
+            cost += f" / {self.limits.session_cost:.4f} $"
+        return f"{tokens} | {cost}"
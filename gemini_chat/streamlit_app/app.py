@@ -5,8 +5,6 @@ Interface Streamlit pour le chatbot Gemini avec support PDF et recherche Perplex
 import streamlit as st
 import sys
 import time
-import asyncio
-import tempfile
 from pathlib import Path
 from typing import List, Optional
 
@@ -26,11 +24,14 @@ if not src_path.exists():
 sys.path.insert(0, str(src_path.parent))
 
 from src.utils.config import Config
-from src.clients.gemini_client import GeminiClient, DuplicateFileError
+from src.clients.gemini_client import GeminiClient
 from src.clients.perplexity_client import PerplexityClient
 from src.tools.perplexity_tool import PerplexityTool
 from src.models.citation import CitationManager
 from src.models.message import MessageRole, ChatMessage
+from src.models.stream_event import StreamEventType
+from src.ui.stream_renderer import ThrottledStreamRenderer, RenderStats
+from src.utils.usage import BudgetGovernor, BudgetExceededError
 
 
 class StreamlitGeminiChat:
@@ -69,69 +70,75 @@ class StreamlitGeminiChat:
         
         if "perplexity_tool" not in st.session_state:
             st.session_state.perplexity_tool = None
+        
+        if "render_stats" not in st.session_state:
+            st.session_state.render_stats = RenderStats()
+        
+        if "last_gemini_usage" not in st.session_state:
+            st.session_state.last_gemini_usage = None
+        
+        if "governor" not in st.session_state:
+            st.session_state.governor = BudgetGovernor(self.config.budget_limits)
     
     def initialize_clients(self):
         """Initialise les clients si pas déjà fait"""
         if st.session_state.gemini_client is None:
             st.session_state.gemini_client = GeminiClient(self.config)
+            st.session_state.gemini_client.governor = st.session_state.governor
             st.session_state.citation_manager = CitationManager()
             
             if self.config.has_perplexity:
                 st.session_state.perplexity_client = PerplexityClient(self.config)
+                # Même gouverneur : les recherches comptent dans le tour de Gemini
+                st.session_state.perplexity_client.governor = st.session_state.governor
                 st.session_state.perplexity_tool = PerplexityTool(
                     st.session_state.perplexity_client, 
                     st.session_state.citation_manager
                 )
                 tools = [st.session_state.perplexity_tool.get_tool_config()]
+                function_handlers = st.session_state.perplexity_tool.get_in_turn_function_mapping()
             else:
                 tools = None
+                function_handlers = None
             
-            st.session_state.gemini_client.initialize_chat(tools)
-    
-    def save_uploaded_file(self, uploaded_file) -> Path:
-        """Sauvegarde un fichier uploadé dans un dossier temporaire"""
-        temp_dir = Path(tempfile.gettempdir()) / "streamlit_gemini_uploads"
-        temp_dir.mkdir(exist_ok=True)
-        
-        file_path = temp_dir / uploaded_file.name
-        with open(file_path, "wb") as f:
-            f.write(uploaded_file.getbuffer())
-        
-        return file_path
+            st.session_state.gemini_client.initialize_chat(tools, function_handlers)
     
     def handle_file_uploads(self, files):
-        """Traite les fichiers uploadés via chat_input"""
+        """Traite les fichiers uploadés via chat_input (upload en parallèle, depuis la mémoire)"""
         if not files:
             return
         
-        files_processed = 0
-        for uploaded_file in files:
-            # Vérifier si le fichier est déjà uploadé
-            if uploaded_file.name not in [f["name"] for f in st.session_state.uploaded_files]:
-                try:
-                    # Sauvegarder temporairement
-                    temp_path = self.save_uploaded_file(uploaded_file)
-                    
-                    # Upload vers Gemini
-                    file_info = st.session_state.gemini_client.upload_file(temp_path)
-                    
-                    # Ajouter à la liste Streamlit
-                    st.session_state.uploaded_files.append({
-                        "name": uploaded_file.name,
-                        "size": uploaded_file.size,
-                        "path": str(temp_path),
-                        "gemini_info": file_info
-                    })
-                    
-                    files_processed += 1
-                    
-                except DuplicateFileError:
-                    st.toast(f"⚠️ {uploaded_file.name} déjà uploadé", icon="⚠️")
-                except Exception as e:
-                    st.toast(f"❌ Erreur upload {uploaded_file.name}: {e}", icon="❌")
+        # Ignorer les fichiers déjà présents dans la liste Streamlit
+        known_names = {f["name"] for f in st.session_state.uploaded_files}
+        new_files = [uploaded_file for uploaded_file in files if uploaded_file.name not in known_names]
+        if not new_files:
+            return
         
-        if files_processed > 0:
-            st.toast(f"✅ {files_processed} fichier(s) uploadé(s)", icon="✅")
+        progress_bar = st.progress(0.0, text="📤 Upload des fichiers...")
+        done = []
+        
+        def on_progress(name: str, status: str, detail: str):
+            done.append(name)
+            progress_bar.progress(len(done) / len(new_files), text=f"📤 {name} ({len(done)}/{len(new_files)})")
+            if status == "duplicate":
+                st.toast(f"⚠️ {name} déjà uploadé", icon="⚠️")
+            elif status == "error":
+                st.toast(f"❌ Erreur upload {name}: {detail}", icon="❌")
+        
+        result = st.session_state.gemini_client.upload_files(new_files, on_progress=on_progress)
+        progress_bar.empty()
+        
+        # Ajouter à la liste Streamlit les fichiers réussis (même si d'autres ont échoué)
+        for file_info in result.uploaded:
+            st.session_state.uploaded_files.append({
+                "name": file_info["name"],
+                "size": file_info["size"],
+                "path": None,
+                "gemini_info": file_info
+            })
+        
+        if result.uploaded:
+            st.toast(f"✅ {len(result.uploaded)} fichier(s) uploadé(s)", icon="✅")
     
     def _extract_domain(self, url: str) -> str:
         """Extrait le domaine d'une URL"""
@@ -143,126 +150,21 @@ class StreamlitGeminiChat:
         except:
             return ""
     
-    async def stream_perplexity_for_streamlit(self, query: str, response_placeholder, current_response: str):
-        """Version spéciale du streaming Perplexity pour Streamlit"""
-        import json
-        import httpx
-        
-        headers = {
-            "Authorization": f"Bearer {self.config.perplexity_api_key}",
-            "Content-Type": "application/json"
-        }
-        
-        payload = {
-            "temperature": 0.2,
-            "top_p": 0.9,
-            "return_images": False,
-            "return_related_questions": False,
-            "top_k": 0,
-            "stream": True,
-            "presence_penalty": 0,
-            "frequency_penalty": 1,
-            "web_search_options": {"search_context_size": "medium"},
-            "model": self.config.perplexity_model,
-            "messages": [
-                {
-                    "content": "Tu es un expert juridique français. Donne une réponse précise et complète avec les références légales appropriées.",
-                    "role": "system"
-                },
-                {
-                    "role": "user",
-                    "content": query
-                }
-            ],
-            "max_tokens": self.config.perplexity_max_tokens,
-            "search_domain_filter": self.config.allowed_domains
-        }
-        
-        citations = []
-        full_message = ""
-        input_tokens = 0
-        output_tokens = 0
-        last_chunk = None
-        
-        streaming_response = current_response + "📄 **Réponse Perplexity :**\n\n"
+    def stream_perplexity_for_streamlit(self, query: str, response_placeholder, current_response: str):
+        """Version spéciale du streaming Perplexity pour Streamlit (transport partagé du client)"""
+        renderer = ThrottledStreamRenderer(
+            response_placeholder,
+            prefix=current_response + "📄 **Réponse Perplexity :**\n\n",
+            stats=st.session_state.render_stats
+        )
         
-        try:
-            async with httpx.AsyncClient() as client:
-                async with client.stream('POST', "https://api.perplexity.ai/chat/completions", 
-                                       json=payload, headers=headers, timeout=90) as response:
-                    async for line in response.aiter_lines():
-                        if line.startswith('data: '):
-                            data = line[6:]
-                            if data != '[DONE]' and data.strip():
-                                try:
-                                    chunk = json.loads(data)
-                                    last_chunk = chunk
-                                    
-                                    # Contenu du message - streaming en temps réel
-                                    if chunk and 'choices' in chunk and len(chunk['choices']) > 0:
-                                        delta = chunk['choices'][0].get('delta', {})
-                                        if 'content' in delta:
-                                            message = delta['content']
-                                            full_message += message
-                                            # Mettre à jour Streamlit en temps réel
-                                            streaming_response_with_new_content = streaming_response + full_message + "▌"
-                                            response_placeholder.markdown(streaming_response_with_new_content)
-                                    
-                                    # Citations
-                                    if 'citations' in chunk and chunk['citations']:
-                                        from src.models.citation import Citation
-                                        raw_citations = chunk['citations']
-                                        citations = []
-                                        for i, citation_url in enumerate(raw_citations, 1):
-                                            citation = Citation(
-                                                number=i,
-                                                title=f"Source {i}",
-                                                url=citation_url,
-                                                snippet="",
-                                                source=self._extract_domain(citation_url)
-                                            )
-                                            citations.append(citation)
-                                            
-                                except json.JSONDecodeError:
-                                    continue
-            
-            # Finaliser l'affichage
-            final_response = streaming_response + full_message
-            response_placeholder.markdown(final_response)
-            
-            # Extraire les informations de coût
-            if last_chunk and 'usage' in last_chunk:
-                usage = last_chunk['usage']
-                input_tokens = usage.get('prompt_tokens', 0)
-                output_tokens = usage.get('completion_tokens', 0)
-            
-            # Calculer le coût total
-            input_price = input_tokens * self.config.perplexity_input_price_per_token
-            output_price = output_tokens * self.config.perplexity_output_price_per_token
-            total_cost = self.config.perplexity_base_search_price + input_price + output_price
-            
-            # Créer le résultat
-            from src.models.citation import SearchResult
-            return SearchResult(
-                content=full_message,
-                citations=citations,
-                query=query,
-                input_tokens=input_tokens,
-                output_tokens=output_tokens,
-                total_tokens=input_tokens + output_tokens,
-                total_cost=total_cost
-            ), final_response
-            
-        except Exception as e:
-            error_msg = f"❌ Erreur lors de la recherche: {e}"
-            response_placeholder.markdown(streaming_response + error_msg)
-            from src.models.citation import SearchResult
-            return SearchResult(
-                content=error_msg,
-                citations=[],
-                query=query,
-                total_cost=0.0
-            ), streaming_response + error_msg
+        # Mettre à jour Streamlit en temps réel (rendu throttlé)
+        search_result = st.session_state.perplexity_client.search(query, on_delta=renderer.append)
+        
+        # Finaliser l'affichage
+        final_response = renderer.finalize(renderer.prefix + search_result.content)
+        
+        return search_result, final_response
     
     def process_gemini_response_stream(self, message: str, response_placeholder):
         """Traite la réponse de Gemini en streaming temps réel"""
@@ -271,144 +173,83 @@ class StreamlitGeminiChat:
         gemini_cost = 0.0
         perplexity_cost = 0.0
         
+        renderer = ThrottledStreamRenderer(response_placeholder, stats=st.session_state.render_stats)
+        st.session_state.last_gemini_usage = None
+        
         try:
-            for chunk in st.session_state.gemini_client.send_message_stream(message):
+            for event in st.session_state.gemini_client.send_message_stream(message):
                 
-                # Extraire le coût Gemini
-                if chunk.startswith("GEMINI_TOTAL_PRICE :"):
-                    try:
-                        gemini_cost = float(chunk.split(":")[1].strip().replace("$", ""))
-                    except:
-                        pass
+                # Contenu normal - streaming fluide (rendu throttlé)
+                if event.type == StreamEventType.TEXT_DELTA:
+                    renderer.append(event.text)
                 
                 # Gérer les function calls
-                elif chunk.startswith("FUNCTION_CALL:"):
-                    parts = chunk.split(":", 2)
-                    if len(parts) == 3:
-                        tool_name = parts[1]
-                        query = parts[2]
-                        
-                        if tool_name == "perplexity_direct_search":
-                            # RECHERCHE DIRECTE avec streaming Perplexity
-                            if st.session_state.perplexity_client:
-                                # Afficher la requête de recherche
-                                full_response += f"\n\n🔍 **Recherche directe sur internet**\n"
-                                full_response += f"**Requête :** {query}\n\n"
-                                response_placeholder.markdown(full_response + "⏳ Connexion à Perplexity...")
-                                
-                                # Streaming Perplexity en temps réel
-                                async def run_streaming_search():
-                                    search_result, updated_response = await self.stream_perplexity_for_streamlit(
-                                        query, response_placeholder, full_response
-                                    )
-                                    return search_result, updated_response
-                                
-                                # Exécuter le streaming
-                                try:
-                                    loop = asyncio.new_event_loop()
-                                    asyncio.set_event_loop(loop)
-                                    search_result, full_response = loop.run_until_complete(run_streaming_search())
-                                except Exception as e:
-                                    try:
-                                        loop = asyncio.get_event_loop()
-                                        search_result, full_response = loop.run_until_complete(run_streaming_search())
-                                    except:
-                                        # Fallback si asyncio pose problème
-                                        search_result = st.session_state.perplexity_client.search(query)
-                                        full_response += f"📄 **Réponse Perplexity :**\n\n{search_result.content}"
-                                        response_placeholder.markdown(full_response)
-                                
-                                # Ajouter aux citations et coûts
-                                st.session_state.citation_manager.add_search_result(search_result)
-                                st.session_state.citations = search_result.citations
-                                perplexity_cost += search_result.total_cost
-                                
-                                # RÉAJOUT DIRECT AU CONTEXTE GEMINI (sans synthèse)
-                                context_message = (
-                                    f"[CONTEXTE AUTOMATIQUE] Recherche effectuée: {query}\n\n"
-                                    f"Réponse complète fournie à l'utilisateur:\n{search_result.content}\n\n"
-                                    f"Sources: {[c.url for c in search_result.citations]}\n\n"
-                                    f"[Cette information est maintenant dans ton contexte pour les prochaines questions]"
-                                )
-                                # Ajout silencieux au contexte
-                                st.session_state.gemini_client.send_message(context_message)
-                        
-                        elif tool_name == "perplexity_help_search":
-                            # RECHERCHE D'AIDE avec streaming
-                            if st.session_state.perplexity_client:
-                                # Afficher la requête de recherche d'aide
-                                full_response += f"\n\n🔍 **Recherche d'informations complémentaires**\n"
-                                full_response += f"**Requête :** {query}\n\n"
-                                response_placeholder.markdown(full_response + "⏳ Recherche en cours...")
-                                
-                                # Streaming pour la recherche d'aide
-                                async def run_help_search():
-                                    search_result, updated_response = await self.stream_perplexity_for_streamlit(
-                                        query, response_placeholder, full_response
-                                    )
-                                    return search_result
-                                
-                                # Exécuter le streaming
-                                try:
-                                    loop = asyncio.new_event_loop()
-                                    asyncio.set_event_loop(loop)
-                                    search_result = loop.run_until_complete(run_help_search())
-                                except Exception as e:
-                                    try:
-                                        loop = asyncio.get_event_loop()
-                                        search_result = loop.run_until_complete(run_help_search())
-                                    except:
-                                        # Fallback
-                                        search_result = st.session_state.perplexity_client.search(query)
-                                
-                                perplexity_cost += search_result.total_cost
-                                st.session_state.citation_manager.add_search_result(search_result)
-                                
-                                # Ajouter au contexte Gemini
-                                context_message = (
-                                    f"[INFORMATIONS COMPLÉMENTAIRES] Recherche: {query}\n\n"
-                                    f"Résultats trouvés:\n{search_result.content}\n\n"
-                                    f"Sources: {[c.url for c in search_result.citations]}\n\n"
-                                    f"[Utilise ces informations pour enrichir ta réponse initiale]"
-                                )
-                                st.session_state.gemini_client.send_message(context_message)
-                                
-                                # Afficher un message de transition
-                                full_response += "\n\n🤖 **Gemini reprend la main pour synthétiser...**\n\n"
-                                response_placeholder.markdown(full_response)
-                                
-                                # Demander une synthèse et streamer normalement
-                                synthesis_prompt = "Maintenant, réponds à la question initiale en utilisant les informations complémentaires."
-                                for synthesis_chunk in st.session_state.gemini_client.send_message_stream(synthesis_prompt):
-                                    if synthesis_chunk.startswith("GEMINI_TOTAL_PRICE :"):
-                                        try:
-                                            synthesis_cost = float(synthesis_chunk.split(":")[1].strip().replace("$", ""))
-                                            gemini_cost += synthesis_cost
-                                        except:
-                                            pass
-                                    elif not synthesis_chunk.startswith(("GEMINI_", "FUNCTION_CALL:")):
-                                        full_response += synthesis_chunk
-                                        response_placeholder.markdown(full_response + "▌")
-                                
-                                # Nettoyer l'indicateur de frappe
-                                response_placeholder.markdown(full_response)
-                                
-                                # Mettre à jour les citations
-                                st.session_state.citations = search_result.citations
+                elif event.type == StreamEventType.TOOL_CALL:
+                    if event.tool_name == "perplexity_direct_search":
+                        # RECHERCHE DIRECTE avec streaming Perplexity
+                        if st.session_state.perplexity_client:
+                            # Afficher la requête de recherche
+                            full_response = renderer.prefix + renderer.text
+                            full_response += f"\n\n🔍 **Recherche directe sur internet**\n"
+                            full_response += f"**Requête :** {event.query}\n\n"
+                            response_placeholder.markdown(full_response + "⏳ Connexion à Perplexity...")
+                            
+                            # Streaming Perplexity en temps réel
+                            search_result, full_response = self.stream_perplexity_for_streamlit(
+                                event.query, response_placeholder, full_response
+                            )
+                            
+                            # Ajouter aux citations et coûts
+                            st.session_state.citation_manager.add_search_result(search_result)
+                            st.session_state.citations = search_result.citations
+                            perplexity_cost += search_result.total_cost
+                            
+                            # RÉAJOUT DIRECT AU CONTEXTE GEMINI (sans synthèse)
+                            context_message = (
+                                f"[CONTEXTE AUTOMATIQUE] Recherche effectuée: {event.query}\n\n"
+                                f"Réponse complète fournie à l'utilisateur:\n{search_result.content}\n\n"
+                                f"Sources: {[c.url for c in search_result.citations]}\n\n"
+                                f"[Cette information est maintenant dans ton contexte pour les prochaines questions]"
+                            )
+                            # Ajout silencieux au contexte (joint au prochain tour, sans appel au modèle)
+                            st.session_state.gemini_client.queue_context(context_message)
+                            
+                            # La suite éventuelle du streaming s'affiche après la réponse Perplexity
+                            renderer.rebase(full_response)
                 
-                # Contenu normal - streaming fluide (filtrer toutes les métadonnées et tokens)
-                elif not any(chunk.strip().startswith(prefix) for prefix in ["GEMINI_", "FUNCTION_CALL:", "PERPLEXITY_"]) and chunk.strip():
-                    full_response += chunk
-                    response_placeholder.markdown(full_response + "▌")
+                # Recherche d'aide exécutée dans le tour par le client : la synthèse suit directement
+                elif event.type == StreamEventType.TOOL_RESULT:
+                    if st.session_state.perplexity_tool:
+                        perplexity_cost += st.session_state.perplexity_tool.get_last_search_cost()
+                    
+                    full_response = renderer.prefix + renderer.text
+                    full_response += f"\n\n🔍 **Recherche d'informations complémentaires**\n"
+                    full_response += f"**Requête :** {event.query}\n\n"
+                    full_response += "🤖 **Gemini reprend la main pour synthétiser...**\n\n"
+                    renderer.rebase(full_response)
+                    renderer.show(full_response + "▌")
+                    
+                    # Mettre à jour les citations
+                    st.session_state.citations = st.session_state.citation_manager.get_latest_citations()
+                
+                # Coût Gemini
+                elif event.type == StreamEventType.USAGE:
+                    gemini_cost = event.usage.total_price
+                    st.session_state.last_gemini_usage = event.usage
             
             # Nettoyer l'indicateur final
-            response_placeholder.markdown(full_response)
+            full_response = renderer.finalize()
             
             # Calculer le temps de réponse
             end_time = time.time()
             response_time = end_time - start_time
             
             return full_response, gemini_cost, perplexity_cost, response_time
+        
+        except BudgetExceededError as e:
+            error_msg = f"⛔ {e}"
+            response_placeholder.warning(error_msg)
+            return error_msg, 0.0, 0.0, time.time() - start_time
             
         except Exception as e:
             error_msg = f"❌ Erreur lors de la génération: {e}"
@@ -513,6 +354,11 @@ class StreamlitGeminiChat:
                         
                         if gemini_cost > 0:
                             cost_info += f"\n- Gemini: {gemini_cost:.6f}$"
+                        usage = st.session_state.last_gemini_usage
+                        if usage and usage.cached_tokens:
+                            cost_info += f" (dont {usage.cached_tokens} tokens lus depuis le cache de contexte)"
+                        if usage and usage.cache_storage_price:
+                            cost_info += f"\n- Stockage du cache de contexte: {usage.cache_storage_price:.6f}$"
                         if perplexity_cost > 0:
                             cost_info += f"\n- Perplexity: {perplexity_cost:.6f}$"
                         
@@ -623,6 +469,10 @@ class StreamlitGeminiChat:
                             for citation in result.citations:
                                 st.write(f"- [{citation.number}] {citation.url}")
         
+        # Statistiques de rendu du streaming (session)
+        if st.session_state.render_stats.frames:
+            st.caption(st.session_state.render_stats.summary())
+        
         # Boutons de gestion
         col1, col2 = st.columns(2)
         
@@ -0,0 +1,89 @@
+"""Tests du résumé glissant de la conversation"""
+
+from src.utils.compaction import ConversationCompactor
+
+
+def turn(question: str, answer: str, citations=None):
+    answer_message = {"role": "assistant", "content": answer}
+    if citations is not None:
+        answer_message["citations"] = citations
+    return [{"role": "user", "content": question}, answer_message]
+
+
+class FakeSummarizer:
+    """Résumeur de test : garde les prompts reçus"""
+
+    def __init__(self, summary: str = "résumé"):
+        self.summary = summary
+        self.prompts = []
+
+    def __call__(self, prompt: str) -> str:
+        self.prompts.append(prompt)
+        return self.summary
+
+
+def test_short_history_is_not_compacted():
+    compactor = ConversationCompactor(threshold_tokens=1000, keep_recent_turns=1)
+    summarize = FakeSummarizer()
+    messages = turn("q1", "r1") + turn("q2", "r2")
+
+    result = compactor.compact(messages, summarize)
+
+    assert result.messages == messages
+    assert result.summary == ""
+    assert summarize.prompts == []
+
+
+def test_old_turns_are_replaced_by_the_summary_with_their_sources():
+    compactor = ConversationCompactor(threshold_tokens=10, keep_recent_turns=1)
+    summarize = FakeSummarizer("Question sur le bail")
+    messages = (
+        turn("bail", "Voir https://www.legifrance.gouv.fr/article", citations=["https://www.service-public.fr/bail"])
+        + turn("divorce", "réponse")
+    )
+
+    result = compactor.compact(messages, summarize)
+
+    assert result.messages == messages[-2:]
+    assert "Question sur le bail" in result.summary
+    assert "https://www.legifrance.gouv.fr/article" in result.summary
+    assert "https://www.service-public.fr/bail" in result.summary
+    assert result.newly_compacted_turns == 1
+
+
+def test_only_new_turns_are_sent_to_the_summarizer():
+    compactor = ConversationCompactor(threshold_tokens=10, keep_recent_turns=1)
+    summarize = FakeSummarizer()
+    messages = turn("bail", "r1") + turn("divorce", "r2")
+    compactor.compact(messages, summarize)
+
+    compactor.compact(messages + turn("succession", "r3"), summarize)
+
+    assert len(summarize.prompts) == 2
+    new_exchanges = summarize.prompts[1].split("NOUVEAUX ÉCHANGES :")[-1]
+    assert "divorce" in new_exchanges and "bail" not in new_exchanges
+
+
+def test_pinned_turns_are_never_compacted():
+    compactor = ConversationCompactor(
+        threshold_tokens=10, keep_recent_turns=1, is_pinned=lambda m: m.get("pinned", False)
+    )
+    pinned_turn = [{"role": "user", "content": "document", "pinned": True}, {"role": "assistant", "content": "analyse"}]
+    messages = pinned_turn + turn("bail", "r1") + turn("divorce", "r2")
+
+    result = compactor.compact(messages, FakeSummarizer())
+
+    assert result.messages == pinned_turn + messages[-2:]
+
+
+def test_failed_summary_keeps_the_history():
+    compactor = ConversationCompactor(threshold_tokens=10, keep_recent_turns=1)
+    messages = turn("bail", "r1") + turn("divorce", "r2")
+
+    def failing(prompt):
+        raise RuntimeError("indisponible")
+
+    result = compactor.compact(messages, failing)
+
+    assert result.messages == messages
+    assert compactor.compacted_until == 0
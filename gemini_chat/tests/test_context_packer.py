@@ -0,0 +1,109 @@
+"""Tests de la sélection de l'historique dans le budget de tokens"""
+
+from src.utils.context_packer import (
+    ContextPacker,
+    count_pdf_pages,
+    estimate_tokens,
+    get_input_budget,
+    split_turns,
+)
+
+
+def turn(question: str, answer: str):
+    return [{"role": "user", "content": question}, {"role": "assistant", "content": answer}]
+
+
+def filler(topic: str, chars: int = 800) -> str:
+    return (topic + " ") * (chars // (len(topic) + 1))
+
+
+def test_estimates():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("abcde") == 2
+    assert get_input_budget("claude-3-5-haiku-20241022") == 24000
+    assert get_input_budget("inconnu") == 16000
+    assert count_pdf_pages(b"/Type /Pages /Type /Page /Type /Page") == 2
+
+
+def test_split_turns_starts_a_turn_on_each_user_message():
+    messages = turn("q1", "r1") + turn("q2", "r2") + [{"role": "user", "content": "q3"}]
+    assert [len(t) for t in split_turns(messages)] == [2, 2, 1]
+
+
+def test_everything_is_kept_within_budget():
+    messages = turn("q1", "r1") + turn("q2", "r2")
+
+    packed = ContextPacker(budget=1000).pack(messages, query="q3", system_prompt="système")
+
+    assert packed.messages == messages
+    assert packed.dropped_turns == 0
+    assert not packed.over_budget
+    assert packed.tokens == estimate_tokens("système") + estimate_tokens("q3") + 4 * (1 + 4)
+
+
+def test_recent_and_relevant_turns_are_kept_in_chronological_order():
+    messages = (
+        turn("licenciement", filler("licenciement"))
+        + turn("bail", filler("bail"))
+        + turn("divorce", filler("divorce"))
+        + turn("succession", filler("succession"))
+    )
+
+    # Deux échanges de ~208 tokens tiennent dans le budget
+    packed = ContextPacker(budget=450).pack(messages, query="licenciement")
+
+    assert [m["content"] for m in packed.messages if m["role"] == "user"] == ["licenciement", "succession"]
+    assert packed.dropped_turns == 2
+    assert packed.tokens <= packed.budget
+
+
+
+def test_without_relevance_the_oldest_turns_are_dropped_first():
+    messages = (
+        turn("licenciement", filler("licenciement"))
+        + turn("bail", filler("bail"))
+        + turn("court", "ok")
+        + turn("divorce", filler("divorce"))
+        + turn("succession", filler("succession"))
+    )
+    packer = ContextPacker(budget=450, by_relevance=False)
+
+    packed = packer.pack(messages, query="licenciement")
+
+    # Suite continue des derniers échanges, quelle que soit la question
+    assert [m["content"] for m in packed.messages if m["role"] == "user"] == ["court", "divorce", "succession"]
+    assert packer.pack(messages, query="bail").messages == packed.messages
+
+def test_pinned_turns_are_always_kept():
+    document_turn = [
+        {"role": "user", "content": [{"type": "text", "text": "analyse"}, {"type": "document", "sha256": "abc"}]},
+        {"role": "assistant", "content": filler("analyse")},
+    ]
+    messages = document_turn + turn("bail", filler("bail")) + turn("divorce", filler("divorce"))
+    is_pinned = lambda message: isinstance(message["content"], list)
+
+    packed = ContextPacker(budget=450, is_pinned=is_pinned).pack(messages, query="divorce")
+
+    assert packed.messages[:2] == document_turn
+    assert packed.messages[2:] == messages[-2:]
+
+
+def test_long_recent_turn_is_truncated_rather_than_dropped():
+    messages = turn("question", "x" * 8000)
+
+    packed = ContextPacker(budget=500).pack(messages, query="suite")
+
+    assert packed.truncated_turns == 1
+    assert packed.messages[1]["content"].endswith("\n[…]")
+    assert packed.tokens <= packed.budget
+    # L'historique d'origine n'est pas modifié
+    assert len(messages[1]["content"]) == 8000
+
+
+def test_documents_tokens_reduce_the_history_budget():
+    messages = turn("bail", filler("bail")) + turn("divorce", filler("divorce"))
+
+    packed = ContextPacker(budget=1000).pack(messages, documents_tokens=700)
+
+    assert packed.dropped_turns == 1
+    assert packed.messages == messages[-2:]
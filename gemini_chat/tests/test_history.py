@@ -0,0 +1,93 @@
+"""Tests du journal JSONL de l'historique"""
+
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from src.models.message import MessageRole
+from src.utils.history import ChatHistory
+
+
+@pytest.fixture
+def config(tmp_path):
+    return SimpleNamespace(
+        max_history_length=2,
+        history_dir=tmp_path,
+        history_fsync_batch=1000,
+        history_fsync_interval=60.0
+    )
+
+
+@pytest.fixture
+def history(config):
+    history = ChatHistory(config)
+    yield history
+    history.close()
+
+
+def journal_lines(history):
+    return history.journal_path.read_bytes().splitlines()
+
+
+def test_close_flushes_pending_lines(history):
+    # Ni le lot (1000 lignes) ni le délai (60 s) ne déclenchent d'écriture : seule la fermeture
+    history.add_message(MessageRole.USER, "Question")
+    history.add_message(MessageRole.ASSISTANT, "Réponse", files=["contrat.pdf"])
+
+    history.close()
+
+    records = [json.loads(line) for line in journal_lines(history)]
+    assert [record["content"] for record in records] == ["Question", "Réponse"]
+    assert records[1]["files"] == ["contrat.pdf"]
+    # Une seconde fermeture est sans effet
+    history.close()
+
+
+def test_older_messages_are_read_through_the_offsets_index(history):
+    for i in range(5):
+        history.add_message(MessageRole.USER, f"message {i}")
+
+    # Seuls les deux derniers sont en mémoire, les autres sont relus sur disque
+    assert [m.content for m in history.messages] == ["message 3", "message 4"]
+    assert history.get_message(0).content == "message 0"
+    assert history.get_message(-4).content == "message 1"
+    assert [m.content for m in history.get_messages(4)] == ["message 1", "message 2", "message 3", "message 4"]
+    with pytest.raises(IndexError):
+        history.get_message(5)
+
+
+def test_torn_last_line_is_dropped_on_load(config, history):
+    for i in range(3):
+        history.add_message(MessageRole.USER, f"message {i}")
+    history.close()
+    with open(history.journal_path, "ab") as f:
+        f.write(b'{"role": "user", "content": "interrom')
+
+    resumed = ChatHistory(config)
+    assert resumed.load_from_file(history.journal_path).startswith("✅")
+
+    assert resumed.total_messages == 3
+    assert [m.content for m in resumed.messages] == ["message 1", "message 2"]
+    assert resumed.get_message(0).content == "message 0"
+
+    # La suite de la conversation est ajoutée au même journal, après la ligne écartée
+    resumed.add_message(MessageRole.ASSISTANT, "suite")
+    resumed.close()
+    assert [json.loads(line)["content"] for line in journal_lines(resumed)] == [
+        "message 0", "message 1", "message 2", "suite"
+    ]
+    assert resumed.get_message(3).content == "suite"
+
+
+def test_clear_starts_a_new_journal(history):
+    history.add_message(MessageRole.USER, "avant")
+    first_journal = history.journal_path
+
+    history.clear()
+    history.add_message(MessageRole.USER, "après")
+    history.close()
+
+    assert history.journal_path != first_journal
+    assert len(journal_lines(history)) == 1
+    assert history.total_messages == 1
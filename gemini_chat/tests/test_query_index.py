@@ -0,0 +1,89 @@
+"""Tests de la normalisation et du rapprochement des paraphrases"""
+
+import pytest
+
+from src.models.citation import SearchResult
+from src.utils.query_index import (
+    QueryIndex,
+    extract_references,
+    normalize_for_similarity,
+    replay_query_log,
+)
+from src.utils.search_cache import SearchCache
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("Que dit l'article L.1234-5 du C. trav. ?", "article l1234-5 code travail"),
+    ("art. L 1234-5 c. trav", "article l1234-5 code travail"),
+    ("CSS art. R. 4-1", "code securite sociale article r4-1"),
+    ("Délai de préavis ?", "delai preavis"),
+    ("", ""),
+])
+def test_normalize_for_similarity(query, expected):
+    assert normalize_for_similarity(query) == expected
+
+
+def test_extract_references_keeps_article_numbers():
+    assert extract_references("article l1234-5 code travail 2016") == frozenset({"l1234-5", "2016"})
+
+
+def test_paraphrase_is_found_in_the_same_scope():
+    index = QueryIndex(threshold=0.8)
+    index.add("key", "Que dit l'article L.1234-5 du Code du travail ?", "scope")
+
+    match = index.find("art. L1234-5 c. trav", "scope")
+
+    assert match is not None and match[0] == "key"
+    assert index.find("art. L1234-5 c. trav", "autre") is None
+
+
+def test_different_references_never_match():
+    index = QueryIndex(threshold=0.1)
+    index.add("key", "article L1234-5 du code du travail", "scope")
+
+    assert index.find("article L1234-9 du code du travail", "scope") is None
+
+
+def test_removed_queries_are_not_matched():
+    index = QueryIndex(threshold=0.8)
+    index.add("key", "article 1240 code civil", "scope")
+    index.remove("key")
+
+    assert len(index) == 0
+    assert index.find("article 1240 code civil", "scope") is None
+
+
+def test_search_cache_serves_paraphrases(tmp_path):
+    cache = SearchCache(tmp_path / "cache.db", ttl=60, max_entries=10, semantic_threshold=0.8)
+    scope = SearchCache.make_scope("sonar", [], "prompt")
+    cache.store("Que dit l'article L.1234-5 du Code du travail ?", scope, SearchResult("Réponse", [], "L1234-5"))
+
+    assert cache.lookup("art. L1234-5 c. trav", scope).content == "Réponse"
+    assert cache.get_stats()["semantic_hits"] == 1
+    cache.close()
+
+
+def test_query_log_is_off_by_default(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv("PERPLEXITY_QUERY_LOG", raising=False)
+    from src.utils.config import Config
+
+    assert Config().perplexity_query_log_enabled is False
+    monkeypatch.setenv("PERPLEXITY_QUERY_LOG", "1")
+    assert Config().perplexity_query_log_enabled is True
+
+
+def test_query_log_is_rotated_past_its_size_limit(tmp_path):
+    log_path = tmp_path / "query_log.jsonl"
+    cache = SearchCache(tmp_path / "cache.db", ttl=60, max_entries=10, query_log_path=log_path, query_log_max_bytes=200)
+    scope = SearchCache.make_scope("sonar", [], "prompt")
+
+    for i in range(10):
+        cache.lookup(f"question {i}", scope)
+    cache.close()
+
+    archive = tmp_path / "query_log.jsonl.1"
+    assert archive.exists()
+    assert log_path.stat().st_size < 200 + 200
+    assert archive.stat().st_size < 200 + 200
+    assert replay_query_log(log_path, 0.9)["queries"] >= 1
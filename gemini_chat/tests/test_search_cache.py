@@ -0,0 +1,81 @@
+"""Tests du cache disque des recherches Perplexity (TTL, LRU, périmètre)"""
+
+import pytest
+
+from src.models.citation import Citation, SearchResult
+from src.utils import search_cache
+from src.utils.search_cache import SearchCache, normalize_query
+
+
+def make_result(query: str) -> SearchResult:
+    return SearchResult(
+        content=f"Réponse à {query}",
+        citations=[Citation(1, "Légifrance", "https://www.legifrance.gouv.fr/")],
+        query=query,
+        total_cost=0.01,
+        search_profile="article"
+    )
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = SearchCache(tmp_path / "cache.db", ttl=60, max_entries=2)
+    yield cache
+    cache.close()
+
+
+@pytest.fixture
+def scope():
+    return SearchCache.make_scope("sonar", ["legifrance.gouv.fr"], "prompt")
+
+
+def test_normalize_query_ignores_case_spaces_and_final_punctuation():
+    assert normalize_query("  Article   1240 du Code civil ?! ") == "article 1240 du code civil"
+
+
+def test_store_then_lookup_round_trips_the_result(cache, scope):
+    cache.store("Article 1240 du Code civil", scope, make_result("Article 1240 du Code civil"))
+
+    result = cache.lookup("article 1240 du code civil ?", scope)
+
+    assert result is not None
+    assert result.content == "Réponse à Article 1240 du Code civil"
+    assert result.citations[0].url == "https://www.legifrance.gouv.fr/"
+    assert result.search_profile == "article"
+    assert cache.get_stats()["exact_hits"] == 1
+
+
+def test_scope_separates_models_prompts_and_context_sizes(cache, scope):
+    cache.store("Article 1240 du Code civil", scope, make_result("Article 1240 du Code civil"))
+
+    assert cache.lookup("Article 1240 du Code civil", SearchCache.make_scope("sonar-pro", ["legifrance.gouv.fr"], "prompt")) is None
+    assert cache.lookup("Article 1240 du Code civil", SearchCache.make_scope("sonar", ["legifrance.gouv.fr"], "autre")) is None
+    assert cache.lookup("Article 1240 du Code civil", SearchCache.make_scope("sonar", ["legifrance.gouv.fr"], "prompt", "high")) is None
+    assert cache.get_stats()["misses"] == 3
+
+
+def test_expired_entries_are_not_served(cache, scope, monkeypatch):
+    now = 1_000_000.0
+    monkeypatch.setattr(search_cache.time, "time", lambda: now)
+    cache.store("Article 1240 du Code civil", scope, make_result("Article 1240 du Code civil"))
+
+    now += 61
+    assert cache.lookup("Article 1240 du Code civil", scope) is None
+    assert len(cache) == 0
+
+
+def test_least_recently_used_entry_is_evicted(cache, scope, monkeypatch):
+    now = 1_000_000.0
+    monkeypatch.setattr(search_cache.time, "time", lambda: now)
+    cache.store("première", scope, make_result("première"))
+    now += 1
+    cache.store("deuxième", scope, make_result("deuxième"))
+    now += 1
+    assert cache.lookup("première", scope) is not None
+    now += 1
+    cache.store("troisième", scope, make_result("troisième"))
+
+    assert len(cache) == 2
+    assert cache.lookup("deuxième", scope) is None
+    assert cache.lookup("première", scope) is not None
+
@@ -0,0 +1,60 @@
+"""Tests de la classification des questions (profondeur de recherche)"""
+
+import pytest
+
+from src.utils.search_profile import (
+    ARTICLE_LOOKUP,
+    CASE_LAW,
+    PROCEDURE,
+    SEARCH_PROFILES,
+    classify_query,
+    get_search_profile,
+)
+
+
+@pytest.mark.parametrize("query", [
+    "Que dit l'article 1240 du Code civil ?",
+    "art. L1234-5 c. trav",
+    "loi n° 2016-1088 du 8 août 2016",
+    "décret 2019-1234",
+])
+def test_text_references_are_article_lookups(query):
+    assert classify_query(query) == ARTICLE_LOOKUP
+
+
+@pytest.mark.parametrize("query", [
+    "Quel est le délai de préavis pour une démission ?",
+    "Comment déposer une demande de titre de séjour ?",
+])
+def test_procedural_questions(query):
+    assert classify_query(query) == PROCEDURE
+
+
+@pytest.mark.parametrize("query", [
+    "Quelle est la jurisprudence de la Cour de cassation sur le harcèlement moral ?",
+    "Mon employeur peut-il me licencier pendant un arrêt maladie ?",
+    "Quel délai pour contester un licenciement ?",
+    "Puis-je rompre mon CDI ?",
+])
+def test_open_questions_are_case_law(query):
+    assert classify_query(query) == CASE_LAW
+
+
+@pytest.mark.parametrize("query", ["", "   ", "Bonjour", "merci beaucoup"])
+def test_empty_or_small_talk_takes_cheapest_profile(query):
+    assert classify_query(query) == ARTICLE_LOOKUP
+
+
+def test_long_reference_describes_a_situation():
+    query = (
+        "Mon bailleur invoque l'article 1724 du Code civil pour refuser de réduire le loyer "
+        "pendant des travaux qui durent depuis plusieurs mois dans mon appartement"
+    )
+    assert classify_query(query) == CASE_LAW
+
+
+def test_profiles_are_ordered_by_depth():
+    article, procedure, case_law = (SEARCH_PROFILES[name] for name in (ARTICLE_LOOKUP, PROCEDURE, CASE_LAW))
+    assert article.max_uses < procedure.max_uses < case_law.max_uses
+    assert article.max_tokens < procedure.max_tokens < case_law.max_tokens
+    assert get_search_profile("Bonjour") is article
@@ -0,0 +1,128 @@
+"""Tests de la base SQLite locale des conversations"""
+
+import sqlite3
+from types import SimpleNamespace
+
+import pytest
+
+from src.models.citation import Citation, CitationManager, SearchResult
+from src.models.message import ChatMessage, MessageRole
+from src.utils.history import ChatHistory
+from src.utils.store import ConversationStore
+
+
+class RecordingConnection:
+    """Connexion SQLite qui garde la trace des appels à executemany"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.executemany_calls = []
+
+    def executemany(self, sql, rows):
+        rows = list(rows)
+        self.executemany_calls.append((sql.split()[2], len(rows)))
+        return self.conn.executemany(sql, rows)
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def __enter__(self):
+        return self.conn.__enter__()
+
+    def __exit__(self, *exc_info):
+        return self.conn.__exit__(*exc_info)
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = ConversationStore(tmp_path / "conversations.db", batch_size=3, flush_interval=3600)
+    yield store
+    store.close()
+
+
+def count_rows(db_path, table):
+    with sqlite3.connect(str(db_path)) as conn:
+        return conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+
+def make_result(query, urls):
+    return SearchResult(
+        content=f"Réponse à {query}",
+        citations=[Citation(i, f"Source {i}", url) for i, url in enumerate(urls, 1)],
+        query=query,
+        total_cost=0.005
+    )
+
+
+def test_database_uses_wal_mode(store):
+    assert store._conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+
+def test_writes_are_batched_with_executemany(store):
+    store._conn = RecordingConnection(store._conn)
+
+    store.add_message(0, ChatMessage(MessageRole.USER, "q1"))
+    store.add_message(1, ChatMessage(MessageRole.ASSISTANT, "r1"))
+    assert count_rows(store.db_path, "messages") == 0
+
+    store.add_message(2, ChatMessage(MessageRole.USER, "q2"))
+    assert count_rows(store.db_path, "messages") == 3
+    assert store._conn.executemany_calls == [("messages", 3)]
+
+
+def test_reads_flush_pending_writes(store):
+    store.add_message(0, ChatMessage(MessageRole.USER, "q1", files=["bail.pdf"]))
+
+    messages = store.get_messages()
+
+    assert [(m.role, m.content, m.files) for m in messages] == [(MessageRole.USER, "q1", ["bail.pdf"])]
+    assert [m.content for m in store.get_messages(limit=1)] == ["q1"]
+
+
+def test_citation_manager_reads_search_results_from_the_store(store):
+    manager = CitationManager(store)
+    manager.add_search_result(make_result("bail", ["https://www.service-public.fr/bail"]))
+    manager.add_search_result(make_result("divorce", ["https://www.legifrance.gouv.fr/a", "https://www.legifrance.gouv.fr/b"]))
+    manager.clear()
+
+    results = manager.get_all_search_results()
+
+    assert [r.query for r in results] == ["bail", "divorce"]
+    assert [c.url for c in results[1].citations] == ["https://www.legifrance.gouv.fr/a", "https://www.legifrance.gouv.fr/b"]
+    assert "Interaction 2: divorce" in manager.format_citations_by_interaction()
+
+
+def test_sessions_are_separated_and_summarized(store):
+    store.add_search_result(make_result("bail", []))
+    store.add_usage("gemini", prompt_tokens=100, output_tokens=50, cost=0.01)
+    first_session = store.session_id
+
+    store.start_session()
+    store.add_message(0, ChatMessage(MessageRole.USER, "nouvelle session"))
+
+    assert store.session_id != first_session
+    assert store.get_search_results() == []
+    summary = store.get_cost_summary(first_session)
+    assert summary["searches"] == 1
+    assert summary["providers"]["gemini"]["prompt_tokens"] == 100
+    sessions = store.list_sessions()
+    assert [s["messages"] for s in sessions] == [1, 0]
+    assert sessions[1]["cost"] == pytest.approx(0.015)
+
+
+def test_chat_history_imports_a_journal_into_the_store(tmp_path, store):
+    config = SimpleNamespace(
+        max_history_length=10, history_dir=tmp_path, history_fsync_batch=1, history_fsync_interval=60.0
+    )
+    history = ChatHistory(config)
+    history.add_message(MessageRole.USER, "q1")
+    history.add_message(MessageRole.ASSISTANT, "r1")
+    history.close()
+
+    resumed = ChatHistory(config, store)
+    resumed.load_from_file(history.journal_path)
+    resumed.add_message(MessageRole.USER, "q2")
+    resumed.close()
+
+    assert [m.content for m in store.get_messages()] == ["q1", "r1", "q2"]
+    assert store.open_session(history.journal_path) is True
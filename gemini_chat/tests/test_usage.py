@@ -0,0 +1,148 @@
+"""Tests de la comptabilité des coûts et du gouverneur de budget"""
+
+from types import SimpleNamespace
+
+import pytest
+
+from src.utils.usage import (
+    BudgetExceededError,
+    BudgetGovernor,
+    BudgetLimits,
+    ModelPricing,
+    Usage,
+    anthropic_usage,
+    gemini_usage,
+    get_pricing,
+    openai_usage,
+)
+
+
+def test_get_pricing_uses_the_longest_prefix():
+    assert get_pricing("grok-3-mini-fast") is get_pricing("grok-3-mini-fast-beta")
+    assert get_pricing("grok-3-mini-fast").input == 0.6
+    assert get_pricing("grok-3").input == 3.0
+    assert get_pricing("sonar-pro").output == 15.0
+    assert get_pricing("claude-3-5-sonnet-20241022").input == 3.0
+    assert get_pricing("modele-inconnu") == ModelPricing()
+
+
+def test_costs_detail():
+    usage = Usage(
+        "anthropic", "claude-3-5-haiku-20241022",
+        input_tokens=1_000_000, output_tokens=500_000,
+        cache_write_tokens=200_000, cache_read_tokens=1_000_000,
+        searches=3, requests=1
+    )
+
+    costs = usage.costs()
+
+    assert costs["entry_cost"] == pytest.approx(0.8)
+    assert costs["output_cost"] == pytest.approx(2.0)
+    assert costs["cache_cost"] == pytest.approx(0.2 + 0.08)
+    assert costs["search_cost"] == pytest.approx(0.03)
+    assert costs["total_cost"] == pytest.approx(0.8 + 2.0 + 0.28 + 0.03)
+    assert usage.total_cost == costs["total_cost"]
+    assert usage.total_tokens == 2_700_000
+
+
+def test_perplexity_charges_a_fee_per_request():
+    usage = openai_usage({"prompt_tokens": 1000, "completion_tokens": 1000}, "perplexity", "sonar")
+    assert usage.costs()["search_cost"] == pytest.approx(0.008)
+    assert usage.total_cost == pytest.approx(0.002 + 0.008)
+
+
+def test_add_accumulates_usage():
+    total = Usage("gemini", "gemini-2.0-flash")
+    total.add(Usage("gemini", "gemini-2.0-flash", input_tokens=10, output_tokens=5, requests=1))
+    total.add(Usage("gemini", "gemini-2.0-flash", input_tokens=20, searches=1, requests=1))
+    assert (total.input_tokens, total.output_tokens, total.searches, total.requests) == (30, 5, 1, 2)
+
+
+def test_provider_readers():
+    anthropic = anthropic_usage(SimpleNamespace(
+        input_tokens=100, output_tokens=50, cache_creation_input_tokens=10, cache_read_input_tokens=20,
+        server_tool_use=SimpleNamespace(web_search_requests=2)
+    ), "claude-3-5-haiku")
+    assert (anthropic.input_tokens, anthropic.cache_write_tokens, anthropic.cache_read_tokens, anthropic.searches) == (100, 10, 20, 2)
+
+    gemini = gemini_usage(SimpleNamespace(
+        prompt_token_count=100, cached_content_token_count=40, candidates_token_count=30, thoughts_token_count=5
+    ), "gemini-2.5-flash", searches=1)
+    assert (gemini.input_tokens, gemini.cache_read_tokens, gemini.output_tokens, gemini.searches) == (60, 40, 35, 1)
+
+    grok = openai_usage({"prompt_tokens": 10, "completion_tokens": 20, "num_sources_used": 4}, "xai", "grok-3")
+    assert (grok.input_tokens, grok.output_tokens, grok.searches) == (10, 20, 4)
+    assert openai_usage(None, "xai", "grok-3").requests == 1
+
+
+def test_on_text_stops_at_the_turn_token_limit():
+    turn = BudgetGovernor(BudgetLimits(turn_tokens=100)).start_turn()
+    turn.begin_stream("claude-3-5-haiku", input_tokens=80)
+
+    assert turn.on_text("x" * 40)       # 80 + 10 tokens
+    assert not turn.on_text("x" * 40)   # 80 + 20 tokens
+    assert turn.stop_reason == "plafond de 100 tokens par tour atteint"
+    assert not turn.on_text("x")
+
+
+def test_on_text_stops_at_the_session_cost_limit():
+    governor = BudgetGovernor(BudgetLimits(session_cost=0.01))
+    governor.start_turn().record(Usage("anthropic", "claude-3-5-haiku", output_tokens=2000))  # 0.008 $
+    turn = governor.start_turn()
+    turn.begin_stream("claude-3-5-haiku")
+
+    assert turn.on_text("x" * 1000)          # 250 tokens de sortie : 0.001 $
+    assert not turn.on_text("x" * 2000)      # 750 tokens de sortie : 0.003 $
+    assert "par session" in turn.stop_reason
+
+
+def test_allow_search_respects_the_turn_limit():
+    governor = BudgetGovernor(BudgetLimits(turn_searches=2))
+    turn = governor.start_turn()
+
+    assert governor.remaining_searches(5) == 2
+    assert turn.allow_search()
+    assert governor.remaining_searches(5) == 1
+    assert turn.allow_search()
+    assert not turn.allow_search()
+    assert turn.stop_reason == "plafond de 2 recherche(s) par tour atteint"
+    assert governor.remaining_searches(5) == 0
+
+
+def test_unlimited_governor_allows_everything():
+    governor = BudgetGovernor()
+    turn = governor.start_turn()
+    turn.begin_stream("grok-3", input_tokens=10_000_000)
+
+    assert not governor.enabled
+    assert turn.on_text("x" * 10_000)
+    assert turn.allow_search()
+    assert governor.remaining_searches(3) == 3
+
+
+def test_record_replaces_the_estimate_and_exhausts_the_session():
+    governor = BudgetGovernor(BudgetLimits(session_tokens=100))
+    turn = governor.start_turn()
+    turn.begin_stream("grok-3", input_tokens=10)
+    turn.on_text("x" * 40)
+    assert turn.estimated_usage("xai", "grok-3").output_tokens == 10
+
+    turn.record(Usage("xai", "grok-3", input_tokens=60, output_tokens=40))
+
+    assert turn.estimated_tokens == 100
+    assert governor.session_tokens == 100
+    assert governor.usage_by_model["xai:grok-3"].output_tokens == 40
+    with pytest.raises(BudgetExceededError):
+        governor.start_turn()
+
+
+def test_limits_from_env(monkeypatch):
+    monkeypatch.setenv("BUDGET_SESSION_USD", "1.5")
+    monkeypatch.setenv("BUDGET_TURN_SEARCHES", "3")
+    monkeypatch.delenv("BUDGET_TURN_TOKENS", raising=False)
+
+    limits = BudgetLimits.from_env()
+
+    assert limits.session_cost == 1.5
+    assert limits.turn_searches == 3
+    assert limits.turn_tokens is None
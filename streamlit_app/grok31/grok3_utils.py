@@ -9,13 +9,22 @@ from typing import Generator, Union, Dict, Any
 from openai import OpenAI
 from dotenv import load_dotenv
 import os
+import sys
+from pathlib import Path
+
+# Mesures de latence partagées avec gemini_chat
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent / "gemini_chat"))
+from src.utils.metrics import get_registry
+from src.utils.usage import openai_usage
 
 load_dotenv()
 GROK_API_KEY = os.getenv("GROK_API_KEY")
+# URL de l'API xAI (surchargée pour pointer vers l'émulateur local, cf. benchmarks/)
+XAI_BASE_URL = os.getenv("XAI_BASE_URL", "https://api.x.ai/v1").rstrip("/")
     
 client = OpenAI(
   api_key=GROK_API_KEY,
-  base_url="https://api.x.ai/v1",
+  base_url=XAI_BASE_URL,
 )
 
 
@@ -28,9 +37,10 @@ def call_grok(model:str, query: str) -> Generator[Union[str, Dict[str, Any]], No
         
     Yields:
         str: Chunks de texte pendant le streaming
-        Dict[str, Any]: Résultat final avec métriques
+        Dict[str, Any]: Citations reçues ("citations", gardées si l'appelant arrête le flux)
+            puis résultat final avec métriques
     """
-    url = "https://api.x.ai/v1/chat/completions"
+    url = f"{XAI_BASE_URL}/chat/completions"
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {os.getenv('GROK_API_KEY')}"
@@ -48,6 +58,8 @@ def call_grok(model:str, query: str) -> Generator[Union[str, Dict[str, Any]], No
         ],
         "model": model,
         "stream": True,
+        # Usage réel (tokens, sources consultées) dans le dernier chunk
+        "stream_options": {"include_usage": True},
         "search_parameters": {
             "mode": "on",
             "return_citations": True,
@@ -62,6 +74,9 @@ def call_grok(model:str, query: str) -> Generator[Union[str, Dict[str, Any]], No
     # Variables pour accumuler les données
     complete_text = ""
     citations = []
+    usage_data = None
+    timer = get_registry().stream("xai", model)
+    response = None
     
     try:
         # IMPORTANT: stream=True pour requests
@@ -70,6 +85,7 @@ def call_grok(model:str, query: str) -> Generator[Union[str, Dict[str, Any]], No
 
         # Traiter chaque ligne de la réponse streaming
         for line in response.iter_lines():
+            timer.on_bytes(len(line) + 1)
             if line:
                 line_str = line.decode('utf-8')
                 
@@ -89,29 +105,48 @@ def call_grok(model:str, query: str) -> Generator[Union[str, Dict[str, Any]], No
                             if 'delta' in choice and 'content' in choice['delta']:
                                 content = choice['delta']['content']
                                 if content:
+                                    timer.on_delta()
                                     complete_text += content
                                     yield content  # Yield du chunk de texte
                         
                         # Extraire les citations
                         if 'citations' in chunk_data and chunk_data['citations']:
                             citations.extend(chunk_data['citations'])
+                            yield {"type": "citations", "citations": list(citations)}
+                        
+                        if chunk_data.get('usage'):
+                            usage_data = chunk_data['usage']
                         
                     except json.JSONDecodeError as e:
                         print(f"Erreur parsing JSON: {e} - Line: {json_str}")
                         continue
     
     except requests.exceptions.RequestException as e:
+        timer.finish(error=True)
         yield {
             "type": "error",
             "message": f"Erreur API: {str(e)}"
         }
         return
+    except Exception:
+        timer.finish(error=True)
+        raise
+    finally:
+        # Aussi quand l'appelant ferme le générateur avant la fin (GeneratorExit) :
+        # la connexion est libérée et la réponse comptée une seule fois
+        if response is not None:
+            response.close()
+        timer.finish()
     
-    # Yield du résultat final
+    # Yield du résultat final (usage None si l'API ne l'a pas renvoyé)
+    usage = openai_usage(usage_data, "xai", model) if usage_data else None
     yield {
         "type": "final_result",
         "complete_text": complete_text,
-        "citations": citations
+        "citations": citations,
+        "usage": usage,
+        "input_tokens": usage.input_tokens if usage else None,
+        "output_tokens": usage.output_tokens if usage else None
     }
 
 # Fonction d'utilisation
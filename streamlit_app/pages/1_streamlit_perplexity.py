@@ -3,8 +3,17 @@ import httpx
 import json
 import asyncio
 import os
+import sys
+from pathlib import Path
 from dotenv import load_dotenv
 
+# Composants partagés de gemini_chat (rendu du streaming)
+sys.path.insert(0, str(Path(__file__).parent.parent.parent / "gemini_chat"))
+from src.ui.stream_renderer import ThrottledStreamRenderer, RenderStats
+from src.utils.context_packer import ContextPacker, get_input_budget
+from src.utils.compaction import ConversationCompactor
+from src.utils.search_profile import get_search_profile
+
 load_dotenv()
 
 api_key = os.getenv("PERPLEXITY_API_KEY", "")
@@ -25,45 +34,85 @@ def init_session_state():
         st.session_state.messages = []
     if 'api_key' not in st.session_state:
         st.session_state.api_key = os.getenv("PERPLEXITY_API_KEY", "")
+    if 'render_stats' not in st.session_state:
+        st.session_state.render_stats = RenderStats()
+    if 'compactor' not in st.session_state:
+        st.session_state.compactor = ConversationCompactor(
+            threshold_tokens=COMPACTION_THRESHOLD_TOKENS,
+            keep_recent_turns=COMPACTION_KEEP_RECENT_TURNS
+        )
+
+SYSTEM_PROMPTS = [
+    "Tu es un expert juridique français qui choisit de faire une recherche ou non selon la question posée.",
+    "Définis les termes juridiques de la question posée et réponds y."
+]
+MODEL = "sonar"
+API_URL = "https://api.perplexity.ai/chat/completions"
+
+# Compaction de l'historique (optionnelle) : seuil et fenêtre d'échanges gardés tels quels
+COMPACTION_THRESHOLD_TOKENS = 4000
+COMPACTION_KEEP_RECENT_TURNS = 3
 
-def prepare_context_messages(message_history, new_user_input):
+
+def summarize_conversation(prompt, api_key):
+    """Met à jour le résumé glissant de la conversation (compaction)"""
+    response = httpx.post(
+        API_URL,
+        json={
+            "model": MODEL,
+            "messages": [{"role": "user", "content": prompt}],
+            "max_tokens": 1500,
+            "temperature": 0
+        },
+        headers={"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"},
+        timeout=60.0
+    )
+    response.raise_for_status()
+    return response.json()["choices"][0]["message"]["content"]
+
+def prepare_context_messages(message_history, new_user_input, compactor=None, api_key=""):
     """
-    Prépare les messages avec contexte limité aux 4 dernières interactions
+    Prépare les messages avec un historique choisi dans le budget de tokens d'entrée du modèle
+    (interactions récentes d'abord, puis anciennes interactions pertinentes pour la question)
     
     Args:
         message_history: Liste des messages de st.session_state.messages
         new_user_input: Nouvelle question de l'utilisateur
+        compactor: Si fourni, les anciens échanges sont remplacés par un résumé glissant
+        api_key: Clé API (appel de résumé)
     
     Returns:
-        Liste des messages formatés pour l'API
+        Messages formatés pour l'API, résultat de la sélection (PackedContext) et de la compaction
     """
-    messages = [
-        {
-            "role": "system",
-            "content": (
-                "Tu es un expert juridique français qui choisit de faire une recherche ou non selon la question posée."
-            )
-        },
+    system_prompts = list(SYSTEM_PROMPTS)
+    
+    # Les citations restent hors du texte envoyé mais sont gardées par la compaction
+    history = [
         {
-            "role": "system",
-            "content": (
-                "Définis les termes juridiques de la question posée et réponds y."
-            )
+            "role": msg["role"],
+            "content": msg["content"],
+            "citations": (msg.get("metadata") or {}).get("citations", [])
         }
+        for msg in message_history
+        if msg["role"] in ["user", "assistant"]
     ]
     
-    # Limiter aux 4 dernières interactions (= 8 derniers messages maximum)
-    # 1 interaction = 1 message user + 1 message assistant
-    recent_history = message_history[-8:] if len(message_history) > 8 else message_history
+    compaction = None
+    if compactor is not None:
+        compaction = compactor.compact(history, lambda summary_prompt: summarize_conversation(summary_prompt, api_key))
+        history = compaction.messages
+        if compaction.summary:
+            system_prompts.append(compaction.summary)
+    
+    messages = [{"role": "system", "content": prompt} for prompt in system_prompts]
     
-    # Ajouter l'historique récent
-    for msg in recent_history:
-        if msg["role"] in ["user", "assistant"]:
-            messages.append({
-                "role": msg["role"],
-                "content": msg["content"]
-                # On n'inclut pas les métadonnées dans l'API
-            })
+    packed = ContextPacker.for_model(MODEL).pack(
+        history,
+        query=new_user_input,
+        system_prompt="\n".join(system_prompts)
+    )
+    # On n'inclut pas les métadonnées dans l'API
+    messages.extend({"role": msg["role"], "content": msg["content"]} for msg in packed.messages)
     
     # Ajouter la nouvelle question
     messages.append({
@@ -71,37 +120,39 @@ def prepare_context_messages(message_history, new_user_input):
         "content": new_user_input
     })
     
-    return messages
+    return messages, packed, compaction
 
-def count_context_stats(messages):
+def count_context_stats(messages, packed, compaction=None):
     """
     Compte les statistiques du contexte envoyé
     
     Returns:
-        dict avec interactions et tokens approximatifs
+        dict avec interactions, interactions écartées, tokens estimés et économisés par la compaction
     """
     user_messages = [m for m in messages if m["role"] == "user"]
-    assistant_messages = [m for m in messages if m["role"] == "assistant"]
-    
-    # Estimation approximative des tokens (1 token ≈ 4 caractères)
-    total_chars = sum(len(m["content"]) for m in messages)
-    estimated_tokens = total_chars // 4
     
     return {
-        "interactions": min(len(user_messages) - 1, 4),  # -1 car nouvelle question pas encore dans l'historique
-        "total_messages": len(messages) - 1,  # -1 pour le système
-        "estimated_input_tokens": estimated_tokens
+        "interactions": len(user_messages) - 1,  # -1 car nouvelle question pas encore dans l'historique
+        "dropped_interactions": packed.dropped_turns,
+        "total_messages": len([m for m in messages if m["role"] != "system"]),
+        "estimated_input_tokens": packed.tokens,
+        "input_budget": packed.budget,
+        "compaction_tokens_saved": compaction.tokens_saved if compaction else 0
     }
 
-async def stream_perplexity_response(user_input, api_key, message_history=None):
+async def stream_perplexity_response(user_input, api_key, message_history=None, compactor=None):
     """Fonction asynchrone pour streamer la réponse de Perplexity avec contexte limité"""
-    url = "https://api.perplexity.ai/chat/completions"
+    url = API_URL
     
-    # Préparer les messages avec contexte limité
-    messages = prepare_context_messages(message_history or [], user_input)
+    # Préparer les messages dans le budget de tokens du modèle (compaction optionnelle)
+    messages, packed, compaction = prepare_context_messages(message_history or [], user_input, compactor, api_key)
     
     # Statistiques pour debugging/information
-    context_stats = count_context_stats(messages)
+    context_stats = count_context_stats(messages, packed, compaction)
+    
+    # Contexte de recherche et longueur de réponse selon la question (le modèle reste MODEL)
+    profile = get_search_profile(user_input)
+    context_stats["search_profile"] = profile.label
     
     payload = {
         "temperature": 0.2,
@@ -112,10 +163,10 @@ async def stream_perplexity_response(user_input, api_key, message_history=None):
         "stream": True,
         "presence_penalty": 0,
         "frequency_penalty": 1,
-        "web_search_options": {"search_context_size": "high"},
-        "model": "sonar",
-        "messages": messages,  # Messages avec contexte limité
-        "max_tokens": 4000,
+        "web_search_options": {"search_context_size": profile.search_context_size},
+        "model": MODEL,
+        "messages": messages,  # Messages dans le budget de tokens
+        "max_tokens": profile.max_tokens,
         "search_domain_filter": [
             "www.legifrance.gouv.fr",
             "www.service-public.fr",
@@ -175,7 +226,7 @@ async def stream_perplexity_response(user_input, api_key, message_history=None):
 def main():
     """Fonction principale de l'application"""
     st.title("⚖️ Expert Juridique IA")
-    st.markdown("Assistant juridique alimenté par Perplexity AI - **Contexte limité aux 4 dernières interactions**")
+    st.markdown("Assistant juridique alimenté par Perplexity AI - **Contexte limité par un budget de tokens**")
     
     # Initialisation des variables de session
     init_session_state()
@@ -189,24 +240,49 @@ def main():
         # Informations sur le contexte
         st.markdown("---")
         st.subheader("🧠 Gestion du contexte")
-        st.markdown("""
-        - **Historique :** 4 dernières interactions
+        st.markdown(f"""
+        - **Budget :** {get_input_budget(MODEL):,} tokens d'entrée ({MODEL})
+        - **Historique :** interactions récentes, puis anciennes interactions pertinentes
         - **Optimisation :** Équilibre contexte/coût
-        - **Limite :** 8 messages max (4 user + 4 assistant)
         """)
         
-        # Statistiques de la conversation actuelle
+        # Statistiques de la dernière requête
         total_interactions = len([m for m in st.session_state.messages if m["role"] == "user"])
+        last_stats = next(
+            (m["context_stats"] for m in reversed(st.session_state.messages) if m.get("context_stats")),
+            None
+        )
         if total_interactions > 0:
             st.metric("Interactions totales", total_interactions)
-            context_interactions = min(total_interactions, 4)
-            st.metric("Dans le contexte", context_interactions)
+        if last_stats:
+            st.metric("Dans le contexte", last_stats["interactions"])
+            st.caption(f"🧮 ~{last_stats['estimated_input_tokens']:,} / {last_stats['input_budget']:,} tokens d'entrée")
+            if last_stats.get("search_profile"):
+                st.caption(f"🧭 Profondeur de recherche : {last_stats['search_profile']}")
             
-            if total_interactions > 4:
-                st.warning(f"🗂️ {total_interactions - 4} interactions anciennes exclues du contexte")
+            if last_stats["dropped_interactions"]:
+                st.warning(f"🗂️ {last_stats['dropped_interactions']} interactions exclues du contexte")
+        
+        # Compaction de l'historique (optionnelle)
+        compaction_enabled = st.checkbox(
+            "Compacter l'historique (résumé glissant)",
+            value=False,
+            help=f"Au-delà de {COMPACTION_THRESHOLD_TOKENS} tokens d'historique, les interactions antérieures aux "
+                 f"{COMPACTION_KEEP_RECENT_TURNS} dernières sont remplacées par un résumé tenu à jour (sources conservées)."
+        )
+        if compaction_enabled and st.session_state.compactor.summary_calls:
+            st.caption(
+                f"🗜️ {st.session_state.compactor.compacted_until} interactions résumées | "
+                f"{st.session_state.compactor.total_tokens_saved} tokens économisés au total"
+            )
+        
+        # Statistiques de rendu du streaming (session)
+        if st.session_state.render_stats.frames:
+            st.caption(st.session_state.render_stats.summary())
         
         if st.button("Effacer l'historique"):
             st.session_state.messages = []
+            st.session_state.compactor.reset()
             st.rerun()
         
         # Informations sur les coûts
@@ -263,6 +339,7 @@ def main():
             message_placeholder = st.empty()
             metadata_placeholder = st.empty()
             
+            renderer = ThrottledStreamRenderer(message_placeholder, stats=st.session_state.render_stats)
             full_response = ""
             metadata = {}
             context_stats = {}
@@ -272,14 +349,15 @@ def main():
                 nonlocal full_response, metadata, context_stats
                 
                 async for chunk, input_tokens, output_tokens, citations, ctx_stats in stream_perplexity_response(
-                    prompt, st.session_state.api_key, st.session_state.messages[:-1]  # Exclut la nouvelle question
+                    prompt, st.session_state.api_key, st.session_state.messages[:-1],  # Exclut la nouvelle question
+                    st.session_state.compactor if compaction_enabled else None
                 ):
                     if chunk:
                         if chunk.startswith("Erreur"):
                             st.error(chunk)
+                            full_response = renderer.text
                             return
-                        full_response += chunk
-                        message_placeholder.markdown(full_response + "▌")
+                        renderer.append(chunk)
                     elif input_tokens is not None:
                         # Métadonnées finales reçues
                         metadata = {
@@ -290,7 +368,7 @@ def main():
                         context_stats = ctx_stats or {}
                 
                 # Affichage final sans curseur
-                message_placeholder.markdown(full_response)
+                full_response = renderer.finalize()
                 
                 # Afficher les métadonnées
                 if metadata:
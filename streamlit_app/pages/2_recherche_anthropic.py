@@ -6,6 +6,18 @@ import os
 import json
 import base64
 import datetime
+import hashlib
+import re
+import sys
+from pathlib import Path
+
+# Sélection de l'historique dans un budget de tokens (partagée avec gemini_chat)
+sys.path.insert(0, str(Path(__file__).parent.parent.parent / "gemini_chat"))
+from src.utils.context_packer import ContextPacker, estimate_pdf_tokens
+from src.utils.compaction import ConversationCompactor
+from src.utils.metrics import get_registry
+from src.utils.usage import BudgetGovernor, BudgetLimits, BudgetExceededError, anthropic_usage
+from src.utils.search_profile import get_search_profile
 
 # Chargement des variables d'environnement
 load_dotenv()
@@ -17,30 +29,127 @@ st.set_page_config(
     layout="wide"
 )
 
+# En-tête bêta de l'API Files d'Anthropic (documents référencés par file_id)
+FILES_API_BETA = "files-api-2025-04-14"
+
+# Compaction de l'historique (optionnelle) : seuil, fenêtre d'échanges gardés et modèle de résumé
+COMPACTION_THRESHOLD_TOKENS = 6000
+COMPACTION_KEEP_RECENT_TURNS = 4
+SUMMARY_MODEL = "claude-3-5-haiku-latest"
+
 # Fonction pour encoder un PDF en base64
-def encode_pdf_to_base64(uploaded_file):
+def encode_pdf_to_base64(file):
     """
     Encode un fichier PDF téléchargé en base64.
     
     Args:
-        uploaded_file: Fichier téléchargé via st.file_uploader
+        file: Fichier téléchargé via st.file_uploader
         
     Returns:
         str: Chaîne encodée en base64
     """
-    if uploaded_file is not None:
-        base64_pdf = ""
-        for file in uploaded_file:
-            # Lire le contenu du fichier
-            pdf_bytes = file.getvalue()
-            
-            # Encoder en base64
-            base64_pdf += base64.b64encode(pdf_bytes).decode('utf-8')
-        
-        return base64_pdf
+    if file is not None:
+        return base64.b64encode(file.getvalue()).decode('utf-8')
     
     return None
 
+# Fonction pour enregistrer les PDF dans le registre de documents de la session
+def register_documents(client, uploaded_files):
+    """
+    Enregistre les PDF dans le registre de la session, indexé par leur SHA-256.
+    
+    Chaque fichier n'est lu et transmis qu'une fois : envoyé à l'API Files
+    d'Anthropic puis référencé par son file_id, ou à défaut encodé une seule
+    fois en base64.
+    
+    Returns:
+        list: Empreintes SHA-256 des fichiers, dans l'ordre
+    """
+    registry = st.session_state.document_registry
+    digests = []
+    
+    for file in uploaded_files or []:
+        pdf_bytes = file.getvalue()
+        digest = hashlib.sha256(pdf_bytes).hexdigest()
+        
+        if digest not in registry:
+            entry = {
+                "name": file.name,
+                "size": len(pdf_bytes),
+                "tokens": estimate_pdf_tokens(pdf_bytes, "anthropic"),
+                "file_id": None,
+                "base64": None
+            }
+            try:
+                uploaded = client.beta.files.upload(
+                    file=(file.name, pdf_bytes, "application/pdf"),
+                    betas=[FILES_API_BETA]
+                )
+                entry["file_id"] = uploaded.id
+            except Exception as e:
+                print(f"API Files indisponible pour {file.name}, envoi en base64: {e}")
+                entry["base64"] = base64.b64encode(pdf_bytes).decode('utf-8')
+            registry[digest] = entry
+        
+        digests.append(digest)
+    
+    return digests
+
+# Fonction pour construire le bloc document envoyé à l'API
+def resolve_document_block(document_ref):
+    """
+    Transforme une référence de document de l'historique en bloc pour l'API.
+    
+    Un document envoyé à l'API Files est référencé par son file_id ; à défaut, son base64
+    (gardé dans le registre, pas dans l'historique) est renvoyé à chaque tour, le dernier
+    document portant un point de cache pour être relu au tarif réduit.
+    """
+    entry = st.session_state.document_registry[document_ref["sha256"]]
+    if entry["file_id"]:
+        source = {"type": "file", "file_id": entry["file_id"]}
+    else:
+        source = {"type": "base64", "media_type": "application/pdf", "data": entry["base64"]}
+    return {"type": "document", "source": source, "title": entry["name"]}
+
+# Fonction pour obtenir la charge utile API d'un message de l'historique
+def api_message(message):
+    """
+    Message tel qu'envoyé à l'API. La charge utile propre (texte sans HTML, références
+    de documents) est stockée avec le message dès sa création ; les documents ne sont
+    résolus qu'au moment de la requête (voir resolve_document_block).
+    """
+    if "api_content" not in message:
+        # Message créé avant la séparation affichage / API : calculé une fois puis stocké
+        content = message["content"]
+        if not isinstance(content, list):
+            content = re.sub(r"<[^>]+>", "", content)
+        message["api_content"] = content
+    content = message["api_content"]
+    if isinstance(content, list):
+        content = [
+            resolve_document_block(item) if isinstance(item, dict) and "sha256" in item else item
+            for item in content
+        ]
+    return {"role": message["role"], "content": content}
+
+# Fonction pour repérer les messages portant un document
+def is_document_message(message):
+    """Vrai si le message contient un bloc document (référence ou bloc résolu)"""
+    return isinstance(message["content"], list) and any(
+        isinstance(item, dict) and item.get("type") == "document" for item in message["content"]
+    )
+
+# Fonction pour mettre à jour le résumé de la conversation (compaction)
+def summarize_conversation(client, prompt):
+    """Met à jour le résumé glissant de la conversation avec un modèle rapide"""
+    response = client.messages.create(
+        model=SUMMARY_MODEL,
+        max_tokens=1500,
+        temperature=0,
+        messages=[{"role": "user", "content": prompt}]
+    )
+    return "".join(block.text for block in response.content if block.type == "text")
+
 # Fonction pour gérer les erreurs de recherche web
 def handle_search_error(query_parts):
     """
@@ -171,6 +280,167 @@ def extract_citations_from_blocks(content_blocks):
     
     return citations
 
+# Fonctions de construction des blocs HTML statiques de la réponse
+def build_errors_html(errors):
+    """Bloc HTML des erreurs de recherche (chaîne vide si aucune)"""
+    if not errors:
+        return ""
+    html = """
+    <div class="error-block">
+    <h4>⚠️ Erreurs de recherche:</h4>
+    """
+    for i, error in enumerate(errors):
+        html += f"<p><strong>Erreur {i+1}:</strong> <em>{error}</em></p>"
+    return html + "</div>"
+
+def build_tools_html(tool_executions):
+    """Bloc HTML des outils exécutés (chaîne vide si aucun)"""
+    if not tool_executions:
+        return ""
+    html = """
+    <div class="tools-block">
+    <h4>🛠️ Outils exécutés:</h4>
+    """
+    for i, tool_exec in enumerate(tool_executions):
+        html += f"<p><strong>Outil {i+1}:</strong> {tool_exec['name']} - {tool_exec['description']}</p>"
+        if 'result' in tool_exec:
+            html += f"<p><strong>Résultat:</strong> {tool_exec['result']}</p>"
+    return html + "</div>"
+
+def build_searches_html(search_queries):
+    """Bloc HTML des recherches effectuées (chaîne vide si aucune)"""
+    if not search_queries:
+        return ""
+    html = """
+    <div class="search-block">
+    <h4>🔍 Recherches effectuées:</h4>
+    """
+    for i, query in enumerate(search_queries):
+        html += f"<p><strong>Recherche {i+1}:</strong> <em>{query}</em></p>"
+    return html + "</div>"
+
+def build_documents_html(document_names):
+    """Bloc HTML des documents de référence (chaîne vide si aucun)"""
+    if not document_names:
+        return ""
+    html = """
+    <div class="document-block">
+    <h4>📄 Document(s) de référence utilisé(s):</h4>
+    """
+    for name in document_names:
+        html += f"<p>{name}</p>"
+    return html + "</div>"
+
+# Rendu incrémental de la réponse en streaming
+class IncrementalResponseRenderer:
+    """
+    Affiche la réponse en streaming sans tout reconstruire à chaque delta.
+    
+    Les blocs statiques (erreurs, outils, recherches) ont chacun leur placeholder,
+    réécrit seulement quand son contenu change. Le texte est mis en tampon et
+    affiché selon un budget de temps ou d'octets ; les paragraphes terminés sont
+    figés dans leur propre élément et seul le paragraphe en cours est réécrit.
+    """
+    
+    def __init__(self, container, flush_interval=0.1, flush_bytes=400):
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self._blocks = {name: container.empty() for name in ("errors", "tools", "searches")}
+        self._block_html = {}
+        self._text_container = container.container()
+        self._tail_placeholder = self._text_container.empty()
+        self._tail = ""
+        self._pending_bytes = 0
+        self._last_flush = time.perf_counter()
+        self.frames = 0
+        self.render_time = 0.0
+    
+    def _render(self, placeholder, content):
+        """Écrit un élément en mesurant le temps de rendu"""
+        start = time.perf_counter()
+        placeholder.markdown(content, unsafe_allow_html=True)
+        self.render_time += time.perf_counter() - start
+        self.frames += 1
+    
+    def set_block(self, name, html):
+        """Met à jour un bloc statique uniquement si son HTML a changé"""
+        if self._block_html.get(name) != html:
+            self._block_html[name] = html
+            self._render(self._blocks[name], html)
+    
+    def append_text(self, text):
+        """Ajoute du texte streamé, affiché quand le budget de temps ou d'octets est atteint"""
+        self._tail += text
+        self._pending_bytes += len(text.encode("utf-8"))
+        if (
+            self._pending_bytes >= self.flush_bytes
+            or time.perf_counter() - self._last_flush >= self.flush_interval
+        ):
+            self.flush()
+    
+    def flush(self):
+        """Affiche le texte en attente, en figeant les paragraphes terminés"""
+        if not self._pending_bytes:
+            return
+        
+        # Figer les paragraphes complets (hors bloc de code ouvert)
+        split_at = self._tail.rfind("\n\n")
+        if split_at > 0 and self._tail[:split_at].count("```") % 2 == 0:
+            self._render(self._tail_placeholder, self._tail[:split_at])
+            self._tail_placeholder = self._text_container.empty()
+            self._tail = self._tail[split_at + 2:]
+        
+        self._render(self._tail_placeholder, self._tail + "▌")
+        self._pending_bytes = 0
+        self._last_flush = time.perf_counter()
+
+# Fonction pour placer les points de cache de prompt Anthropic
+def add_prompt_cache_breakpoints(system_blocks, tools, api_messages):
+    """
+    Ajoute des points de cache (cache_control) sur les préfixes stables de la requête :
+    les outils, le prompt système, le dernier document PDF et la fin de l'historique.
+    Anthropic limite à 4 points de cache par requête.
+    """
+    cache_control = {"type": "ephemeral"}
+    
+    cached_system = [dict(block) for block in system_blocks]
+    if cached_system:
+        cached_system[-1]["cache_control"] = cache_control
+    
+    cached_tools = [dict(tool) for tool in tools]
+    if cached_tools:
+        cached_tools[-1]["cache_control"] = cache_control
+    
+    cached_messages = []
+    for m in api_messages:
+        content = m["content"]
+        if isinstance(content, list):
+            content = [
+                {key: value for key, value in item.items() if key != "cache_control"} if isinstance(item, dict) else item
+                for item in content
+            ]
+        cached_messages.append({"role": m["role"], "content": content})
+    
+    # Le dernier document joint : relu depuis le cache aux tours suivants
+    document_message = None
+    for m in reversed(cached_messages):
+        if isinstance(m["content"], list):
+            documents = [item for item in m["content"] if isinstance(item, dict) and item.get("type") == "document"]
+            if documents:
+                documents[-1]["cache_control"] = cache_control
+                document_message = m
+                break
+    
+    # Fin de l'historique : chaque tour relit le préfixe mis en cache au tour précédent
+    if cached_messages and cached_messages[-1] is not document_message:
+        last = cached_messages[-1]
+        if isinstance(last["content"], str):
+            last["content"] = [{"type": "text", "text": last["content"]}]
+        if last["content"] and isinstance(last["content"][-1], dict):
+            last["content"][-1]["cache_control"] = cache_control
+    
+    return cached_system, cached_tools, cached_messages
+
 # Initialisation des variables de session
 if 'messages' not in st.session_state:
     st.session_state.messages = []
@@ -184,8 +454,18 @@ if 'search_errors' not in st.session_state:
     st.session_state.search_errors = []
 if 'uploaded_file' not in st.session_state:
     st.session_state.uploaded_file = None
+if 'document_registry' not in st.session_state:
+    st.session_state.document_registry = {}
 if 'tool_executions' not in st.session_state:
     st.session_state.tool_executions = []
+if 'compactor' not in st.session_state:
+    st.session_state.compactor = ConversationCompactor(
+        threshold_tokens=COMPACTION_THRESHOLD_TOKENS,
+        keep_recent_turns=COMPACTION_KEEP_RECENT_TURNS,
+        is_pinned=is_document_message
+    )
+if 'governor' not in st.session_state:
+    st.session_state.governor = BudgetGovernor(BudgetLimits.from_env())
 
 # Titre de l'application
 st.title("Assistant Juridique Français Anthropic 🇫🇷⚖️")
@@ -296,6 +576,12 @@ with st.sidebar:
     temperature = st.slider("Temperature", 0.0, 1.0, 0.3, 0.1)
     max_tokens = st.slider("Tokens max en sortie", 500, 30000, 10000, 100)
     max_searches = st.slider("Nombre max de recherches web", 1, 5, 3, 1)
+    adaptive_search = st.checkbox(
+        "Profondeur de recherche adaptée à la question",
+        value=True,
+        help="Consultation d'un texte : 1 recherche, question de procédure : 2, question ouverte ou "
+             "de jurisprudence : jusqu'au maximum ci-dessus (classification locale de la question)."
+    )
     
     # Domaines autorisés
     st.subheader("Domaines prioritaires pour la recherche")
@@ -319,15 +605,30 @@ with st.sidebar:
             st.session_state.uploaded_file = uploaded_file
             st.success(f"Document '{file.name}' prêt à être utilisé")
         
-        # Ajouter une prévisualisation du document PDF
-        pdf_display = f'<iframe src="data:application/pdf;base64,{encode_pdf_to_base64(uploaded_file)}" width="100%" height="200" type="application/pdf"></iframe>'
-        st.markdown(pdf_display, unsafe_allow_html=True)
+        # Ajouter une prévisualisation de chaque document PDF
+        for file in uploaded_file:
+            pdf_display = f'<iframe src="data:application/pdf;base64,{encode_pdf_to_base64(file)}" width="100%" height="200" type="application/pdf"></iframe>'
+            st.markdown(pdf_display, unsafe_allow_html=True)
     
     # Information sur les outils disponibles
     st.subheader("Outils disponibles")
     st.write("🔍 Recherche web")
     st.write("📅 Vérification de date future")
     
+    # Compaction de l'historique
+    st.subheader("Mémoire de la conversation")
+    compaction_enabled = st.checkbox(
+        "Compacter l'historique (résumé glissant)",
+        value=False,
+        help=f"Au-delà de {COMPACTION_THRESHOLD_TOKENS} tokens d'historique, les échanges antérieurs aux "
+             f"{COMPACTION_KEEP_RECENT_TURNS} derniers sont remplacés par un résumé tenu à jour (sources conservées)."
+    )
+    if compaction_enabled and st.session_state.compactor.summary_calls:
+        st.caption(
+            f"🗜️ {st.session_state.compactor.compacted_until} échanges résumés | "
+            f"{st.session_state.compactor.total_tokens_saved} tokens économisés au total"
+        )
+    
     # Debug mode
     debug_mode = st.checkbox("Mode débogage", value=False)
     
@@ -357,27 +658,39 @@ for message in st.session_state.messages:
 
 # Traitement de la nouvelle question
 if prompt:
-    # Construire le contenu du message en fonction de la présence d'un PDF
-    pdf_data = None
-    if st.session_state.uploaded_file is not None:
-        pdf_data = encode_pdf_to_base64(st.session_state.uploaded_file)
-   
-    
-    if pdf_data:
-        # Message avec document attaché
-        message_content = [
-            {"type": "text", "text": prompt},
-            {
-                "type": "document", 
-                "source": {
-                    "type": "base64", 
-                    "media_type": "application/pdf", 
-                    "data": pdf_data
-                }
-            }
+    # Budget de la session : aucun nouvel appel une fois épuisé
+    try:
+        turn = st.session_state.governor.start_turn()
+    except BudgetExceededError as e:
+        st.error(f"⛔ {e}")
+        st.stop()
+    
+    # Enregistrer les PDF (une seule fois par contenu) et ne joindre que ceux
+    # qui n'ont pas encore été introduits dans la conversation
+    new_documents = []
+    if st.session_state.uploaded_file:
+        documents_in_conversation = {
+            item["sha256"]
+            for m in st.session_state.messages if isinstance(m["content"], list)
+            for item in m["content"] if isinstance(item, dict) and item.get("type") == "document"
+        }
+        digests = register_documents(anthropic.Anthropic(api_key=api_key), st.session_state.uploaded_file)
+        for digest in dict.fromkeys(digests):
+            if digest not in documents_in_conversation:
+                new_documents.append(digest)
+    
+    if new_documents:
+        # Message avec référence(s) aux documents du registre (pas de contenu PDF dans l'historique)
+        message_content = [{"type": "text", "text": prompt}] + [
+            {"type": "document", "sha256": digest, "name": st.session_state.document_registry[digest]["name"]}
+            for digest in new_documents
         ]
-        # Pour stockage dans l'historique
-        st.session_state.messages.append({"role": "user", "content": message_content})
+        # Pour stockage dans l'historique (affichage) ; la charge utile API ne garde que les références
+        st.session_state.messages.append({
+            "role": "user",
+            "content": message_content,
+            "api_content": message_content
+        })
         
         # Pour affichage dans l'interface
         with st.chat_message("user"):
@@ -385,7 +698,7 @@ if prompt:
             st.info("📎 Document PDF joint à cette question")
     else:
         # Message standard sans document
-        st.session_state.messages.append({"role": "user", "content": prompt})
+        st.session_state.messages.append({"role": "user", "content": prompt, "api_content": prompt})
         with st.chat_message("user"):
             st.markdown(prompt)
     
@@ -446,32 +759,58 @@ if prompt:
         }
     ]
     
-    # Créer la liste des messages pour la requête
-    api_messages = []
-    for m in st.session_state.messages:
-        # Si le contenu est une liste (contenant un document), le traiter différemment
-        if isinstance(m["content"], list):
-            api_messages.append({"role": m["role"], "content": m["content"]})
-        # Si c'est une chaîne simple (texte standard)
-        elif isinstance(m["content"], str):
-            # Nettoyer le contenu des balises HTML
-            content = m["content"]
-            content = content.replace('<div class="search-block">', '').replace('</div>', '')
-            content = content.replace('<div class="citations-block">', '').replace('</div>', '')
-            content = content.replace('<div class="error-block">', '').replace('</div>', '')
-            content = content.replace('<div class="document-block">', '').replace('</div>', '')
-            content = content.replace('<div class="tools-block">', '').replace('</div>', '')
-            api_messages.append({"role": m["role"], "content": content})
-        # Autres cas (si nécessaire)
-        else:
-            api_messages.append({"role": m["role"], "content": m["content"]})
+    # Créer la liste des messages pour la requête (charges utiles API stockées, sans HTML)
+    api_messages = [api_message(m) for m in st.session_state.messages]
+    
+    # Historique choisi dans le budget de tokens du modèle : les échanges portant un document
+    # sont toujours gardés (leurs tokens sont comptés à part), puis les plus récents ; les plus
+    # anciens sont écartés en premier pour garder le préfixe mis en cache stable d'un tour à l'autre
+    history = api_messages[:-1]
+    
+    # Compaction optionnelle : les anciens échanges sont remplacés par le résumé glissant, envoyé
+    # dans son propre bloc système après le bloc mis en cache pour ne pas invalider ce dernier
+    compaction = None
+    summary_block = None
+    if compaction_enabled:
+        summary_client = anthropic.Anthropic(api_key=api_key)
+        # Les citations restent hors de la requête mais sont gardées par la compaction
+        compaction = st.session_state.compactor.compact(
+            [dict(message, citations=source.get("citations", []))
+             for message, source in zip(history, st.session_state.messages)],
+            lambda summary_prompt: summarize_conversation(summary_client, summary_prompt)
+        )
+        history = [{"role": m["role"], "content": m["content"]} for m in compaction.messages]
+        if compaction.summary:
+            summary_block = {"type": "text", "text": compaction.summary}
+    
+    documents_tokens = sum(
+        st.session_state.document_registry[item["sha256"]].get("tokens", 0)
+        for m in st.session_state.messages if isinstance(m["content"], list)
+        for item in m["content"] if isinstance(item, dict) and item.get("type") == "document"
+    )
+    packed_context = ContextPacker.for_model(model, is_pinned=is_document_message, by_relevance=False).pack(
+        history,
+        query=prompt,
+        system_prompt="".join(block["text"] for block in system + ([summary_block] if summary_block else [])),
+        documents_tokens=documents_tokens
+    )
+    api_messages = packed_context.messages + api_messages[-1:]
+    turn.begin_stream(model, packed_context.tokens)
+    
+    # Recherches permises selon la classe de la question, plafonnées par le budget du tour
+    search_profile = get_search_profile(prompt) if adaptive_search else None
+    search_uses = st.session_state.governor.remaining_searches(
+        min(max_searches, search_profile.max_uses) if search_profile else max_searches
+    )
     
-    # Configuration des outils
+    # Configuration des outils : max_uses suit la classe de la question. Les outils ouvrent le
+    # préfixe mis en cache (add_prompt_cache_breakpoints) : quand la classe change d'un tour à
+    # l'autre, le cache est réécrit (tarif d'écriture) plutôt que de couper une réponse en cours
     tools = [
         {
             "type": "web_search_20250305",
             "name": "web_search",
-            "max_uses": max_searches,
+            "max_uses": search_uses,
             "allowed_domains": allowed_domains,
         },
         {
@@ -489,6 +828,8 @@ if prompt:
             }
         }
     ]
+    if not search_uses:
+        tools = tools[1:]
     
     # Réinitialiser les erreurs de recherche et les exécutions d'outils
     st.session_state.search_errors = []
@@ -505,12 +846,18 @@ if prompt:
         # Message d'attente initial
         response_placeholder.markdown("*Traitement de votre demande en cours...*")
         
-        # Mesurer le temps de réponse
+        # Mesurer le temps de réponse (total, et TTFT / intervalles / recherches dans le registre de métriques)
         start_time = time.time()
+        timer = get_registry().stream("anthropic", model)
         
         try:
-            # Créer le client Anthropic
-            client = anthropic.Anthropic(api_key=api_key)
+            # Créer le client Anthropic (les réponses 429/5xx retentées par le SDK sont comptées)
+            client = anthropic.Anthropic(
+                api_key=api_key,
+                http_client=anthropic.DefaultHttpxClient(
+                    event_hooks={"response": [get_registry().retry_hook("anthropic", model)]}
+                )
+            )
             
             # Variables pour capturer la réponse
             complete_response_text = ""
@@ -522,14 +869,32 @@ if prompt:
             tool_parts = []
             current_tool_name = None
             
+            # Rendu incrémental : blocs statiques et texte dans des éléments séparés
+            renderer = IncrementalResponseRenderer(response_placeholder.container())
+            
+            # Points de cache de prompt sur les préfixes stables (outils, système, document, historique)
+            cached_system, cached_tools, cached_messages = add_prompt_cache_breakpoints(system, tools, api_messages)
+            if summary_block:
+                cached_system.append(summary_block)
+            
+            # Les documents référencés par file_id nécessitent l'API bêta Files
+            uses_files_api = any(
+                isinstance(item, dict) and item.get("type") == "document" and item["source"]["type"] == "file"
+                for m in cached_messages if isinstance(m["content"], list)
+                for item in m["content"]
+            )
+            stream_kwargs = {"betas": [FILES_API_BETA]} if uses_files_api else {}
+            messages_api = client.beta.messages if uses_files_api else client.messages
+            
             # Démarrer le streaming
-            with client.messages.stream(
+            with messages_api.stream(
                 model=model,
                 max_tokens=max_tokens,
                 temperature=temperature,
-                system=system,
-                messages=api_messages,
-                tools=tools
+                system=cached_system,
+                messages=cached_messages,
+                tools=cached_tools,
+                **stream_kwargs
             ) as stream:
                 # Parcourir tous les événements
                 for event in stream:
@@ -547,6 +912,9 @@ if prompt:
                             elif event.content_block.type == "server_tool_use" and event.content_block.name == "web_search":
                                 building_query = True
                                 query_parts = []
+                                timer.search_started()
+                            elif event.content_block.type == "web_search_tool_result":
+                                timer.search_finished()
                     
                     elif event.type == "content_block_delta":
                         # Capture des parties de la requête JSON pour les recherches web
@@ -565,51 +933,13 @@ if prompt:
                         elif hasattr(event, "delta") and hasattr(event.delta, "type"):
                             if event.delta.type == "text_delta" and hasattr(event.delta, "text"):
                                 text = event.delta.text
+                                timer.on_delta(len(text.encode("utf-8")))
                                 complete_response_text += text
+                                renderer.append_text(text)
                                 
-                                # Construire la mise en page complète
-                                display_html = ""
-                                
-                                # Afficher les erreurs de recherche s'il y en a
-                                if st.session_state.search_errors:
-                                    error_html = """
-                                    <div class="error-block">
-                                    <h4>⚠️ Erreurs de recherche:</h4>
-                                    """
-                                    for i, error in enumerate(st.session_state.search_errors):
-                                        error_html += f"<p><strong>Erreur {i+1}:</strong> <em>{error}</em></p>"
-                                    error_html += "</div>"
-                                    display_html += error_html
-                                
-                                # Afficher les exécutions d'outils
-                                if tool_executions:
-                                    tools_html = """
-                                    <div class="tools-block">
-                                    <h4>🛠️ Outils exécutés:</h4>
-                                    """
-                                    for i, tool_exec in enumerate(tool_executions):
-                                        tools_html += f"<p><strong>Outil {i+1}:</strong> {tool_exec['name']} - {tool_exec['description']}</p>"
-                                        if 'result' in tool_exec:
-                                            tools_html += f"<p><strong>Résultat:</strong> {tool_exec['result']}</p>"
-                                    tools_html += "</div>"
-                                    display_html += tools_html
-                                
-                                # Utiliser HTML pour créer la mise en page des recherches
-                                if search_queries:
-                                    search_html = """
-                                    <div class="search-block">
-                                    <h4>🔍 Recherches effectuées:</h4>
-                                    """
-                                    for i, query in enumerate(search_queries):
-                                        search_html += f"<p><strong>Recherche {i+1}:</strong> <em>{query}</em></p>"
-                                    search_html += "</div>"
-                                    display_html += search_html
-                                
-                                # Ajouter la réponse actuelle
-                                display_html += f"<div>{complete_response_text}</div>"
-                                
-                                # Utiliser un composant html pour garantir le rendu CSS
-                                response_placeholder.markdown(display_html, unsafe_allow_html=True)
+                                # Plafond du tour ou de la session atteint : on arrête la génération
+                                if not turn.on_text(text):
+                                    break
                     
                     elif event.type == "content_block_stop":
                         if building_query:
@@ -670,7 +1000,8 @@ if prompt:
                                         tool_data = json.loads(tool_json)
                                         
                                         # Exécuter l'outil local
-                                        tool_result = execute_local_tool(current_tool_name, tool_data)
+                                        with timer.tool_call(current_tool_name):
+                                            tool_result = execute_local_tool(current_tool_name, tool_data)
                                         
                                         # Ajouter à la liste des exécutions d'outils
                                         tool_execution = {
@@ -693,99 +1024,68 @@ if prompt:
                             current_tool_name = None
                             tool_parts = []
                         
-                        # Mise à jour de l'affichage après traitement des outils
-                        display_html = ""
-                        
-                        # Afficher les erreurs de recherche s'il y en a
-                        if st.session_state.search_errors:
-                            error_html = """
-                            <div class="error-block">
-                            <h4>⚠️ Erreurs de recherche:</h4>
-                            """
-                            for i, error in enumerate(st.session_state.search_errors):
-                                error_html += f"<p><strong>Erreur {i+1}:</strong> <em>{error}</em></p>"
-                            error_html += "</div>"
-                            display_html += error_html
-                        
-                        # Afficher les exécutions d'outils
-                        if tool_executions:
-                            tools_html = """
-                            <div class="tools-block">
-                            <h4>🛠️ Outils exécutés:</h4>
-                            """
-                            for i, tool_exec in enumerate(tool_executions):
-                                tools_html += f"<p><strong>Outil {i+1}:</strong> {tool_exec['name']} - {tool_exec['description']}</p>"
-                                if 'result' in tool_exec:
-                                    tools_html += f"<p><strong>Résultat:</strong> {tool_exec['result']}</p>"
-                            tools_html += "</div>"
-                            display_html += tools_html
-                        
-                        # Utiliser HTML pour créer la mise en page des recherches
-                        if search_queries:
-                            search_html = """
-                            <div class="search-block">
-                            <h4>🔍 Recherches effectuées:</h4>
-                            """
-                            for i, query in enumerate(search_queries):
-                                search_html += f"<p><strong>Recherche {i+1}:</strong> <em>{query}</em></p>"
-                            search_html += "</div>"
-                            display_html += search_html
-                        
-                        # Ajouter la réponse actuelle
-                        display_html += f"<div>{complete_response_text}</div>"
-                        
-                        # Utiliser un composant html pour garantir le rendu CSS
-                        response_placeholder.markdown(display_html, unsafe_allow_html=True)
+                        # Mise à jour des blocs statiques après traitement des outils
+                        renderer.set_block("errors", build_errors_html(st.session_state.search_errors))
+                        renderer.set_block("tools", build_tools_html(tool_executions))
+                        renderer.set_block("searches", build_searches_html(search_queries))
+                
+                renderer.flush()
                 
-                # Récupérer le message final
-                final_message = stream.get_final_message()
+                # Récupérer le message final (partiel si la génération a été arrêtée par le budget)
+                if turn.stop_reason:
+                    final_message = stream.current_message_snapshot
+                    interruption = f"\n\n⚠️ Réponse interrompue : {turn.stop_reason}."
+                    complete_response_text += interruption
+                    renderer.append_text(interruption)
+                    renderer.flush()
+                else:
+                    final_message = stream.get_final_message()
+                timer.finish()
                 
                 # Extraire les citations des blocs de contenu
                 citations = extract_citations_from_blocks(final_message.content)
                 
-                # Récupérer les statistiques d'utilisation
-                usage = final_message.usage
-                input_tokens = usage.input_tokens if usage else "Non disponible"
-                output_tokens = usage.output_tokens if usage else "Non disponible"
-                web_search_requests = usage.server_tool_use.web_search_requests if usage and usage.server_tool_use else 0
+                # Usage réel de la réponse (les PDF sont compris dans les tokens d'entrée) ;
+                # un message interrompu n'a pas encore son compte de sortie : on garde l'estimation
+                usage = anthropic_usage(final_message.usage, model)
+                if turn.stop_reason:
+                    usage.output_tokens = max(usage.output_tokens, turn.estimated_usage("anthropic", model).output_tokens)
+                turn.record(usage)
+                input_tokens = usage.input_tokens
+                output_tokens = usage.output_tokens
+                web_search_requests = usage.searches
+                cache_creation_tokens = usage.cache_write_tokens
+                cache_read_tokens = usage.cache_read_tokens
                 
                 # Calculer le temps de réponse
                 response_time = round(time.time() - start_time, 2)
                 
-                # Afficher les statistiques d'utilisation
-                try:
-                    entry_cost = (int(input_tokens) / 1000000) * 3
-                    output_cost = (int(output_tokens) / 1000000) * 15
-                    search_cost = (int(web_search_requests) / 1000) * 10
-                    total_cost = entry_cost + output_cost + search_cost
-                except:
-                    entry_cost = output_cost = search_cost = total_cost = 0
-                
-                # Ajouter un coût supplémentaire si un PDF a été utilisé
-                pdf_cost = 0
-                if pdf_data:
-                    # Estimation du coût basée sur la taille du PDF (à ajuster selon vos tarifs)
-                    pdf_size_mb = len(pdf_data) / (1024 * 1024)  # Convertir en Mo
-                    pdf_cost = pdf_size_mb * 0.01  # Coût fictif, à adapter
-                    total_cost += pdf_cost
-                
-                # Coût des outils personnalisés (estimation)
-                tool_cost = len(tool_executions) * 0.001
-                total_cost += tool_cost
+                # Coûts selon la grille tarifaire du modèle
+                costs = usage.costs()
+                entry_cost = costs["entry_cost"]
+                output_cost = costs["output_cost"]
+                cache_cost = costs["cache_cost"]
+                search_cost = costs["search_cost"]
+                total_cost = costs["total_cost"]
                 
                 stats_placeholder.markdown(
                     f"""
                     ⏱️ Temps de réponse: {response_time} secondes | 
                     🔤 Tokens d'entrée: {input_tokens} | 
                     💲 Coût en tokens d'entrée estimé: {entry_cost:.6f} | 
+                    🗄️ Tokens en cache (écrits / lus): {cache_creation_tokens} / {cache_read_tokens} | 
+                    💲 Coût du cache estimé: {cache_cost:.6f} | 
                     🔤 Tokens de sortie: {output_tokens} | 
                     💲 Coût en tokens de sortie estimé: {output_cost:.6f} | 
-                    🔎 Recherches web: {web_search_requests} | 
+                    🔎 Recherches web: {web_search_requests}{f" / {search_uses} ({search_profile.label})" if search_profile else ""} | 
                     💲 Coût en recherches web estimé: {search_cost:.6f} |
                     🛠️ Outils exécutés: {len(tool_executions)} |
-                    {"📄 Document PDF traité |" if pdf_data else ""}
+                    {"📄 Document PDF traité |" if new_documents else ""}
+                    {f"🗜️ Tokens économisés par la compaction: {compaction.tokens_saved} |" if compaction else ""}
                     💲 Coût total estimé: {total_cost:.6f} |
-                    Raison d'arrêt: {final_message.stop_reason}
+                    {f"💳 Budget de session: {st.session_state.governor.summary()} |" if st.session_state.governor.enabled else ""}
+                    Raison d'arrêt: {turn.stop_reason or final_message.stop_reason}
+                    {f"| 🖼️ Rendu: {renderer.render_time * 1000:.0f} ms en {renderer.frames} mises à jour" if debug_mode else ""}
                     """
                 )
                 
@@ -813,79 +1113,41 @@ if prompt:
                 st.session_state.usage_stats = {
                     "input_tokens": input_tokens,
                     "output_tokens": output_tokens,
+                    "cache_creation_input_tokens": cache_creation_tokens,
+                    "cache_read_input_tokens": cache_read_tokens,
                     "web_search_requests": web_search_requests,
                     "tool_executions": len(tool_executions),
+                    "compaction_tokens_saved": compaction.tokens_saved if compaction else 0,
                     "response_time": response_time
                 }
                 st.session_state.response_time = response_time
                 
                 # Construire la réponse finale complète avec les recherches, erreurs, outils et citations en HTML
-                final_html = ""
-                
-                # Ajouter le bloc d'erreurs si nécessaire
-                if st.session_state.search_errors:
-                    error_html = """
-                    <div class="error-block">
-                    <h4>⚠️ Erreurs de recherche:</h4>
-                    """
-                    for i, error in enumerate(st.session_state.search_errors):
-                        error_html += f"<p><strong>Erreur {i+1}:</strong> <em>{error}</em></p>"
-                    error_html += "</div>"
-                    final_html += error_html
-                
-                # Ajouter le bloc document si un PDF a été utilisé
-                if pdf_data:
-                    pdf_names = []
-                    if hasattr(st.session_state.uploaded_file, '__iter__'):
-                        for file in st.session_state.uploaded_file:
-                            if hasattr(file, 'name'):
-                                pdf_names.append(file.name)
-                    if not pdf_names:
-                        pdf_names = ["Document PDF"]
-                    
-                    document_html = f"""
-                    <div class="document-block">
-                    <h4>📄 Document(s) de référence utilisé(s):</h4>
-                    """
-                    for name in pdf_names:
-                        document_html += f"<p>{name}</p>"
-                    document_html += "</div>"
-                    final_html += document_html
-                
-                # Ajouter le bloc des outils exécutés
-                if tool_executions:
-                    tools_html = """
-                    <div class="tools-block">
-                    <h4>🛠️ Outils exécutés:</h4>
-                    """
-                    for i, tool_exec in enumerate(tool_executions):
-                        tools_html += f"<p><strong>Outil {i+1}:</strong> {tool_exec['name']} - {tool_exec['description']}</p>"
-                        if 'result' in tool_exec:
-                            tools_html += f"<p><strong>Résultat:</strong> {tool_exec['result']}</p>"
-                    tools_html += "</div>"
-                    final_html += tools_html
-                
-                # Ajouter le bloc de recherches si nécessaire
-                if search_queries:
-                    search_html = """
-                    <div class="search-block">
-                    <h4>🔍 Recherches effectuées:</h4>
-                    """
-                    for i, query in enumerate(search_queries):
-                        search_html += f"<p><strong>Recherche {i+1}:</strong> <em>{query}</em></p>"
-                    search_html += "</div>"
-                    final_html += search_html
+                final_html = build_errors_html(st.session_state.search_errors)
+                if new_documents:
+                    final_html += build_documents_html(
+                        [st.session_state.document_registry[digest]["name"] for digest in new_documents]
+                    )
+                final_html += build_tools_html(tool_executions)
+                final_html += build_searches_html(search_queries)
                 
                 # Ajouter la réponse
                 final_html += f"<div>{complete_response_text}</div>"
                 
-                # Ajouter la réponse à l'historique (avec les recherches, outils et citations incluses)
-                st.session_state.messages.append({"role": "assistant", "content": final_html})
+                # Ajouter la réponse à l'historique : HTML (recherches, outils, citations) pour l'affichage,
+                # texte seul pour les prochaines requêtes
+                st.session_state.messages.append({
+                    "role": "assistant",
+                    "content": final_html,
+                    "api_content": complete_response_text or "(réponse vide)",
+                    "citations": list(dict.fromkeys(c["url"] for c in citations if c["url"]))
+                })
                 
                 # Mettre à jour l'affichage une dernière fois
                 response_placeholder.markdown(final_html, unsafe_allow_html=True)
         
         except Exception as e:
+            timer.finish(error=True)
             st.error(f"Erreur lors de la communication avec l'API: {str(e)}")
 
 
@@ -6,6 +6,11 @@ from google import genai
 from google.genai import types
 import time
 import pathlib
+import sys
+
+# Comptage de l'usage et grille tarifaire (partagés avec gemini_chat)
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.parent / "gemini_chat"))
+from src.utils.usage import gemini_usage, gemini_search_count, get_pricing
 
 # Charger les variables d'environnement depuis le fichier .env
 load_dotenv()
@@ -54,22 +59,20 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-# Fonction pour estimer le coût
-def estimate_cost(input_tokens=0, output_tokens=0, web_searches=0):
-    """Estime le coût basé sur les tokens et recherches web"""
-    input_cost = (input_tokens / 1_000_000) * 3.0  # 3$ par million de tokens d'input
-    output_cost = (output_tokens / 1_000_000) * 15.0  # 15$ par million de tokens d'output
-    search_cost = web_searches * 0.035  # 0.035$ par recherche internet
-    
-    total_cost = input_cost + output_cost + search_cost
+MODEL = "gemini-2.5-pro-preview-06-05"
+
+# Fonction pour calculer le coût
+def estimate_cost(usage):
+    """Coût d'une réponse d'après son usage réel et la grille tarifaire du modèle"""
+    costs = usage.costs()
     return {
-        'input_cost': input_cost,
-        'output_cost': output_cost,
-        'search_cost': search_cost,
-        'total_cost': total_cost,
-        'input_tokens': input_tokens,
-        'output_tokens': output_tokens,
-        'web_searches': web_searches
+        'input_cost': costs['entry_cost'] + costs['cache_cost'],
+        'output_cost': costs['output_cost'],
+        'search_cost': costs['search_cost'],
+        'total_cost': costs['total_cost'],
+        'input_tokens': usage.input_tokens + usage.cache_read_tokens,
+        'output_tokens': usage.output_tokens,
+        'web_searches': usage.searches
     }
 
 
@@ -170,7 +173,7 @@ def generate_legal_response(chat_input_value):
         
         # Initialisation du client
         client = genai.Client(api_key=api_key)
-        model = "gemini-2.5-pro-preview-06-05"
+        model = MODEL
         
         # Extraire le texte et les fichiers du chat_input
         if isinstance(chat_input_value, str):
@@ -250,7 +253,6 @@ Citations :
         
         # Génération de la réponse avec estimation des coûts et extraction des citations
         response_text = ""
-        estimated_web_searches = 2  # Estimation basée sur l'utilisation des outils de recherche
         citations = {}
         
         response = client.models.generate_content(
@@ -269,20 +271,12 @@ Citations :
             if hasattr(candidate, 'grounding_metadata'):
                 citations = extract_citations(candidate)
         
-        # Estimation des coûts
-        # Extraire les tokens usage_metadata
-                if (hasattr(response, 'usage_metadata') and 
-                    response.usage_metadata is not None):
-                    
-                    usage = response.usage_metadata
-                    input_tokens = getattr(usage, 'prompt_token_count', 0)
-                    output_tokens = getattr(usage, 'candidates_token_count', 0)
-        
-        # Ajouter les tokens des fichiers (estimation approximative)
-        for file_part in file_parts:
-            input_tokens += 1000  # Estimation moyenne par fichier
-        
-        cost_info = estimate_cost(input_tokens, output_tokens, estimated_web_searches)
+        # Coûts d'après usage_metadata (fichiers et tokens de raisonnement compris)
+        # et les requêtes Google Search réellement lancées
+        usage = gemini_usage(
+            getattr(response, 'usage_metadata', None), model, searches=gemini_search_count(response)
+        )
+        cost_info = estimate_cost(usage)
         
         # Mettre à jour le coût total de la session
         if 'total_session_cost' in st.session_state:
@@ -322,13 +316,12 @@ def main():
     # Sidebar avec informations
     with st.sidebar:
         st.header("💰 Tarification")
-        st.write("""
+        pricing = get_pricing(MODEL)
+        st.write(f"""
           **Coûts par requête :**
-          - Input : **3$/M tokens**
-          - Output : **15$/M tokens**
-          - Recherche web : **0.035$/requête**
-        
-          *Coût moyen par question : ~0.04-0.1$*
+          - Input : **{pricing.input:g}$/M tokens**
+          - Output : **{pricing.output:g}$/M tokens**
+          - Recherche web : **{pricing.per_search:g}$/requête**
         """)
         
 
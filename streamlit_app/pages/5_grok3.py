@@ -22,6 +22,11 @@ streamlit_app_dir = current_file.parent.parent  # Remonter à streamlit_app/
 # Ajouter streamlit_app au sys.path
 sys.path.insert(0, str(streamlit_app_dir))
 
+# Composants partagés de gemini_chat (rendu du streaming)
+sys.path.insert(0, str(streamlit_app_dir.parent / "gemini_chat"))
+from src.ui.stream_renderer import ThrottledStreamRenderer, RenderStats
+from src.utils.usage import BudgetGovernor, BudgetLimits, BudgetExceededError, get_pricing
+
 try:
     from grok31.grok3_utils import call_grok
     st.success("✅ Import réussi!")
@@ -103,14 +108,6 @@ AVAILABLE_MODELS = {
     "Grok-3 Mini Fast": "grok-3-mini-fast"
 }
 
-# Dictionnaire des coûts par modèle (prix par million de tokens)
-MODEL_COSTS = {
-    "grok-3-latest": {"input_cost": 3.00, "output_cost": 15.00},
-    "grok-3-mini": {"input_cost": 0.30, "output_cost": 0.50},
-    "grok-3-fast": {"input_cost": 5.00, "output_cost": 25.00},
-    "grok-3-mini-fast": {"input_cost": 0.60, "output_cost": 4.00}
-}
-
 MODEL = "grok-3-latest"  # Variable globale pour le modèle actuel
 
 # ================================
@@ -122,16 +119,14 @@ def calculate_tokens_from_chars(char_count: int) -> int:
     return max(1, char_count // 5)
 
 def calculate_cost_from_chars(input_chars: int, output_chars: int, model_code: str) -> float:
-    """Calcule le coût basé sur le nombre de caractères."""
-    if model_code not in MODEL_COSTS:
-        return 0.0
+    """Estime le coût basé sur le nombre de caractères (quand l'API n'a pas renvoyé d'usage)."""
+    pricing = get_pricing(model_code)
     
     input_tokens = calculate_tokens_from_chars(input_chars)
     output_tokens = calculate_tokens_from_chars(output_chars)
     
-    cost_info = MODEL_COSTS[model_code]
-    input_cost = (input_tokens / 1_000_000) * cost_info['input_cost']
-    output_cost = (output_tokens / 1_000_000) * cost_info['output_cost']
+    input_cost = (input_tokens / 1_000_000) * pricing.input
+    output_cost = (output_tokens / 1_000_000) * pricing.output
     
     return input_cost + output_cost
 
@@ -164,6 +159,12 @@ def initialize_session_state() -> None:
     
     if 'last_response_metrics' not in st.session_state:
         st.session_state.last_response_metrics = None
+    
+    if 'render_stats' not in st.session_state:
+        st.session_state.render_stats = RenderStats()
+    
+    if 'governor' not in st.session_state:
+        st.session_state.governor = BudgetGovernor(BudgetLimits.from_env())
 
 # ================================
 # FONCTIONS D'INTERFACE UTILISATEUR
@@ -206,12 +207,13 @@ def render_sidebar_information() -> None:
         st.markdown("**🔄 Mode :** Streaming temps réel")
         
         # Affichage des coûts du modèle sélectionné
-        if MODEL in MODEL_COSTS:
-            cost_info = MODEL_COSTS[MODEL]
-            with st.expander("💰 Tarifs du modèle", expanded=False):
-                st.write(f"• **Entrée:** ${cost_info['input_cost']:.2f} / million tokens")
-                st.write(f"• **Sortie:** ${cost_info['output_cost']:.2f} / million tokens")
-                st.caption("💡 *1 token ≈ 5 caractères*")
+        pricing = get_pricing(MODEL)
+        with st.expander("💰 Tarifs du modèle", expanded=False):
+            st.write(f"• **Entrée:** ${pricing.input:.2f} / million tokens")
+            st.write(f"• **Sortie:** ${pricing.output:.2f} / million tokens")
+            st.write(f"• **Source consultée:** ${pricing.per_search:.3f}")
+            if st.session_state.governor.enabled:
+                st.caption(f"💳 Budget de session : {st.session_state.governor.summary()}")
         
         # Métriques de la dernière réponse
         if st.session_state.last_response_metrics:
@@ -229,6 +231,10 @@ def render_sidebar_information() -> None:
                 with st.expander("🔗 Citations"):
                     for i, citation in enumerate(metrics['citations'][:5], 1):
                         st.write(f"{i}. {citation[:100]}...")
+        
+        # Statistiques de rendu du streaming (session)
+        if st.session_state.render_stats.frames:
+            st.caption(st.session_state.render_stats.summary())
 
 def render_conversation_display() -> None:
     """Affiche l'historique de conversation dans un format chat."""
@@ -361,8 +367,12 @@ def handle_user_query_submission(query: str) -> None:
         st.warning("⚠️ Veuillez entrer une question avant d'envoyer.")
         return
     
-    # Calculer le coût de la question
-    question_cost = calculate_cost_from_chars(len(query), 0, MODEL)
+    # Budget de la session : aucun nouvel appel une fois épuisé
+    try:
+        turn = st.session_state.governor.start_turn()
+    except BudgetExceededError as error:
+        st.error(f"⛔ {error}")
+        return
     
     # Vérification de fichiers joints
     has_uploaded_file = bool(st.session_state.uploaded_files)
@@ -393,38 +403,61 @@ def handle_user_query_submission(query: str) -> None:
         # Container pour le streaming
         response_container = st.empty()
         status_container = st.empty()
+        renderer = ThrottledStreamRenderer(response_container, cursor="", stats=st.session_state.render_stats)
         complete_response = ""
         final_result = None
+        citations = []
         
         try:
+            turn.begin_stream(MODEL, calculate_tokens_from_chars(len(enhanced_query)))
+            
             # Streaming en temps réel avec le générateur
             with st.spinner("🤖 Génération de la réponse en cours..."):
-                for item in call_grok(MODEL, enhanced_query):
-                    if isinstance(item, dict):
-                        # C'est le résultat final
-                        if item.get("type") == "final_result":
-                            final_result = item
-                            status_container.markdown("✅ *Réponse générée avec succès*")
-                            break
-                        elif item.get("type") == "error":
-                            # Gestion d'erreur
-                            error_msg = f"❌ Erreur: {item['message']}"
-                            response_container.error(error_msg)
-                            status_container.empty()
-                            add_message_to_history("assistant", error_msg)
-                            return
-                    else:
-                        # C'est un chunk de texte
-                        complete_response += item
-                        response_container.markdown(complete_response)
+                grok_stream = call_grok(MODEL, enhanced_query)
+                try:
+                    for item in grok_stream:
+                        if isinstance(item, dict):
+                            # Citations reçues jusqu'ici
+                            if item.get("type") == "citations":
+                                citations = item["citations"]
+                            # C'est le résultat final
+                            elif item.get("type") == "final_result":
+                                final_result = item
+                                status_container.markdown("✅ *Réponse générée avec succès*")
+                                break
+                            elif item.get("type") == "error":
+                                # Gestion d'erreur
+                                error_msg = f"❌ Erreur: {item['message']}"
+                                response_container.error(error_msg)
+                                status_container.empty()
+                                add_message_to_history("assistant", error_msg)
+                                return
+                        else:
+                            # C'est un chunk de texte
+                            renderer.append(item)
+                            
+                            # Plafond du tour ou de la session atteint : on arrête la génération
+                            if not turn.on_text(item):
+                                renderer.append(f"\n\n⚠️ Réponse interrompue : {turn.stop_reason}.")
+                                final_result = {"type": "final_result", "citations": citations, "usage": None}
+                                break
+                finally:
+                    # Ferme la connexion et termine la mesure de la réponse, même après un arrêt anticipé
+                    grok_stream.close()
+            
+            # Dernier rendu (fragments en attente)
+            complete_response = renderer.finalize()
             
             # Nettoyage du statut
             status_container.empty()
             
             # Traitement du résultat final
             if final_result:
-                # Calculer le coût total de la conversation
-                total_cost = calculate_cost_from_chars(len(enhanced_query), len(complete_response), MODEL)
+                # Coût d'après l'usage renvoyé par l'API, sinon d'après l'estimation du tour
+                # (la même que celle imputée au budget)
+                usage = final_result.get('usage') or turn.estimated_usage("xai", MODEL)
+                turn.record(usage)
+                total_cost = usage.total_cost
                 
                 # Stocker les métriques pour la sidebar
                 st.session_state.last_response_metrics = {
@@ -13,6 +13,10 @@ from datetime import datetime
 import uuid
 import hashlib
 import random
+import re
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor, wait
+from difflib import SequenceMatcher
 
 # Import Gemini
 from google import genai
@@ -20,6 +24,13 @@ import tempfile
 from pathlib import Path
 # Import supplémentaire pour les requêtes HTTP synchrones
 import requests
+import sys
+
+# Sélection de l'historique dans un budget de tokens (partagée avec gemini_chat)
+sys.path.insert(0, str(Path(__file__).parent.parent.parent / "gemini_chat"))
+from src.utils.context_packer import ContextPacker, estimate_pdf_tokens
+from src.utils.metrics import get_registry
+from src.utils.usage import Usage, anthropic_usage, gemini_usage, gemini_search_count, openai_usage
 
 # Configuration de la page Streamlit - DOIT ÊTRE EN PREMIER
 st.set_page_config(
@@ -40,6 +51,10 @@ except ImportError:
 # Chargement des variables d'environnement
 load_dotenv()
 
+# URLs des API (surchargées pour pointer vers l'émulateur local, cf. benchmarks/)
+PERPLEXITY_API_URL = os.getenv("PERPLEXITY_BASE_URL", "https://api.perplexity.ai").rstrip("/") + "/chat/completions"
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL")
+
 # ==================== ANONYMISATION DES MODÈLES ====================
 
 # Dictionnaire des noms anonymisés
@@ -323,6 +338,24 @@ def get_firebase_stats(db):
 
 # ==================== FONCTIONS API ====================
 
+# Délai maximal (secondes) accordé à chaque panneau de la comparaison. Les appels SDK
+# tournent dans un thread que wait_for ne peut pas interrompre : le même délai est passé
+# aux clients pour que la requête HTTP elle-même s'arrête (et cesse d'être facturée)
+MODEL_QUERY_TIMEOUT = 120
+
+
+def gemini_http_options():
+    """Options HTTP des clients Gemini de l'arène (délai en millisecondes, URL de l'émulateur)"""
+    options = {"timeout": MODEL_QUERY_TIMEOUT * 1000}
+    if GEMINI_BASE_URL:
+        options["base_url"] = GEMINI_BASE_URL
+    return options
+
+# Recherches Perplexity déclenchées par [SEARCH_QUERY: ...]
+PERPLEXITY_SEARCH_MAX_WORKERS = 3
+PERPLEXITY_SEARCH_DEADLINE = 30
+SEARCH_QUERY_SIMILARITY_THRESHOLD = 0.9
+
 def encode_pdf_to_base64(uploaded_files):
     """Encode un ou plusieurs fichiers PDF téléchargés en base64."""
     if uploaded_files is not None and len(uploaded_files) > 0:
@@ -333,23 +366,86 @@ def encode_pdf_to_base64(uploaded_files):
         return base64_pdf
     return None
 
+def pack_history(message_history, model, prompt, system_prompt, documents_tokens=0):
+    """
+    Historique texte (user/assistant) à envoyer au modèle, choisi dans son budget
+    de tokens d'entrée : interactions récentes, puis anciennes interactions pertinentes.
+    """
+    history = []
+    for m in message_history:
+        if m["role"] in ["user", "assistant"]:
+            content = m["content"]
+            if isinstance(content, list):
+                content = next((item.get("text", "") for item in content 
+                               if isinstance(item, dict) and item.get("type") == "text"), "")
+            if isinstance(content, str):
+                history.append({"role": m["role"], "content": content})
+    
+    packed = ContextPacker.for_model(model).pack(
+        history,
+        query=prompt,
+        system_prompt=system_prompt,
+        documents_tokens=documents_tokens
+    )
+    return packed.messages
+
+def pdf_documents_tokens(pdf_data):
+    """Estimation des tokens d'entrée d'un PDF joint (base64) côté Anthropic"""
+    return estimate_pdf_tokens(base64.b64decode(pdf_data), "anthropic") if pdf_data else 0
+
+def add_prompt_cache_breakpoints(system_prompt, tools, messages):
+    """
+    Ajoute des points de cache Anthropic (cache_control) sur les préfixes stables :
+    outils + prompt système, puis l'historique précédant la nouvelle question.
+    
+    Le document PDF n'est envoyé qu'avec la question courante (l'historique ne
+    garde que le texte), il n'est donc pas mis en cache : l'écriture serait
+    facturée sans jamais être relue.
+    """
+    cache_control = {"type": "ephemeral"}
+    
+    system_blocks = [{"type": "text", "text": system_prompt, "cache_control": cache_control}]
+    
+    cached_tools = [dict(tool) for tool in tools]
+    if cached_tools:
+        cached_tools[-1]["cache_control"] = cache_control
+    
+    cached_messages = [dict(m) for m in messages]
+    if len(cached_messages) > 1:
+        previous = cached_messages[-2]
+        if isinstance(previous["content"], str) and previous["content"]:
+            previous["content"] = [{"type": "text", "text": previous["content"], "cache_control": cache_control}]
+    
+    return system_blocks, cached_tools, cached_messages
+
 def process_claude_query(model_name, messages, system_prompt, tools, api_key, max_tokens, temperature):
     """Traite une requête avec les modèles Claude."""
+    timer = get_registry().stream("anthropic", model_name)
     try:
-        client = anthropic.Anthropic(api_key=api_key)
+        # Nouvelles tentatives par défaut du SDK ; le délai global du panneau reste celui de wait_for
+        client = anthropic.Anthropic(
+            api_key=api_key,
+            timeout=MODEL_QUERY_TIMEOUT,
+            http_client=anthropic.DefaultHttpxClient(
+                event_hooks={"response": [get_registry().retry_hook("anthropic", model_name)]}
+            )
+        )
         
         start_time = time.time()
         
+        system_blocks, cached_tools, cached_messages = add_prompt_cache_breakpoints(system_prompt, tools, messages)
+        
         response = client.messages.create(
             model=model_name,
             max_tokens=max_tokens,
             temperature=temperature,
-            system=system_prompt,
-            messages=messages,
-            tools=tools
+            system=system_blocks,
+            messages=cached_messages,
+            tools=cached_tools
         )
         
         response_time = round(time.time() - start_time, 2)
+        timer.finish()
         
         content = ""
         sources = []
@@ -368,43 +464,30 @@ def process_claude_query(model_name, messages, system_prompt, tools, api_key, ma
                     }
                     sources.append(source_info)
         
-        usage = response.usage
-        input_tokens = usage.input_tokens if usage else 0
-        output_tokens = usage.output_tokens if usage else 0
-        web_search_requests = usage.server_tool_use.web_search_requests if usage and usage.server_tool_use else 0
-        
-        try:
-            if "haiku" in model_name.lower():
-                entry_cost = (int(input_tokens) / 1000000) * 0.8    # Vos tarifs Haiku
-                output_cost = (int(output_tokens) / 1000000) * 4.0  # Vos tarifs Haiku
-            elif "sonnet-4" in model_name.lower():
-                entry_cost = (int(input_tokens) / 1000000) * 3.0    # Estimation Sonnet 4
-                output_cost = (int(output_tokens) / 1000000) * 15.0 # Estimation Sonnet 4
-            else:  # Sonnet 3.7
-                entry_cost = (int(input_tokens) / 1000000) * 3.0    # Vos tarifs Sonnet 3.7
-                output_cost = (int(output_tokens) / 1000000) * 15.0 # Vos tarifs Sonnet 3.7
-            
-            search_cost = (int(web_search_requests) / 1000) * 10    # Estimation web search Claude
-            total_cost = entry_cost + output_cost + search_cost
-        except:
-            entry_cost = output_cost = search_cost = total_cost = 0
+        # Usage réel et coûts selon la grille tarifaire du modèle (cache de prompt compris)
+        usage = anthropic_usage(response.usage, model_name)
+        costs = usage.costs()
         
         stats = {
-            "input_tokens": input_tokens,
-            "output_tokens": output_tokens,
-            "web_searches": web_search_requests,
+            "input_tokens": usage.input_tokens,
+            "output_tokens": usage.output_tokens,
+            "cache_creation_tokens": usage.cache_write_tokens,
+            "cache_read_tokens": usage.cache_read_tokens,
+            "cache_cost": costs["cache_cost"],
+            "web_searches": usage.searches,
             "response_time": response_time,
             "model": model_name,
             "sources": sources,
-            "entry_cost": entry_cost,
-            "output_cost": output_cost,
-            "search_cost": search_cost,
-            "total_cost": total_cost
+            "entry_cost": costs["entry_cost"],
+            "output_cost": costs["output_cost"],
+            "search_cost": costs["search_cost"],
+            "total_cost": costs["total_cost"]
         }
         
         return content, stats, None
         
     except Exception as e:
+        timer.finish(error=True)
         error_msg = f"Erreur avec {model_name}: {str(e)}"
         return None, None, error_msg
 
@@ -412,7 +495,10 @@ def process_gemini_query(prompt, message_history, gemini_key, max_tokens, temper
     """Traite une requête avec Google Gemini 2.0 Flash et web search."""
     try:
         # Configuration de Gemini avec le nouveau SDK
-        client = genai.Client(api_key=gemini_key)
+        client = genai.Client(
+            api_key=gemini_key,
+            http_options=gemini_http_options()
+        )
         
         start_time = time.time()
         
@@ -424,21 +510,13 @@ def process_gemini_query(prompt, message_history, gemini_key, max_tokens, temper
         Cite tes sources de manière claire avec les URLs.
         Pour toute question relative à la date, la date d'aujourd'hui est le """ + time.strftime("%d/%m/%Y") + "."
         
-        # Préparer l'historique de conversation (simplifié pour le nouveau SDK)
+        # Préparer l'historique de conversation dans le budget de tokens du modèle
         conversation_context = ""
-        for msg in message_history[-4:]:  # Limiter le contexte aux 4 derniers messages
+        for msg in pack_history(message_history, "gemini-2.0-flash-exp", prompt, system_context):
             if msg["role"] == "user":
-                content = msg["content"]
-                if isinstance(content, list):
-                    content = next((item.get("text", "") for item in content 
-                                   if isinstance(item, dict) and item.get("type") == "text"), "")
-                conversation_context += f"User: {content}\n"
-            elif msg["role"] == "assistant":
-                content = msg["content"]
-                if isinstance(content, str) and content:
-                    # Tronquer les réponses longues pour économiser les tokens
-                    truncated_content = content[:200] + "..." if len(content) > 200 else content
-                    conversation_context += f"Assistant: {truncated_content}\n"
+                conversation_context += f"User: {msg['content']}\n"
+            elif msg["content"]:
+                conversation_context += f"Assistant: {msg['content']}\n"
         
         # Construire le prompt complet
         full_prompt = f"{system_context}\n\n"
@@ -479,17 +557,15 @@ def process_gemini_query(prompt, message_history, gemini_key, max_tokens, temper
         # Extraire le contenu
         content = response.text if hasattr(response, 'text') and response.text else "Pas de réponse générée."
         
-        # Estimer les recherches web (le nouveau SDK ne fournit pas toujours ces infos)
-        web_searches = 1 if any(url_indicator in content.lower() for url_indicator in ['http', 'www.', '.fr', '.com']) else 0
-        
-        # Estimation des tokens
-        input_tokens = len(full_prompt) // 4
-        output_tokens = len(content) // 4
-        
-        # Calculer les coûts pour Gemini 2.0 Flash (vos tarifs)
-        input_cost = (input_tokens / 1000000) * 0.1   # Vos tarifs : $0.1 per 1M input tokens
-        output_cost = (output_tokens / 1000000) * 0.4  # Vos tarifs : $0.4 per 1M output tokens
-        search_cost = web_searches * 0.005
+        # Usage réel (usage_metadata) et recherches Google réellement lancées
+        usage = gemini_usage(response.usage_metadata, "gemini-2.0-flash-exp", searches=gemini_search_count(response))
+        costs = usage.costs()
+        input_tokens = usage.input_tokens + usage.cache_read_tokens
+        output_tokens = usage.output_tokens
+        web_searches = usage.searches
+        input_cost = costs["entry_cost"] + costs["cache_cost"]
+        output_cost = costs["output_cost"]
+        search_cost = costs["search_cost"]
         
         # Coût PDF (si présent)
         pdf_cost = 0
@@ -531,11 +607,150 @@ def process_gemini_query(prompt, message_history, gemini_key, max_tokens, temper
         error_msg = f"Erreur avec Gemini: {str(e)}"
         return None, None, error_msg
 
+def normalize_search_query(query):
+    """Normalise une requête (casse, accents, ponctuation, espaces) pour la comparaison"""
+    query = unicodedata.normalize("NFKD", query.lower())
+    query = "".join(c for c in query if not unicodedata.combining(c))
+    query = re.sub(r"[^\w\s]", " ", query)
+    return " ".join(query.split())
+
+def deduplicate_search_queries(queries, similarity_threshold=SEARCH_QUERY_SIMILARITY_THRESHOLD):
+    """Supprime les requêtes identiques ou quasi identiques en conservant l'ordre d'apparition"""
+    unique_queries = []
+    normalized_seen = []
+    
+    for query in queries:
+        query = query.strip()
+        normalized = normalize_search_query(query)
+        if not normalized:
+            continue
+        
+        is_duplicate = any(
+            normalized == seen or SequenceMatcher(None, normalized, seen).ratio() >= similarity_threshold
+            for seen in normalized_seen
+        )
+        if not is_duplicate:
+            unique_queries.append(query)
+            normalized_seen.append(normalized)
+    
+    return unique_queries
+
+def run_perplexity_search(query, perplexity_key, timeout):
+    """Effectue une recherche Perplexity non streamée et retourne son résultat"""
+    try:
+        # Préparer la requête Perplexity
+        url = PERPLEXITY_API_URL
+        
+        payload = {
+            "temperature": 0.2,
+            "top_p": 0.9,
+            "return_images": False,
+            "return_related_questions": False,
+            "top_k": 0,
+            "stream": False,
+            "presence_penalty": 0,
+            "frequency_penalty": 1,
+            "web_search_options": {"search_context_size": "medium"},  # Medium pour optimiser coût/qualité
+            "model": "sonar-pro",
+            "messages": [
+                {
+                    "role": "system",
+                    "content": "Tu es un expert juridique français. Fournis des informations précises avec les sources de la façon la plus détaillée possible."
+                },
+                {
+                    "role": "user",
+                    "content": query
+                }
+            ],
+            "max_tokens": 2000,
+            "search_domain_filter": [
+                "www.legifrance.gouv.fr",
+                "www.service-public.fr",
+                "annuaire-entreprises.data.gouv.fr"
+            ],
+        }
+        
+        headers = {
+            "Authorization": f"Bearer {perplexity_key}",
+            "Content-Type": "application/json"
+        }
+        
+        # Effectuer la recherche Perplexity
+        search_response = requests.post(url, json=payload, headers=headers, timeout=timeout)
+        
+        if search_response.status_code != 200:
+            return {
+                "query": query,
+                "content": f"Erreur lors de la recherche: HTTP {search_response.status_code}",
+                "cost": 0,
+                "ok": False
+            }
+        
+        search_data = search_response.json()
+        search_content = search_data['choices'][0]['message']['content'] if 'choices' in search_data else ""
+        
+        # Coût Perplexity (tokens et forfait par requête)
+        search_cost = openai_usage(search_data.get('usage'), "perplexity", payload["model"]).total_cost
+        
+        return {
+            "query": query,
+            "content": search_content,
+            "cost": search_cost,
+            "ok": True
+        }
+        
+    except Exception as search_error:
+        print(f"Erreur recherche Perplexity: {search_error}")
+        return {
+            "query": query,
+            "content": f"Erreur lors de la recherche: {search_error}",
+            "cost": 0,
+            "ok": False
+        }
+
+def run_perplexity_searches_concurrently(queries, perplexity_key, max_workers=PERPLEXITY_SEARCH_MAX_WORKERS, deadline=PERPLEXITY_SEARCH_DEADLINE):
+    """
+    Lance les recherches Perplexity en parallèle avec un nombre de workers borné
+    et une échéance commune à toutes les recherches.
+    
+    Returns:
+        tuple: (résultats dans l'ordre des requêtes, durée totale en secondes)
+    """
+    if not queries:
+        return [], 0.0
+    
+    start_time = time.time()
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(queries)))
+    try:
+        futures = [executor.submit(run_perplexity_search, query, perplexity_key, deadline) for query in queries]
+        wait(futures, timeout=deadline)
+        
+        results = []
+        for query, future in zip(queries, futures):
+            if future.done():
+                results.append(future.result())
+            else:
+                future.cancel()
+                results.append({
+                    "query": query,
+                    "content": f"Erreur lors de la recherche: délai de {deadline}s dépassé",
+                    "cost": 0,
+                    "ok": False
+                })
+    finally:
+        # Ne pas attendre les recherches hors délai
+        executor.shutdown(wait=False, cancel_futures=True)
+    
+    return results, time.time() - start_time
+
 def process_gemini_with_perplexity_query(prompt, message_history, gemini_key, perplexity_key, max_tokens, temperature, pdf_data=None):
     """Traite une requête avec Google Gemini 2.0 Flash + Perplexity Search intégré."""
     try:
         # Configuration de Gemini avec le nouveau SDK (SANS web search natif)
-        client = genai.Client(api_key=gemini_key)
+        client = genai.Client(
+            api_key=gemini_key,
+            http_options=gemini_http_options()
+        )
         
         start_time = time.time()
         
@@ -554,20 +769,13 @@ def process_gemini_with_perplexity_query(prompt, message_history, gemini_key, pe
         Cite tes sources de manière claire.
         Pour toute question relative à la date, la date d'aujourd'hui est le """ + time.strftime("%d/%m/%Y") + "."
         
-        # Préparer l'historique de conversation
+        # Préparer l'historique de conversation dans le budget de tokens du modèle
         conversation_context = ""
-        for msg in message_history[-4:]:
+        for msg in pack_history(message_history, "gemini-2.0-flash-exp", prompt, system_context):
             if msg["role"] == "user":
-                content = msg["content"]
-                if isinstance(content, list):
-                    content = next((item.get("text", "") for item in content 
-                                   if isinstance(item, dict) and item.get("type") == "text"), "")
-                conversation_context += f"User: {content}\n"
-            elif msg["role"] == "assistant":
-                content = msg["content"]
-                if isinstance(content, str) and content:
-                    truncated_content = content[:200] + "..." if len(content) > 200 else content
-                    conversation_context += f"Assistant: {truncated_content}\n"
+                conversation_context += f"User: {msg['content']}\n"
+            elif msg["content"]:
+                conversation_context += f"Assistant: {msg['content']}\n"
         
         # Construire le prompt complet
         full_prompt = f"{system_context}\n\n"
@@ -597,6 +805,8 @@ def process_gemini_with_perplexity_query(prompt, message_history, gemini_key, pe
             model="gemini-2.0-flash-exp",
             contents=contents
         )
+        gemini_total_usage = Usage("gemini", "gemini-2.0-flash-exp")
+        gemini_total_usage.add(gemini_usage(response.usage_metadata, "gemini-2.0-flash-exp"))
         
         initial_content = response.text if hasattr(response, 'text') and response.text else ""
         
@@ -609,75 +819,16 @@ def process_gemini_with_perplexity_query(prompt, message_history, gemini_key, pe
         import re
         search_queries = re.findall(r'\[SEARCH_QUERY:\s*([^\]]+)\]', initial_content)
         
+        search_fanout_time = 0.0
         if search_queries and perplexity_key:
-            # Effectuer les recherches Perplexity UNIQUEMENT
-            for query in search_queries:
-                try:
-                    # Préparer la requête Perplexity
-                    url = "https://api.perplexity.ai/chat/completions"
-                    
-                    payload = {
-                        "temperature": 0.2,
-                        "top_p": 0.9,
-                        "return_images": False,
-                        "return_related_questions": False,
-                        "top_k": 0,
-                        "stream": False,
-                        "presence_penalty": 0,
-                        "frequency_penalty": 1,
-                        "web_search_options": {"search_context_size": "medium"},  # Medium pour optimiser coût/qualité
-                        "model": "sonar-pro",
-                        "messages": [
-                            {
-                                "role": "system",
-                                "content": "Tu es un expert juridique français. Fournis des informations précises avec les sources de la façon la plus détaillée possible."
-                            },
-                            {
-                                "role": "user",
-                                "content": query.strip()
-                            }
-                        ],
-                        "max_tokens": 2000,
-                        "search_domain_filter": [
-                            "www.legifrance.gouv.fr",
-                            "www.service-public.fr",
-                            "annuaire-entreprises.data.gouv.fr"
-                        ],
-                    }
-                    
-                    headers = {
-                        "Authorization": f"Bearer {perplexity_key}",
-                        "Content-Type": "application/json"
-                    }
-                    
-                    # Effectuer la recherche Perplexity
-                    search_response = requests.post(url, json=payload, headers=headers, timeout=30)
-                    
-                    if search_response.status_code == 200:
-                        search_data = search_response.json()
-                        search_content = search_data['choices'][0]['message']['content'] if 'choices' in search_data else ""
-                        
-                        # Calculer le coût Perplexity (vos tarifs)
-                        usage = search_data.get('usage', {})
-                        p_input_tokens = usage.get('prompt_tokens', 0)
-                        p_output_tokens = usage.get('completion_tokens', 0)
-                        search_cost = (p_input_tokens / 1000000) * 1.0 + (p_output_tokens / 1000000) * 1.0 + 0.008  # Vos tarifs $1/$1 + $8 per 1000
-                        perplexity_cost += search_cost
-                        perplexity_searches += 1
-                        
-                        search_results.append({
-                            "query": query.strip(),
-                            "content": search_content,
-                            "cost": search_cost
-                        })
-                        
-                except Exception as search_error:
-                    print(f"Erreur recherche Perplexity: {search_error}")
-                    search_results.append({
-                        "query": query.strip(),
-                        "content": f"Erreur lors de la recherche: {search_error}",
-                        "cost": 0
-                    })
+            # Effectuer les recherches Perplexity UNIQUEMENT, en parallèle et sans doublons
+            unique_queries = deduplicate_search_queries(search_queries)
+            search_results, search_fanout_time = run_perplexity_searches_concurrently(unique_queries, perplexity_key)
+            
+            for result in search_results:
+                perplexity_cost += result["cost"]
+                if result["ok"]:
+                    perplexity_searches += 1
             
             # Si des recherches ont été effectuées, demander à Gemini de synthétiser
             if search_results:
@@ -699,6 +850,7 @@ Intègre naturellement ces informations dans ta réponse et cite les sources app
                     model="gemini-2.0-flash-exp",
                     contents=[synthesis_prompt]
                 )
+                gemini_total_usage.add(gemini_usage(synthesis_response.usage_metadata, "gemini-2.0-flash-exp"))
                 
                 final_content = synthesis_response.text if hasattr(synthesis_response, 'text') and synthesis_response.text else initial_content
         
@@ -707,13 +859,12 @@ Intègre naturellement ces informations dans ta réponse et cite les sources app
         # Nettoyer le contenu final des marqueurs de recherche
         final_content = re.sub(r'\[SEARCH_QUERY:\s*[^\]]+\]', '', final_content).strip()
         
-        # Estimation des tokens
-        input_tokens = len(full_prompt) // 4
-        output_tokens = len(final_content) // 4
-        
-        # Calculer les coûts (UNIQUEMENT Gemini + Perplexity, vos tarifs)
-        gemini_input_cost = (input_tokens / 1000000) * 0.1    # Vos tarifs : $0.1 per 1M input
-        gemini_output_cost = (output_tokens / 1000000) * 0.4  # Vos tarifs : $0.4 per 1M output
+        # Usage réel des deux appels Gemini (réponse initiale et synthèse)
+        gemini_costs = gemini_total_usage.costs()
+        input_tokens = gemini_total_usage.input_tokens + gemini_total_usage.cache_read_tokens
+        output_tokens = gemini_total_usage.output_tokens
+        gemini_input_cost = gemini_costs["entry_cost"] + gemini_costs["cache_cost"]
+        gemini_output_cost = gemini_costs["output_cost"]
         gemini_search_cost = 0.0  # PAS de web search Gemini natif
         
         # Coût PDF
@@ -753,7 +904,8 @@ Intègre naturellement ces informations dans ta réponse et cite les sources app
             "entry_cost": gemini_input_cost,
             "output_cost": gemini_output_cost,
             "search_cost": perplexity_cost,  # UNIQUEMENT coût Perplexity
-            "total_cost": total_cost
+            "total_cost": total_cost,
+            "search_fanout_time": round(search_fanout_time, 2)
         }
         
         return final_content, stats, None
@@ -764,26 +916,16 @@ Intègre naturellement ces informations dans ta réponse et cite les sources app
 
 
 def prepare_perplexity_messages(message_history, new_user_input):
-    """Prépare les messages avec contexte limité aux 4 dernières interactions"""
+    """Prépare les messages avec un historique choisi dans le budget de tokens de sonar-pro"""
+    system_prompt = "Tu es un expert juridique français spécialisé dans le droit français. Tu réponds toujours en français et de manière précise."
     messages = [
         {
             "role": "system",
-            "content": "Tu es un expert juridique français spécialisé dans le droit français. Tu réponds toujours en français et de manière précise."
+            "content": system_prompt
         }
     ]
     
-    recent_history = message_history[-8:] if len(message_history) > 8 else message_history
-    
-    for msg in recent_history:
-        if msg["role"] in ["user", "assistant"]:
-            content = msg["content"]
-            if isinstance(content, list):
-                content = next((item.get("text", "") for item in content 
-                               if isinstance(item, dict) and item.get("type") == "text"), "")
-            messages.append({
-                "role": msg["role"],
-                "content": content
-            })
+    messages.extend(pack_history(message_history, "sonar-pro", new_user_input, system_prompt))
     
     messages.append({
         "role": "user",
@@ -794,10 +936,11 @@ def prepare_perplexity_messages(message_history, new_user_input):
 
 async def process_perplexity_query(user_input, api_key, message_history=None):
     """Traite une requête avec Perplexity AI."""
-    url = "https://api.perplexity.ai/chat/completions"
+    url = PERPLEXITY_API_URL
     
     messages = prepare_perplexity_messages(message_history or [], user_input)
     
+    # Réglages fixes, comme pour les autres concurrents, pour ne pas fausser la comparaison à l'aveugle
     payload = {
         "temperature": 0.2,
         "top_p": 0.9,
@@ -837,17 +980,17 @@ async def process_perplexity_query(user_input, api_key, message_history=None):
             
             content = data['choices'][0]['message']['content'] if 'choices' in data else ""
             
-            input_tokens = data.get('usage', {}).get('prompt_tokens', 0)
-            output_tokens = data.get('usage', {}).get('completion_tokens', 0)
             citations = data.get('citations', [])
             
-            try:
-                entry_cost = (int(input_tokens) / 1000000) * 3.0   # Vos tarifs Perplexity Sonar
-                output_cost = (int(output_tokens) / 1000000) * 15.0 # Vos tarifs Perplexity Sonar  
-                search_cost = (1 / 1000) * 8.0                     # Vos tarifs : $8 per 1000 recherches
-                total_cost = entry_cost + output_cost + search_cost
-            except:
-                entry_cost = output_cost = search_cost = total_cost = 0
+            # Usage réel et coûts selon la grille tarifaire (forfait par requête compté en recherche)
+            usage = openai_usage(data.get('usage'), "perplexity", payload["model"])
+            costs = usage.costs()
+            input_tokens = usage.input_tokens
+            output_tokens = usage.output_tokens
+            entry_cost = costs["entry_cost"]
+            output_cost = costs["output_cost"]
+            search_cost = costs["search_cost"]
+            total_cost = costs["total_cost"]
             
             stats = {
                 "input_tokens": input_tokens,
@@ -868,7 +1011,13 @@ async def process_perplexity_query(user_input, api_key, message_history=None):
         return None, None, f"Erreur Perplexity: {str(e)}"
 
 async def process_model_query(model_name, prompt, message_history, anthropic_key, perplexity_key, gemini_key, max_tokens, temperature, pdf_data=None):
-    """Traite une requête pour n'importe quel modèle"""
+    """
+    Traite une requête pour n'importe quel modèle.
+    
+    Les appels SDK bloquants (Anthropic, Gemini) sont exécutés dans un thread
+    via asyncio.to_thread pour ne pas bloquer la boucle d'événements : deux
+    appels lancés ensemble s'exécutent réellement en parallèle.
+    """
     # récupérer la date actuelle
     date = time.strftime("%d/%m/%Y")
     
@@ -896,14 +1045,9 @@ async def process_model_query(model_name, prompt, message_history, anthropic_key
             ]
         }]
         
-        api_messages = []
-        for m in message_history:
-            if m["role"] in ["user", "assistant"]:
-                content = m["content"]
-                if isinstance(content, list):
-                    content = next((item.get("text", "") for item in content 
-                                   if isinstance(item, dict) and item.get("type") == "text"), "")
-                api_messages.append({"role": m["role"], "content": content})
+        api_messages = pack_history(
+            message_history, "claude-3-5-haiku-latest", prompt, system_prompt, pdf_documents_tokens(pdf_data)
+        )
         
         if pdf_data:
             message_content = [
@@ -922,7 +1066,8 @@ async def process_model_query(model_name, prompt, message_history, anthropic_key
             
         api_messages.append({"role": "user", "content": message_content})
         
-        return process_claude_query(
+        return await asyncio.to_thread(
+            process_claude_query,
             "claude-3-5-haiku-latest",
             api_messages,
             system_prompt,
@@ -951,14 +1096,9 @@ async def process_model_query(model_name, prompt, message_history, anthropic_key
             ]
         }]
         
-        api_messages = []
-        for m in message_history:
-            if m["role"] in ["user", "assistant"]:
-                content = m["content"]
-                if isinstance(content, list):
-                    content = next((item.get("text", "") for item in content 
-                                   if isinstance(item, dict) and item.get("type") == "text"), "")
-                api_messages.append({"role": m["role"], "content": content})
+        api_messages = pack_history(
+            message_history, "claude-3-7-sonnet-20250219", prompt, system_prompt, pdf_documents_tokens(pdf_data)
+        )
         
         if pdf_data:
             message_content = [
@@ -977,7 +1117,8 @@ async def process_model_query(model_name, prompt, message_history, anthropic_key
             
         api_messages.append({"role": "user", "content": message_content})
         
-        return process_claude_query(
+        return await asyncio.to_thread(
+            process_claude_query,
             "claude-3-7-sonnet-20250219",
             api_messages,
             system_prompt,
@@ -1007,14 +1148,9 @@ async def process_model_query(model_name, prompt, message_history, anthropic_key
             ]
         }]
         
-        api_messages = []
-        for m in message_history:
-            if m["role"] in ["user", "assistant"]:
-                content = m["content"]
-                if isinstance(content, list):
-                    content = next((item.get("text", "") for item in content 
-                                   if isinstance(item, dict) and item.get("type") == "text"), "")
-                api_messages.append({"role": m["role"], "content": content})
+        api_messages = pack_history(
+            message_history, "claude-sonnet-4-20250514", prompt, system_prompt, pdf_documents_tokens(pdf_data)
+        )
         
         if pdf_data:
             message_content = [
@@ -1033,7 +1169,8 @@ async def process_model_query(model_name, prompt, message_history, anthropic_key
             
         api_messages.append({"role": "user", "content": message_content})
         
-        return process_claude_query(
+        return await asyncio.to_thread(
+            process_claude_query,
             "claude-sonnet-4-20250514",
             api_messages,
             system_prompt,
@@ -1045,27 +1182,37 @@ async def process_model_query(model_name, prompt, message_history, anthropic_key
     
     elif real_model_name == "Google Gemini":
         # Gemini 2.0 Flash avec web search intégré
-        return process_gemini_query(prompt, message_history, gemini_key, max_tokens, temperature, pdf_data)
+        return await asyncio.to_thread(
+            process_gemini_query, prompt, message_history, gemini_key, max_tokens, temperature, pdf_data
+        )
     
     elif real_model_name == "Google Gemini 2.0 Flash + Perplexity":
         # Gemini 2.0 Flash avec Perplexity Search intégré
-        return process_gemini_with_perplexity_query(prompt, message_history, gemini_key, perplexity_key, max_tokens, temperature, pdf_data)
+        return await asyncio.to_thread(
+            process_gemini_with_perplexity_query,
+            prompt, message_history, gemini_key, perplexity_key, max_tokens, temperature, pdf_data
+        )
     
     elif real_model_name == "Perplexity AI":
-        clean_history = []
-        for m in message_history:
-            content = m["content"]
-            if isinstance(content, list):
-                content = next((item.get("text", "") for item in content 
-                               if isinstance(item, dict) and item.get("type") == "text"), "")
-            if isinstance(content, str):
-                clean_history.append({"role": m["role"], "content": content})
-        
-        return await process_perplexity_query(prompt, perplexity_key, clean_history)
+        return await process_perplexity_query(prompt, perplexity_key, message_history)
     
     else:
         return None, None, f"Modèle {model_name} non supporté"
 
+async def process_model_query_with_timeout(model_name, prompt, message_history, anthropic_key, perplexity_key, gemini_key, max_tokens, temperature, pdf_data=None, timeout=None):
+    """Traite une requête pour un panneau avec un délai maximal propre à ce panneau"""
+    timeout = timeout or MODEL_QUERY_TIMEOUT
+    try:
+        return await asyncio.wait_for(
+            process_model_query(
+                model_name, prompt, message_history, anthropic_key, perplexity_key,
+                gemini_key, max_tokens, temperature, pdf_data
+            ),
+            timeout=timeout
+        )
+    except asyncio.TimeoutError:
+        return None, None, f"Délai dépassé pour {model_name} (>{timeout}s)"
+
 # ==================== SYSTÈME DE VOTE ====================
 
 def init_voting_system():
@@ -1715,6 +1862,7 @@ def display_messages(messages, model_name):
                 ⏱️ {stats.get('response_time', 0)}s | 
                 🔤 In: {stats.get('input_tokens', 0)} | 
                 🔤 Out: {stats.get('output_tokens', 0)} | 
+                {f"🗄️ Cache: {stats.get('cache_read_tokens', 0)} lus / {stats.get('cache_creation_tokens', 0)} écrits | " if stats.get('cache_read_tokens') or stats.get('cache_creation_tokens') else ""}
                 🔍 Recherches: {stats.get('web_searches', 0)} | 
                 💲 Coût: {stats.get('total_cost', 0):.6f}$
                 </div>
@@ -1911,157 +2059,116 @@ if prompt:
                 st.warning("⚠️ PDF ignoré (Perplexity ne le supporte pas)")
     
     # Traiter les réponses des modèles
-    async def process_both_models():
-        with col1:
-            with st.chat_message("assistant"):
-                with st.spinner(f"🤔 {model_left} réfléchit..."):
-                    if debug_mode:
-                        st.write(f"🔍 Debug: Envoi de la requête à {model_left} ({real_left})...")
+    def display_model_result(placeholder, model_name, content, stats, error, pdf_used, messages):
+        """Affiche le résultat d'un modèle dans son panneau et l'ajoute à son historique"""
+        with placeholder.container():
+            if error:
+                st.markdown(f'<div class="error-box">❌ {error}</div>', unsafe_allow_html=True)
+            elif content:
+                st.markdown(f'<div class="response-container">{content}</div>', unsafe_allow_html=True)
+                
+                if stats:
+                    pdf_cost = 0
+                    if pdf_used:
+                        pdf_size_mb = len(pdf_used) / (1024 * 1024)
+                        pdf_cost = pdf_size_mb * 0.01
                     
-                    pdf_for_left = pdf_data if real_left != "Perplexity AI" else None
+                    total_cost = stats['total_cost'] + pdf_cost
                     
-                    content_left, stats_left, error_left = await process_model_query(
-                        model_left, 
-                        user_text, 
-                        st.session_state.messages_left[:-1],
-                        anthropic_key, 
-                        perplexity_key,
-                        gemini_key,
-                        max_tokens, 
-                        temperature,
-                        pdf_for_left
-                    )
+                    # Masquer le vrai nom du modèle - garder anonyme
+                    display_model = model_name
                     
-                    if error_left:
-                        st.markdown(f'<div class="error-box">❌ {error_left}</div>', unsafe_allow_html=True)
-                    elif content_left:
-                        st.markdown(f'<div class="response-container">{content_left}</div>', unsafe_allow_html=True)
-                        
-                        if stats_left:
-                            pdf_cost = 0
-                            if pdf_for_left:
-                                pdf_size_mb = len(pdf_for_left) / (1024 * 1024)
-                                pdf_cost = pdf_size_mb * 0.01
-                            
-                            total_cost = stats_left['total_cost'] + pdf_cost
-                            
-                            # Masquer le vrai nom du modèle - garder anonyme
-                            display_model = model_left
-                            
-                            st.markdown(f"""
-                            <div class="stats-box">
-                            🤖 {display_model} | 
-                            ⏱️ {stats_left['response_time']}s | 
-                            🔤 In: {stats_left['input_tokens']} | 
-                            🔤 Out: {stats_left['output_tokens']} | 
-                            🔍 Recherches: {stats_left['web_searches']} | 
-                            💲 Coût: {total_cost:.6f}$
-                            {"| 📄 PDF traité" if pdf_for_left else ""}
-                            </div>
-                            """, unsafe_allow_html=True)
-                            
-                            if stats_left.get('sources'):
-                                with st.expander("📚 Sources consultées", expanded=False):
-                                    st.markdown('<div class="sources-container">', unsafe_allow_html=True)
-                                    sources_html = '<div class="sources-box">'
-                                    for i, source in enumerate(stats_left['sources']):
-                                        title = source.get('title', 'Source inconnue')
-                                        url = source.get('url', '')
-                                        sources_html += f'<div class="source-item">'
-                                        sources_html += f'<strong>Source {i+1}:</strong> {title}<br>'
-                                        if url:
-                                            sources_html += f'<a href="{url}" target="_blank">🔗 {url}</a><br>'
-                                        if source.get('text'):
-                                            excerpt = source['text'][:150] + "..." if len(source['text']) > 150 else source['text']
-                                            sources_html += f'<em>Extrait: "{excerpt}"</em>'
-                                        sources_html += '</div>'
-                                    sources_html += '</div>'
-                                    st.markdown(sources_html, unsafe_allow_html=True)
-                                    st.markdown('</div>', unsafe_allow_html=True)
-                        
-                        st.session_state.messages_left.append({
-                            "role": "assistant", 
-                            "content": content_left,
-                            "model": model_left,
-                            "stats": stats_left
-                        })
-                    else:
-                        st.error(f"❌ Aucune réponse reçue de {model_left}")
+                    st.markdown(f"""
+                    <div class="stats-box">
+                    🤖 {display_model} | 
+                    ⏱️ {stats['response_time']}s | 
+                    🔤 In: {stats['input_tokens']} | 
+                    🔤 Out: {stats['output_tokens']} | 
+                    {f"🗄️ Cache: {stats.get('cache_read_tokens', 0)} lus / {stats.get('cache_creation_tokens', 0)} écrits | " if stats.get('cache_read_tokens') or stats.get('cache_creation_tokens') else ""}
+                    🔍 Recherches: {stats['web_searches']} | 
+                    💲 Coût: {total_cost:.6f}$
+                    {"| 📄 PDF traité" if pdf_used else ""}
+                    </div>
+                    """, unsafe_allow_html=True)
+                    
+                    if stats.get('sources'):
+                        with st.expander("📚 Sources consultées", expanded=False):
+                            st.markdown('<div class="sources-container">', unsafe_allow_html=True)
+                            sources_html = '<div class="sources-box">'
+                            for i, source in enumerate(stats['sources']):
+                                title = source.get('title', 'Source inconnue')
+                                url = source.get('url', '')
+                                sources_html += f'<div class="source-item">'
+                                sources_html += f'<strong>Source {i+1}:</strong> {title}<br>'
+                                if url:
+                                    sources_html += f'<a href="{url}" target="_blank">🔗 {url}</a><br>'
+                                if source.get('text'):
+                                    excerpt = source['text'][:150] + "..." if len(source['text']) > 150 else source['text']
+                                    sources_html += f'<em>Extrait: "{excerpt}"</em>'
+                                sources_html += '</div>'
+                            sources_html += '</div>'
+                            st.markdown(sources_html, unsafe_allow_html=True)
+                            st.markdown('</div>', unsafe_allow_html=True)
+                
+                messages.append({
+                    "role": "assistant", 
+                    "content": content,
+                    "model": model_name,
+                    "stats": stats
+                })
+            else:
+                st.error(f"❌ Aucune réponse reçue de {model_name}")
+    
+    async def process_both_models():
+        pdf_for_left = pdf_data if real_left != "Perplexity AI" else None
+        pdf_for_right = pdf_data if real_right != "Perplexity AI" else None
+        
+        # Préparer un emplacement par colonne avant de lancer les requêtes
+        with col1:
+            with st.chat_message("assistant"):
+                if debug_mode:
+                    st.write(f"🔍 Debug: Envoi de la requête à {model_left} ({real_left})...")
+                placeholder_left = st.empty()
+                placeholder_left.info(f"🤔 {model_left} réfléchit...")
         
         with col2:
             with st.chat_message("assistant"):
-                with st.spinner(f"🤔 {model_right} réfléchit..."):
-                    if debug_mode:
-                        st.write(f"🔍 Debug: Envoi de la requête à {model_right} ({real_right})...")
-                    
-                    pdf_for_right = pdf_data if real_right != "Perplexity AI" else None
-                    
-                    content_right, stats_right, error_right = await process_model_query(
-                        model_right, 
-                        user_text, 
-                        st.session_state.messages_right[:-1],
-                        anthropic_key, 
-                        perplexity_key,
-                        gemini_key,
-                        max_tokens, 
-                        temperature,
-                        pdf_for_right
-                    )
-                    
-                    if error_right:
-                        st.markdown(f'<div class="error-box">❌ {error_right}</div>', unsafe_allow_html=True)
-                    elif content_right:
-                        st.markdown(content_right)
-                        
-                        if stats_right:
-                            pdf_cost = 0
-                            if pdf_for_right:
-                                pdf_size_mb = len(pdf_for_right) / (1024 * 1024)
-                                pdf_cost = pdf_size_mb * 0.01
-                            
-                            total_cost = stats_right['total_cost'] + pdf_cost
-                            
-                            # Masquer le vrai nom du modèle - garder anonyme
-                            display_model = model_right
-                            
-                            st.markdown(f"""
-                            <div class="stats-box">
-                            🤖 {display_model} | 
-                            ⏱️ {stats_right['response_time']}s | 
-                            🔤 In: {stats_right['input_tokens']} | 
-                            🔤 Out: {stats_right['output_tokens']} | 
-                            🔍 Recherches: {stats_right['web_searches']} | 
-                            💲 Coût: {total_cost:.6f}$
-                            {"| 📄 PDF traité" if pdf_for_right else ""}
-                            </div>
-                            """, unsafe_allow_html=True)
-                            
-                            if stats_right.get('sources'):
-                                sources_html = '<div class="sources-box"><h4>📚 Sources consultées:</h4>'
-                                for i, source in enumerate(stats_right['sources']):
-                                    title = source.get('title', 'Source inconnue')
-                                    url = source.get('url', '')
-                                    sources_html += f'<div class="source-item">'
-                                    sources_html += f'<strong>Source {i+1}:</strong> {title}<br>'
-                                    if url:
-                                        sources_html += f'<a href="{url}" target="_blank">🔗 {url}</a><br>'
-                                    if source.get('text'):
-                                        excerpt = source['text'][:200] + "..." if len(source['text']) > 200 else source['text']
-                                        sources_html += f'<em>Extrait: "{excerpt}"</em>'
-                                    sources_html += '</div>'
-                                sources_html += '</div>'
-                                st.markdown(sources_html, unsafe_allow_html=True)
-                        
-                        st.session_state.messages_right.append({
-                            "role": "assistant", 
-                            "content": content_right,
-                            "model": model_right,
-                            "stats": stats_right
-                        })
-                    else:
-                        st.error(f"❌ Aucune réponse reçue de {model_right}")
+                if debug_mode:
+                    st.write(f"🔍 Debug: Envoi de la requête à {model_right} ({real_right})...")
+                placeholder_right = st.empty()
+                placeholder_right.info(f"🤔 {model_right} réfléchit...")
+        
+        async def run_panel(side, model_name, history, pdf_for_model):
+            result = await process_model_query_with_timeout(
+                model_name, 
+                user_text, 
+                history,
+                anthropic_key, 
+                perplexity_key,
+                gemini_key,
+                max_tokens, 
+                temperature,
+                pdf_for_model
+            )
+            return side, result
+        
+        # Lancer les deux modèles en même temps
+        tasks = [
+            asyncio.create_task(run_panel("left", model_left, st.session_state.messages_left[:-1], pdf_for_left)),
+            asyncio.create_task(run_panel("right", model_right, st.session_state.messages_right[:-1], pdf_for_right))
+        ]
+        
+        # Afficher chaque réponse dans sa colonne dès qu'elle est prête
+        panel_stats = {"left": None, "right": None}
+        for finished in asyncio.as_completed(tasks):
+            side, (content, stats, error) = await finished
+            if side == "left":
+                display_model_result(placeholder_left, model_left, content, stats, error, pdf_for_left, st.session_state.messages_left)
+            else:
+                display_model_result(placeholder_right, model_right, content, stats, error, pdf_for_right, st.session_state.messages_right)
+            panel_stats[side] = stats
         
-        return stats_left, stats_right
+        return panel_stats["left"], panel_stats["right"]
     
     # Exécuter le traitement des deux modèles
     try:
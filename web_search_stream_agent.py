@@ -55,13 +55,10 @@ En plus de tes compétences juridiques, tu peux répondre poliment aux salutatio
 """
 
 # --- Boucle Principale de Conversation ---
-def main():
-    user_input = input("Entrez votre question : ")
-    if not user_input:
-        print("Aucune question fournie. Arrêt du programme.")
-        return
-
-    messages = [{"role": "user", "content": user_input}]
+def run_conversation(messages):
+    """Streame les réponses de Claude et exécute les outils locaux jusqu'à la fin du tour.
+    Retourne le dernier message du modèle (None en cas d'erreur)."""
+    final_message = None
 
     while True:
         print("\n\033[34m--- Appel au modèle Claude ---\033[0m")
@@ -86,16 +83,16 @@ def main():
             print(f"\n\033[31mERREUR API : {e}\033[0m")
             print("\nSi l'erreur est 'not_found_error', cela peut signifier que votre clé API n'a pas encore accès à ce modèle ou à ses outils.")
             print("Dans ce cas, essayez avec 'claude-3-opus-20240229'.")
-            break
+            return None
         except Exception as e:
             print(f"\n\033[31mUne erreur inattendue est survenue : {e}\033[0m")
-            break
+            return None
 
         print(f"\n\n\033[32mRaison de l'arrêt: {final_message.stop_reason}\033[0m")
 
         if final_message.stop_reason in ["end_turn", "stop_sequence"]:
             print("\n\033[32mConversation terminée.\033[0m")
-            break
+            return final_message
 
         elif final_message.stop_reason == "tool_use":
             print("\033[33mLe modèle a utilisé des outils. Traitement en cours...\033[0m")
@@ -120,6 +117,20 @@ def main():
             if tool_results_content:
                 messages.append({"role": "user", "content": tool_results_content})
                 print("\033[34mRésultats des outils locaux envoyés au modèle pour la synthèse finale.\033[0m")
+            else:
+                # Seuls des outils serveur (web_search) : rien à renvoyer au modèle
+                return final_message
+
+        else:
+            return final_message
+
+def main():
+    user_input = input("Entrez votre question : ")
+    if not user_input:
+        print("Aucune question fournie. Arrêt du programme.")
+        return
+
+    run_conversation([{"role": "user", "content": user_input}])
 
 if __name__ == "__main__":
     main()
\ No newline at end of file